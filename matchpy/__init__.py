@@ -6,14 +6,16 @@ import pkg_resources
 # pylint: disable=wildcard-import
 from . import expressions
 from . import functions
+from . import egraph
 from . import utils
 from . import matching
 
 from .expressions import *
 from .functions import *
+from .egraph import *
 from .utils import *
 from .matching import *
 
-__all__ = expressions.__all__ + functions.__all__ + utils.__all__ + matching.__all__
+__all__ = expressions.__all__ + functions.__all__ + egraph.__all__ + utils.__all__ + matching.__all__
 
 __version__ = pkg_resources.get_distribution(__name__).version
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""This module contains an e-graph for rewriting expressions by equality saturation.
+
+An `EGraph` represents many equivalent expressions at once. Instead of destructively replacing subexpressions like
+`replace_all()` or the `ManyToOneReplacer`, `EGraph.saturate()` adds the result of every replacement to the e-graph as
+an equivalent alternative. Hence, the rules can be applied in any order without committing to one of them. Afterwards,
+`EGraph.extract()` chooses the cheapest of all equivalent expressions according to a cost function.
+"""
+import itertools
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from .expressions.expressions import Expression, Operation, Symbol, Wildcard
+from .expressions.functions import op_iter
+from .functions import ReplacementRule, _apply_replacement
+from .matching.many_to_one import ManyToOneMatcher
+
+__all__ = ['EGraph']
+
+ENode = Tuple[object, Tuple[int, ...]]
+CostFunction = Callable[[object, List[float]], float]
+
+
+class _EClassSymbol(Symbol):
+    """A placeholder for an e-class in the expressions that are matched against the rules."""
+
+    def __init__(self, class_id: int) -> None:
+        super().__init__('#{}'.format(class_id))
+        self.class_id = class_id
+
+
+class _EClass:
+    __slots__ = ('nodes', 'parents')
+
+    def __init__(self, node: ENode) -> None:
+        self.nodes = {node}
+        self.parents = []  # type: List[Tuple[ENode, int]]
+
+
+def _size_cost(head, operand_costs: List[float]) -> float:
+    return 1 + sum(operand_costs)
+
+
+def _match_depth(expression: Expression) -> int:
+    """Return the depth up to which the e-classes need to be expanded to match the pattern expression."""
+    if isinstance(expression, Wildcard):
+        return 0
+    if isinstance(expression, Operation):
+        return 1 + max((_match_depth(o) for o in op_iter(expression)), default=0)
+    return 1
+
+
+class EGraph:
+    """An e-graph, i.e. a set of expressions partitioned into classes of equivalent expressions.
+
+    Every e-class consists of e-nodes, which are either atomic expressions or operations whose operands are e-classes.
+    The e-nodes are hash-consed, so that structurally equal expressions are only stored once. The equivalence is
+    maintained with a union-find data structure and kept closed under congruence by :meth:`rebuild`.
+
+    Replacement rules can be applied to all expressions in the e-graph at once until nothing changes anymore:
+
+    >>> egraph = EGraph()
+    >>> root = egraph.add(f(f(a)))
+    >>> rules = [ReplacementRule(Pattern(f(f(x_))), lambda x: x), ReplacementRule(Pattern(a), lambda: f(b))]
+    >>> egraph.saturate(rules)
+    True
+    >>> egraph.equivalent(f(f(a)), f(b))
+    True
+    >>> print(egraph.extract(root))
+    a
+
+    The rules are matched against the e-graph with a :class:`.ManyToOneMatcher`. For that, the e-classes are expanded
+    into expressions as deep as the deepest pattern. Below that depth, the e-classes are represented by placeholder
+    symbols that the variables of the patterns bind to. Constraints are therefore evaluated with these placeholders in
+    place of deeper subexpressions.
+    """
+
+    def __init__(self) -> None:
+        self._parents = []  # type: List[int]
+        self._classes = {}  # type: Dict[int, _EClass]
+        self._hashcons = {}  # type: Dict[ENode, int]
+        self._pending = []  # type: List[int]
+
+    @property
+    def node_count(self) -> int:
+        """The number of e-nodes in the e-graph."""
+        return len(self._hashcons)
+
+    @property
+    def class_count(self) -> int:
+        """The number of e-classes in the e-graph."""
+        return len(self._classes)
+
+    def find(self, class_id: int) -> int:
+        """Return the canonical id of the e-class."""
+        parents = self._parents
+        root = class_id
+        while parents[root] != root:
+            root = parents[root]
+        while parents[class_id] != root:
+            parents[class_id], class_id = root, parents[class_id]
+        return root
+
+    def _canonicalize(self, node: ENode) -> ENode:
+        head, children = node
+        if not children:
+            return node
+        children = tuple(self.find(child) for child in children)
+        if head.commutative:
+            children = tuple(sorted(children))
+        return head, children
+
+    def add(self, expression: Expression) -> int:
+        """Add the expression to the e-graph.
+
+        Args:
+            expression:
+                The expression to add. Must be constant.
+
+        Returns:
+            The id of the e-class that contains the expression.
+        """
+        if isinstance(expression, _EClassSymbol):
+            return self.find(expression.class_id)
+        if isinstance(expression, Operation):
+            node = (type(expression), tuple(self.add(operand) for operand in op_iter(expression)))
+        else:
+            node = (expression, ())
+        return self._add_node(node)
+
+    def _add_node(self, node: ENode) -> int:
+        node = self._canonicalize(node)
+        class_id = self._hashcons.get(node)
+        if class_id is not None:
+            return self.find(class_id)
+        class_id = len(self._parents)
+        self._parents.append(class_id)
+        self._classes[class_id] = _EClass(node)
+        for child in node[1]:
+            self._classes[child].parents.append((node, class_id))
+        self._hashcons[node] = class_id
+        return class_id
+
+    def lookup(self, expression: Expression) -> Optional[int]:
+        """Return the id of the e-class that contains the expression or None, if it is not in the e-graph."""
+        if isinstance(expression, _EClassSymbol):
+            return self.find(expression.class_id)
+        if isinstance(expression, Operation):
+            children = []
+            for operand in op_iter(expression):
+                child = self.lookup(operand)
+                if child is None:
+                    return None
+                children.append(child)
+            node = (type(expression), tuple(children))
+        else:
+            node = (expression, ())
+        class_id = self._hashcons.get(self._canonicalize(node))
+        return None if class_id is None else self.find(class_id)
+
+    def equivalent(self, expression1: Expression, expression2: Expression) -> bool:
+        """Check whether the expressions are both contained in the e-graph and known to be equivalent."""
+        class1 = self.lookup(expression1)
+        return class1 is not None and class1 == self.lookup(expression2)
+
+    def union(self, class1: int, class2: int) -> int:
+        """Merge two e-classes.
+
+        The e-graph is only closed under congruence again after calling :meth:`rebuild`.
+
+        Returns:
+            The id of the merged e-class.
+        """
+        class1, class2 = self.find(class1), self.find(class2)
+        if class1 == class2:
+            return class1
+        if len(self._classes[class1].parents) < len(self._classes[class2].parents):
+            class1, class2 = class2, class1
+        self._parents[class2] = class1
+        merged = self._classes.pop(class2)
+        eclass = self._classes[class1]
+        eclass.nodes |= merged.nodes
+        eclass.parents.extend(merged.parents)
+        self._pending.append(class1)
+        return class1
+
+    def rebuild(self) -> None:
+        """Restore the congruence closure after e-classes have been merged.
+
+        Operations with equivalent operands are equivalent, so their e-classes are merged as well.
+        """
+        while self._pending:
+            todo = set(self.find(class_id) for class_id in self._pending)
+            self._pending = []
+            for class_id in todo:
+                self._repair(self.find(class_id))
+
+    def _repair(self, class_id: int) -> None:
+        eclass = self._classes[class_id]
+        for node, parent in eclass.parents:
+            self._hashcons.pop(node, None)
+            self._hashcons[self._canonicalize(node)] = self.find(parent)
+        new_parents = {}
+        for node, parent in eclass.parents:
+            node = self._canonicalize(node)
+            if node in new_parents:
+                self.union(parent, new_parents[node])
+            new_parents[node] = self.find(parent)
+        self._classes[self.find(class_id)].parents = list(new_parents.items())
+
+    def _expand(self, class_id: int, depth: int, cache: Dict[Tuple[int, int], List[Expression]],
+                limit: int) -> List[Expression]:
+        """Return up to *limit* expressions of the e-class, expanded up to the given depth."""
+        if depth == 0:
+            return [_EClassSymbol(class_id)]
+        key = (class_id, depth)
+        expressions = cache.get(key)
+        if expressions is not None:
+            return expressions
+        expressions = cache[key] = []
+        for head, children in set(map(self._canonicalize, self._classes[class_id].nodes)):
+            if not children:
+                expressions.append(head() if isinstance(head, type) else head)
+                continue
+            operands = [self._expand(child, depth - 1, cache, limit) for child in children]
+            for combination in itertools.islice(itertools.product(*operands), limit - len(expressions)):
+                expressions.append(head(*combination))
+            if len(expressions) >= limit:
+                break
+        return expressions
+
+    def saturate(
+            self,
+            rules: Iterable[ReplacementRule],
+            max_iterations: Optional[int]=None,
+            node_limit: int=10000,
+            expansion_limit: int=100
+    ) -> bool:
+        """Apply the replacement rules to the e-graph until it is saturated or the budget is exhausted.
+
+        In every iteration, all matches of the rules in the e-graph are collected first. Then the results of their
+        replacements are added to the e-graph and merged with the e-classes of the matched expressions. The e-graph
+        is saturated, when this does not change any e-class anymore.
+
+        Args:
+            rules:
+                The replacement rules to apply. Note that replacements that result in a sequence of expressions are
+                ignored, because they are not equivalent to a single expression.
+            max_iterations:
+                The maximum number of iterations. If None, the number of iterations is unlimited.
+            node_limit:
+                The maximum number of e-nodes. Once it is exceeded, the saturation is stopped.
+            expansion_limit:
+                The maximum number of expressions that an e-class is expanded into for matching at each depth.
+
+        Returns:
+            True, iff the e-graph is saturated.
+        """
+        rules = [ReplacementRule(pattern, replacement) for pattern, replacement in rules]
+        if not rules:
+            return True
+        matcher = ManyToOneMatcher()
+        for index, (pattern, _) in enumerate(rules):
+            matcher.add(pattern, index)
+        depth = max(_match_depth(pattern.expression) for pattern, _ in rules)
+        self.rebuild()
+        for _ in itertools.count() if max_iterations is None else range(max_iterations):
+            matches = []
+            cache = {}
+            for class_id in list(self._classes):
+                for expression in self._expand(class_id, depth, cache, expansion_limit):
+                    for index, substitution in matcher.match(expression):
+                        matches.append((class_id, index, substitution))
+            changed = False
+            for class_id, index, substitution in matches:
+                result = _apply_replacement(rules[index].replacement, substitution)
+                if isinstance(result, (list, tuple)):
+                    continue
+                result_id = self.add(result)
+                if self.find(result_id) != self.find(class_id):
+                    self.union(class_id, result_id)
+                    changed = True
+                if self.node_count > node_limit:
+                    self.rebuild()
+                    return False
+            self.rebuild()
+            if not changed:
+                return True
+        return False
+
+    def extract(self, expression: Union[Expression, int], cost: CostFunction=None) -> Expression:
+        """Extract the cheapest expression that is equivalent to the given one.
+
+        Args:
+            expression:
+                The expression or the id of its e-class.
+            cost:
+                A function that computes the cost of an e-node. It is called with the head of the e-node, i.e. the
+                atomic expression or the operation class, and the list of costs of the operands. The cost of an
+                operation must be larger than the cost of each of its operands. By default, the cost is the number of
+                subexpressions.
+
+        Returns:
+            The cheapest expression in the e-class.
+
+        Raises:
+            KeyError:
+                If the expression is not in the e-graph.
+        """
+        if cost is None:
+            cost = _size_cost
+        self.rebuild()
+        class_id = expression if isinstance(expression, int) else self.lookup(expression)
+        if class_id is None:
+            raise KeyError("The expression {!s} is not in the e-graph.".format(expression))
+        best = {}  # type: Dict[int, Tuple[float, ENode]]
+        changed = True
+        while changed:
+            changed = False
+            for eclass_id, eclass in self._classes.items():
+                for node in eclass.nodes:
+                    head, children = self._canonicalize(node)
+                    if not all(child in best for child in children):
+                        continue
+                    node_cost = cost(head, [best[child][0] for child in children])
+                    if eclass_id not in best or node_cost < best[eclass_id][0]:
+                        best[eclass_id] = (node_cost, (head, children))
+                        changed = True
+        return self._build(self.find(class_id), best)
+
+    def _build(self, class_id: int, best: Dict[int, Tuple[float, ENode]]) -> Expression:
+        head, children = best[class_id][1]
+        if not isinstance(head, type):
+            return head
+        return head(*(self._build(child, best) for child in children))
@@ -576,8 +576,19 @@ class Operation(Expression, metaclass=_OperationMeta):
             yield from operand._preorder_iter(predicate, position + (i, ))  # pylint: disable=protected-access
 
     def __hash__(self):
+        return self._hash
+
+    @cached_property
+    def _hash(self) -> int:
+        # Expressions are immutable, so the hash only needs to be computed once per subexpression
         return hash((self.name, ) + tuple(self.operands))
 
+    def __getstate__(self):
+        # The hashes of strings differ between processes, so the cached hash must not be pickled
+        state = self.__dict__.copy()
+        state.pop('_hash', None)
+        return state
+
     def with_renamed_vars(self, renaming) -> 'Operation':
         return type(self)(
             *(o.with_renamed_vars(renaming) for o in self.operands),
@@ -139,6 +139,46 @@ def rename_variables(expression: Expression, renaming: Dict[str, str]) -> Expres
     return expression
 
 
+def _is_identical(expression, other) -> bool:
+    """Check if the two expressions are equal and all their corresponding subexpressions also have the same type.
+
+    Plain equality does not distinguish instances of different classes, e.g. a symbol and a symbol of a subclass
+    with the same name are equal, even though patterns can tell them apart.
+    """
+    if expression is other:
+        return True
+    if type(expression) is not type(other):
+        return False
+    if isinstance(expression, Operation):
+        return (
+            getattr(expression, 'variable_name', None) == getattr(other, 'variable_name', None) and
+            op_len(expression) == op_len(other) and
+            all(_is_identical(x, y) for x, y in zip(op_iter(expression), op_iter(other)))
+        )
+    return expression == other
+
+
+class _ExpressionKey:
+    """A hashable key for an expression that is only equal to the key of an identical expression.
+
+    Used to cache results for subjects where the result depends on the exact types of the subexpressions.
+    Creating the key does not hash the expression, so a :class:`TypeError` for an unhashable expression is only
+    raised once the key is used.
+    """
+    __slots__ = ('expression', )
+
+    def __init__(self, expression) -> None:
+        self.expression = expression
+
+    def __hash__(self):
+        return hash(self.expression)
+
+    def __eq__(self, other):
+        if not isinstance(other, _ExpressionKey):
+            return NotImplemented
+        return _is_identical(self.expression, other.expression)
+
+
 @singledispatch
 def create_operation_expression(old_operation, new_operands, variable_name=True):
     if variable_name is True:
@@ -2,6 +2,7 @@
 """This module contains various functions for working with expressions.
 
 - With `substitute()` you can replace occurrences of variables with an expression or sequence of expressions.
+  With `compile_substitution()` you can do the same repeatedly for a template without traversing it each time.
 - With `replace()` you can replace a subexpression at a specific position with a different expression or
   sequence of expressions.
 - With `replace_many()` works the same as `replace()`, but you can replace multiple positions at once.
@@ -10,19 +11,29 @@
 """
 
 import itertools
+import json
 import math
-from typing import Callable, List, NamedTuple, Sequence, Tuple, Union, Iterable
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union, Iterable
 
 from multiset import Multiset
 
 from .expressions.expressions import (
-    Expression, Operation, Pattern, Wildcard, SymbolWildcard, AssociativeOperation, CommutativeOperation
+    Expression, Operation, Pattern, Wildcard, SymbolWildcard, AssociativeOperation, CommutativeOperation,
+    OneIdentityOperation
 )
 from .expressions.substitution import Substitution
-from .expressions.functions import preorder_iter_with_position, create_operation_expression, op_iter, op_len
-from .matching.one_to_one import match
+from .expressions.functions import (
+    preorder_iter, preorder_iter_with_position, create_operation_expression, op_iter, op_len, get_head, is_constant,
+    _ExpressionKey
+)
+from .matching.one_to_one import match, _can_check_existence, _exists
+from .utils import Budget, BudgetExceeded, LRUCache, get_short_lambda_source
 
-__all__ = ['substitute', 'replace', 'replace_all', 'replace_many', 'is_match', 'ReplacementRule', 'replace_all_post_order']
+__all__ = [
+    'substitute', 'replace', 'replace_all', 'replace_many', 'is_match', 'ReplacementRule', 'replace_all_post_order',
+    'RuleProfiler', 'RewriteCycleError', 'Template', 'compile_substitution'
+]
 
 Replacement = Union[Expression, List[Expression]]
 
@@ -71,6 +82,36 @@ def substitute(expression: Union[Expression, Pattern], substitution: Substitutio
     return _substitute(expression, substitution)[0]
 
 
+def compile_substitution(template: Union[Expression, Pattern]) -> Callable[[Substitution], Replacement]:
+    """Compile the template into a function that substitutes its variables.
+
+    The compiled function gives the same result as :func:`substitute`, but the template is only traversed once
+    during the compilation. The positions of its variables are precomputed, so that applying the substitution only
+    rebuilds the operations that contain variables and reuses all other subexpressions of the template:
+
+    >>> substitute_f = compile_substitution(f(x_, f(b)))
+    >>> print(substitute_f({'x': a}))
+    f(a, f(b))
+    >>> substitute_f({'x': a})[1] is substitute_f({'x': c})[1]
+    True
+
+    Use this instead of :func:`substitute` if the same template is substituted many times.
+
+    Args:
+        template:
+            An expression in which variables are substituted.
+
+    Returns:
+        A function that takes a substitution and returns the expression resulting from applying it to the template.
+    """
+    if isinstance(template, Pattern):
+        template = template.expression
+    instantiate = _compile_substitution(template)
+    if instantiate is None:
+        return lambda substitution: template
+    return lambda substitution: instantiate(substitution)[0]
+
+
 def _substitute(expression: Expression, substitution: Substitution) -> Tuple[Replacement, bool]:
     if getattr(expression, 'variable_name', False) and expression.variable_name in substitution:
         return substitution[expression.variable_name], True
@@ -211,7 +252,485 @@ def replace_many(expression: Expression, replacements: Sequence[Tuple[Sequence[i
 ReplacementRule = NamedTuple('ReplacementRule', [('pattern', Pattern), ('replacement', Callable[..., Expression])])
 
 
-def replace_all(expression: Expression, rules: Iterable[ReplacementRule], max_count: int=math.inf) \
+class Template:
+    """A replacement for a :class:`ReplacementRule` given as an expression instead of a callback.
+
+    The variables in the template are replaced with their values from the match substitution:
+
+    >>> rule = ReplacementRule(Pattern(f(x_, y_)), Template(f(y_, x_)))
+    >>> print(replace_all(f(a, b), [rule], max_count=1))
+    f(b, a)
+
+    The template is compiled once with :func:`compile_substitution`. Applying it only rebuilds the operations that
+    contain variables and reuses all other subexpressions of the template. The replacement functions
+    in this module and the :class:`.ManyToOneReplacer` pass the match substitution to the template directly instead of
+    as keyword arguments. A template can still be called like any other replacement callback:
+
+    >>> print(Template(f(x_, y_))(x=a, y=b))
+    f(a, b)
+
+    Args:
+        template:
+            The template expression. Its variables are substituted like in :func:`substitute`.
+    """
+
+    __slots__ = ('template', '_substitute')
+
+    def __init__(self, template: Union[Expression, Pattern]) -> None:
+        if isinstance(template, Pattern):
+            template = template.expression
+        self.template = template
+        self._substitute = compile_substitution(template)
+
+    def substitute(self, substitution: Substitution) -> Replacement:
+        """Substitute the variables in the template.
+
+        Args:
+            substitution:
+                The substitution for the variables.
+
+        Returns:
+            The expression resulting from the substitution.
+        """
+        return self._substitute(substitution)
+
+    def __call__(self, **substitution) -> Replacement:
+        return self.substitute(substitution)
+
+    def __repr__(self):
+        return '{!s}({!r})'.format(type(self).__name__, self.template)
+
+    def __str__(self):
+        return str(self.template)
+
+
+def _compile_substitution(expression: Expression) -> Optional[Callable[[Substitution], Tuple[Replacement, bool]]]:
+    """Compile the expression into a function that works like :func:`_substitute` for it.
+
+    Returns:
+        The compiled function or None, if the expression contains no variables.
+    """
+    variable_name = getattr(expression, 'variable_name', None) or None
+    operands = None
+    if isinstance(expression, Operation):
+        operands = [(operand, _compile_substitution(operand)) for operand in op_iter(expression)]
+        if all(instantiate is None for _, instantiate in operands):
+            operands = None
+    if operands is None:
+        if variable_name is None:
+            return None
+
+        def _instantiate_variable(substitution):
+            if variable_name in substitution:
+                return substitution[variable_name], True
+            return expression, False
+
+        return _instantiate_variable
+
+    # Commutative operations sort their operands anyway
+    sort_multisets = not type(expression).commutative
+
+    def _instantiate_operation(substitution):
+        if variable_name is not None and variable_name in substitution:
+            return substitution[variable_name], True
+        any_replaced = False
+        new_operands = []
+        for operand, instantiate in operands:
+            if instantiate is None:
+                new_operands.append(operand)
+                continue
+            result, replaced = instantiate(substitution)
+            if replaced:
+                any_replaced = True
+            if isinstance(result, (list, tuple)):
+                new_operands.extend(result)
+            elif isinstance(result, Multiset):
+                new_operands.extend(sorted(result) if sort_multisets else result)
+            else:
+                new_operands.append(result)
+        if any_replaced:
+            return create_operation_expression(expression, new_operands), True
+        return expression, False
+
+    return _instantiate_operation
+
+
+def _apply_replacement(replacement: Callable[..., Replacement], substitution: Substitution) -> Replacement:
+    """Apply the replacement of a rule to the match substitution."""
+    if isinstance(replacement, Template):
+        return replacement.substitute(substitution)
+    return replacement(**substitution)
+
+
+class RuleStatistics:
+    """The statistics that a :class:`RuleProfiler` collects for a single rule."""
+
+    __slots__ = (
+        'pattern', 'replacement', 'attempts', 'matches', 'applications', 'match_time', 'replacement_time', 'growth'
+    )
+
+    def __init__(self, pattern: Pattern, replacement: Callable[..., Expression]) -> None:
+        self.pattern = pattern
+        self.replacement = replacement
+        self.attempts = 0
+        self.matches = 0
+        self.applications = 0
+        self.match_time = 0.0
+        self.replacement_time = 0.0
+        self.growth = 0
+
+    @property
+    def name(self) -> str:
+        """A string representation of the rule."""
+        replacement = getattr(self.replacement, '__name__', None)
+        if replacement == '<lambda>':
+            replacement = get_short_lambda_source(self.replacement) or replacement
+        return '{!s} -> {}'.format(self.pattern, replacement or repr(self.replacement))
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the statistics as a dictionary."""
+        return {
+            'rule': self.name,
+            'attempts': self.attempts,
+            'matches': self.matches,
+            'applications': self.applications,
+            'match_time': self.match_time,
+            'replacement_time': self.replacement_time,
+            'growth': self.growth,
+        }
+
+
+class RuleProfiler:
+    """Collects statistics about the application of replacement rules.
+
+    A profiler can be passed to :func:`replace_all`, :func:`replace_all_post_order` or a
+    :class:`.ManyToOneReplacer`. For every rule, it records how often it was tried (*attempts*), how often it matched
+    (*matches*) and was applied (*applications*), the time spent matching it (*match_time*) and in its replacement
+    callback (*replacement_time*), and by how many nodes the applications changed the expression (*growth*).
+
+    A :class:`.ManyToOneMatcher` matches all rules at once, so its matching time cannot be attributed to individual
+    rules. It is recorded in *many_to_one_time* instead and the *attempts* and *match_time* of the rules only contain
+    the one-to-one matching.
+
+    >>> profiler = RuleProfiler()
+    >>> print(replace_all(f(f(a)), [ReplacementRule(Pattern(f(a)), lambda: b)], profiler=profiler))
+    f(b)
+    >>> profiler.rules[0].applications, profiler.rules[0].growth
+    (1, -1)
+    """
+
+    def __init__(self) -> None:
+        self.rules = []  # type: List[RuleStatistics]
+        self.many_to_one_attempts = 0
+        self.many_to_one_time = 0.0
+        self._rule_indices = {}  # type: Dict[Tuple[int, int], int]
+
+    def get(self, pattern: Pattern, replacement: Callable[..., Expression]) -> RuleStatistics:
+        """Return the statistics for the rule with the given pattern and replacement."""
+        key = (id(pattern), id(replacement))
+        index = self._rule_indices.get(key)
+        if index is None:
+            index = self._rule_indices[key] = len(self.rules)
+            self.rules.append(RuleStatistics(pattern, replacement))
+        return self.rules[index]
+
+    def record_many_to_one_match(self, duration: float) -> None:
+        self.many_to_one_attempts += 1
+        self.many_to_one_time += duration
+
+    def record_match(self, pattern: Pattern, replacement: Callable[..., Expression], duration: float, matched: bool) \
+            -> None:
+        statistics = self.get(pattern, replacement)
+        statistics.attempts += 1
+        statistics.match_time += duration
+        if matched:
+            statistics.matches += 1
+
+    def profiled_replacement(self, pattern: Pattern, replacement: Callable[..., Expression], subject: Expression) \
+            -> Callable[..., Expression]:
+        """Wrap the replacement callback of a rule, so that its applications to the subject are recorded."""
+
+        def _replacement(**kwargs):
+            start = time.perf_counter()
+            result = _apply_replacement(replacement, kwargs)
+            duration = time.perf_counter() - start
+            statistics = self.get(pattern, replacement)
+            statistics.applications += 1
+            statistics.replacement_time += duration
+            statistics.growth += self._size(result) - self._size(subject)
+            return result
+
+        return _replacement
+
+    @staticmethod
+    def _size(expression) -> int:
+        if isinstance(expression, (list, tuple)):
+            return sum(len(list(preorder_iter(e))) for e in expression)
+        return len(list(preorder_iter(expression)))
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the collected statistics as a dictionary."""
+        return {
+            'many_to_one_attempts': self.many_to_one_attempts,
+            'many_to_one_time': self.many_to_one_time,
+            'rules': [statistics.as_dict() for statistics in self.rules],
+        }
+
+    def to_json(self, **kwargs) -> str:
+        """Return the collected statistics as JSON.
+
+        Args:
+            **kwargs:
+                Additional arguments for :func:`json.dumps`.
+        """
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def table(self) -> str:
+        """Return the collected statistics as a table, with the most time consuming rules first."""
+        rows = [('Rule', 'Attempts', 'Matches', 'Applications', 'Match time', 'Replacement time', 'Growth')]
+        for statistics in sorted(self.rules, key=lambda s: s.match_time + s.replacement_time, reverse=True):
+            rows.append((
+                statistics.name, str(statistics.attempts), str(statistics.matches), str(statistics.applications),
+                '{:.6f}'.format(statistics.match_time), '{:.6f}'.format(statistics.replacement_time),
+                str(statistics.growth)
+            ))
+        if self.many_to_one_attempts:
+            rows.append(('(many-to-one matcher)', str(self.many_to_one_attempts), '', '',
+                         '{:.6f}'.format(self.many_to_one_time), '', ''))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = []
+        for row in rows:
+            lines.append('  '.join([row[0].ljust(widths[0])] + [c.rjust(w) for c, w in zip(row[1:], widths[1:])]))
+        return '\n'.join(lines)
+
+
+class RewriteCycleError(Exception):
+    """Raised when the replacement rules rewrite an expression into one of its earlier intermediate forms.
+
+    Attributes:
+        expression:
+            The intermediate expression that was encountered again.
+        rules:
+            The replacement rules that were applied in the cycle in the order of their application, starting with
+            the first rule applied to the repeated expression.
+    """
+
+    def __init__(self, expression: Replacement, rules: List[ReplacementRule]) -> None:
+        self.expression = expression
+        self.rules = rules
+        super().__init__(
+            'The expression {!s} is rewritten back into itself by the rules: {}'.format(
+                expression, ', '.join(RuleStatistics(*rule).name for rule in rules)
+            )
+        )
+
+
+class _CycleDetector:
+    """Remembers the intermediate expressions of a replacement to detect when one of them is encountered again.
+
+    Args:
+        expression:
+            The initial expression.
+        on_cycle:
+            Either ``'stop'`` to stop at the repeated expression or ``'raise'`` to raise a :class:`RewriteCycleError`.
+    """
+
+    __slots__ = ('on_cycle', 'seen', 'steps')
+
+    def __init__(self, expression: Replacement, on_cycle: str) -> None:
+        if on_cycle not in ('stop', 'raise'):
+            raise ValueError("Invalid value for on_cycle: {!r}, expected 'stop' or 'raise'.".format(on_cycle))
+        self.on_cycle = on_cycle
+        # Maps the intermediate expressions to the number of steps that lead to them
+        self.seen = {}
+        self.steps = []
+        self._remember(expression)
+
+    def _remember(self, expression: Replacement) -> Optional[int]:
+        try:
+            return self.seen.setdefault(expression, len(self.steps))
+        except TypeError:
+            # Sequences of expressions are not hashable and do not occur in a cycle
+            return None
+
+    def step(self, expression: Replacement, rules: List[ReplacementRule]) -> bool:
+        """Record a step of the replacement.
+
+        Args:
+            expression:
+                The expression resulting from the step.
+            rules:
+                The rules that were applied in the step.
+
+        Returns:
+            True, iff the expression was encountered before and the replacement should stop.
+
+        Raises:
+            RewriteCycleError:
+                If the expression was encountered before and *on_cycle* is ``'raise'``.
+        """
+        self.steps.append(rules)
+        start = self._remember(expression)
+        if start is None or start == len(self.steps):
+            return False
+        if self.on_cycle == 'raise':
+            raise RewriteCycleError(expression, [rule for step in self.steps[start:] for rule in step])
+        return True
+
+
+class _HeadIndex:
+    """Indexes rules by the head of their pattern, so that only the rules whose head can match are tried.
+
+    Rules with a wildcard or one-identity operation as head can match subjects with any head and are always tried.
+
+    Args:
+        rules:
+            The rules to index.
+        indices:
+            The indices of the rules to index. By default, all rules are indexed.
+    """
+
+    __slots__ = ('heads', 'fallback', 'candidates_by_type')
+
+    def __init__(self, rules: List[ReplacementRule], indices: Optional[Iterable[int]]=None) -> None:
+        self.heads = {}
+        self.fallback = []
+        if indices is None:
+            indices = range(len(rules))
+        for index in indices:
+            head = get_head(rules[index].pattern.expression)
+            if head is None or issubclass(head, OneIdentityOperation):
+                self.fallback.append(index)
+            else:
+                self.heads.setdefault(head, []).append(index)
+        self.candidates_by_type = {}
+
+    def candidates(self, subject: Expression) -> List[int]:
+        """Return the indices of the rules that can match the subject in their original order."""
+        subject_type = type(subject)
+        try:
+            return self.candidates_by_type[subject_type]
+        except KeyError:
+            pass
+        indices = list(self.fallback)
+        for head, head_indices in self.heads.items():
+            if issubclass(subject_type, head):
+                indices.extend(head_indices)
+        indices.sort()
+        self.candidates_by_type[subject_type] = indices
+        return indices
+
+
+def _is_many_to_one_supported(expression: Expression) -> bool:
+    """Check whether the :class:`.ManyToOneMatcher` supports the pattern expression.
+
+    It does not support fixed size wildcards that match a number of expressions other than one.
+    """
+    return not any(
+        isinstance(e, Wildcard) and not isinstance(e, SymbolWildcard) and e.fixed_size and e.min_count != 1
+        for e in preorder_iter(expression)
+    )
+
+
+class _ManyToOneIndex:
+    """Finds the rules that match a subject at once with a :class:`.ManyToOneMatcher`.
+
+    Only the distinct matching rules are collected, so the search for the matches of a rule stops at its first match.
+    Rules that the many-to-one matcher does not support are indexed by a :class:`_HeadIndex` instead.
+
+    Args:
+        rules:
+            The rules to index.
+    """
+
+    __slots__ = ('matcher', 'unsupported')
+
+    def __init__(self, rules: List[ReplacementRule]) -> None:
+        from .matching.many_to_one import ManyToOneMatcher
+        self.matcher = ManyToOneMatcher()
+        unsupported = []
+        for rule_index, (pattern, _) in enumerate(rules):
+            if _is_many_to_one_supported(pattern.expression):
+                self.matcher.add(pattern, rule_index)
+            else:
+                unsupported.append(rule_index)
+        self.unsupported = _HeadIndex(rules, unsupported) if unsupported else None
+
+    def candidates(self, subject: Expression, budget: Optional[Budget]=None) -> List[int]:
+        """Return the indices of the rules that match the subject in their original order.
+
+        Rules with unsupported patterns are not matched, they are returned if their head can match the subject.
+        """
+        from .matching.many_to_one import _MatchIter
+        patterns = self.matcher.patterns
+        indices = [patterns[i][1] for i in _MatchIter(self.matcher, subject, budget=budget).matched_pattern_indices()]
+        if self.unsupported is not None:
+            indices.extend(self.unsupported.candidates(subject))
+            indices.sort()
+        return indices
+
+
+# With at least this many rules, replace_all() uses a many-to-one matcher to find the matching rules
+MANY_TO_ONE_THRESHOLD = 10
+_RULE_INDICES = LRUCache(16)
+
+
+def _get_rule_index(rules: List[ReplacementRule]):
+    """Return a many-to-one index or, if there are too few rules for it to pay off, a head index for the rules.
+
+    The indices are cached by the identity of the rules' patterns and replacements. The rules are stored along with
+    the index, so that the identities cannot be reused while the index is cached.
+    """
+    many_to_one = len(rules) >= MANY_TO_ONE_THRESHOLD
+    key = (many_to_one, ) + tuple((id(pattern), id(replacement)) for pattern, replacement in rules)
+    cached = _RULE_INDICES.get(key)
+    if cached is not None:
+        return cached[1]
+    index = _ManyToOneIndex(rules) if many_to_one else _HeadIndex(rules)
+    _RULE_INDICES[key] = (tuple(rules), index)
+    return index
+
+
+def _match_first_rule(subject: Expression, rules: List[ReplacementRule], index, profiler=None, budget=None) \
+        -> Optional[Tuple[ReplacementRule, Substitution]]:
+    """Return the first of the rules that matches the subject together with the match substitution.
+
+    The index (see :func:`_get_rule_index`) is used to find the candidate rules. The substitution is still obtained
+    from the one-to-one matching, so that the result is exactly the same as when trying all rules.
+    If a profiler is given, the replacement of the returned rule records its application.
+    """
+    if profiler is not None:
+        return _profiled_match_first_rule(subject, rules, index, profiler, budget)
+    if isinstance(index, _HeadIndex):
+        candidates = index.candidates(subject)
+    else:
+        candidates = index.candidates(subject, budget)
+    for rule_index in candidates:
+        rule = rules[rule_index]
+        for subst in match(subject, rule.pattern, budget):
+            return rule, subst
+    return None
+
+
+def _profiled_match_first_rule(subject, rules, index, profiler, budget=None):
+    if isinstance(index, _HeadIndex):
+        candidates = [rules[rule_index] for rule_index in index.candidates(subject)]
+    else:
+        start = time.perf_counter()
+        indices = index.candidates(subject, budget)
+        profiler.record_many_to_one_match(time.perf_counter() - start)
+        candidates = [rules[rule_index] for rule_index in indices]
+    for pattern, replacement in candidates:
+        start = time.perf_counter()
+        subst = next(match(subject, pattern, budget), None)
+        profiler.record_match(pattern, replacement, time.perf_counter() - start, subst is not None)
+        if subst is not None:
+            return ReplacementRule(pattern, profiler.profiled_replacement(pattern, replacement, subject)), subst
+    return None
+
+
+def replace_all(expression: Expression, rules: Iterable[ReplacementRule], max_count: int=math.inf,
+                profiler: Optional[RuleProfiler]=None, on_cycle: Optional[str]=None, budget: Optional[Budget]=None) \
         -> Union[Expression, Sequence[Expression]]:
     """Replace all occurrences of the patterns according to the replacement rules.
 
@@ -224,6 +743,31 @@ def replace_all(expression: Expression, rules: Iterable[ReplacementRule], max_co
     Note that the pattern can therefore not be a single sequence variable/wildcard, because only single expressions
     will be matched.
 
+    If multiple rules match the same subexpression, the first one of them is applied. Only the rules whose pattern
+    head can match the subexpression are tried. With many rules (see ``MANY_TO_ONE_THRESHOLD``), a
+    :class:`.ManyToOneMatcher` is used to find the matching rules at once instead. Both are cached for the given
+    rules, so that they are only built once when the same rules are used repeatedly.
+
+    If the rules are not confluent, the replacement can run into a cycle. With *on_cycle* set, the intermediate
+    expressions are remembered and the replacement stops as soon as one of them is encountered again:
+
+    >>> rules = [ReplacementRule(Pattern(a), lambda: b), ReplacementRule(Pattern(b), lambda: a)]
+    >>> print(replace_all(f(a), rules, on_cycle='stop'))
+    f(a)
+    >>> replace_all(f(a), rules, on_cycle='raise')
+    Traceback (most recent call last):
+    ...
+    matchpy.functions.RewriteCycleError: The expression f(a) is rewritten back into itself by the rules: a -> b, b -> a
+
+    With a *budget*, the replacement is aborted with a :class:`~matchpy.utils.BudgetExceeded` once the budget is
+    exhausted. Its *result* is the expression after the last completed replacement:
+
+    >>> try:
+    ...     replace_all(f(a, a, a, a), [ReplacementRule(Pattern(a), lambda: b)], budget=Budget(max_steps=5))
+    ... except BudgetExceeded as e:
+    ...     print(e.result)
+    f(b, b, a, a)
+
     Args:
         expression:
             The expression to which the replacement rules are applied.
@@ -233,36 +777,52 @@ def replace_all(expression: Expression, rules: Iterable[ReplacementRule], max_co
             If given, at most *max_count* applications of the rules are performed. Otherwise, the rules
             are applied until there is no more match. If the set of replacement rules is not confluent,
             the replacement might not terminate without a *max_count* set.
+        profiler:
+            An optional :class:`RuleProfiler` that collects statistics about the rules.
+        on_cycle:
+            If given, cycles are detected and either ``'stop'`` the replacement or ``'raise'`` a
+            :class:`RewriteCycleError`. Otherwise, cycles are not detected.
+        budget:
+            An optional :class:`~matchpy.utils.Budget` that limits the time and steps spent on matching.
 
     Returns:
         The resulting expression after the application of the replacement rules. This can also be a sequence of
         expressions, if the root expression is replaced with a sequence of expressions by a rule.
+
+    Raises:
+        RewriteCycleError:
+            If *on_cycle* is ``'raise'`` and a cycle is detected.
+        BudgetExceeded:
+            If the *budget* is exhausted.
     """
     rules = [ReplacementRule(pattern, replacement) for pattern, replacement in rules]
-    expression = expression
+    index = _get_rule_index(rules)
+    cycles = _CycleDetector(expression, on_cycle) if on_cycle is not None else None
     replaced = True
     replace_count = 0
-    while replaced and replace_count < max_count:
-        replaced = False
-        for subexpr, pos in preorder_iter_with_position(expression):
-            for pattern, replacement in rules:
-                try:
-                    subst = next(match(subexpr, pattern))
-                    result = replacement(**subst)
+    try:
+        while replaced and replace_count < max_count:
+            replaced = False
+            for subexpr, pos in preorder_iter_with_position(expression):
+                rule_match = _match_first_rule(subexpr, rules, index, profiler, budget)
+                if rule_match is not None:
+                    rule, subst = rule_match
+                    result = _apply_replacement(rule.replacement, subst)
                     expression = replace(expression, pos, result)
                     replaced = True
+                    if cycles is not None and cycles.step(expression, [rule]):
+                        return expression
                     break
-                except StopIteration:
-                    pass
-            if replaced:
-                break
-        replace_count += 1
+            replace_count += 1
+    except BudgetExceeded as e:
+        e.result = expression
+        raise
 
     return expression
 
 
-def replace_all_post_order(expression: Expression, rules: Iterable[ReplacementRule]) \
-        -> Union[Expression, Sequence[Expression]]:
+def replace_all_post_order(expression: Expression, rules: Iterable[ReplacementRule], cache: Optional[LRUCache]=None,
+                           profiler: Optional[RuleProfiler]=None) -> Union[Expression, Sequence[Expression]]:
     """Replace all occurrences of the patterns according to the replacement rules.
 
     A replacement rule consists of a *pattern*, that is matched against any subexpression
@@ -274,6 +834,9 @@ def replace_all_post_order(expression: Expression, rules: Iterable[ReplacementRu
     Note that the pattern can therefore not be a single sequence variable/wildcard, because only single expressions
     will be matched.
 
+    As in :func:`replace_all`, a cached :class:`.ManyToOneMatcher` is used to find the matching rules if there are many
+    rules. If multiple rules match the same subexpression, the first one of them is applied.
+
     Args:
         expression:
             The expression to which the replacement rules are applied.
@@ -283,39 +846,73 @@ def replace_all_post_order(expression: Expression, rules: Iterable[ReplacementRu
             If given, at most *max_count* applications of the rules are performed. Otherwise, the rules
             are applied until there is no more match. If the set of replacement rules is not confluent,
             the replacement might not terminate without a *max_count* set.
+        cache:
+            A cache for the normal forms of subexpressions, so that repeated subexpressions are only rewritten once.
+            By default, a new :class:`.LRUCache` is used for every call. A cache can be shared between calls
+            to keep its entries, but only if the rules are the same. Use ``LRUCache(0)`` to disable caching.
+        profiler:
+            An optional :class:`RuleProfiler` that collects statistics about the rules.
 
     Returns:
         The resulting expression after the application of the replacement rules. This can also be a sequence of
         expressions, if the root expression is replaced with a sequence of expressions by a rule.
     """
-    return _replace_all_post_order(expression, rules)[0]
-
-def _replace_all_post_order(expression, rules):
+    rules = [ReplacementRule(pattern, replacement) for pattern, replacement in rules]
+    if cache is None:
+        cache = LRUCache()
+    return _replace_all_post_order(expression, rules, _get_rule_index(rules), cache, profiler)[0]
+
+
+def _replace_all_post_order(expression, rules, index, cache, profiler):
+    key = _ExpressionKey(expression)
+    try:
+        cached = cache.get(key)
+    except TypeError:
+        # Expressions that are not hashable cannot be cached
+        cached = cache = None
+    if cached is not None:
+        return cached
     replaced = True
     any_replaced = False
     while replaced:
         replaced = False
         if isinstance(expression, Operation):
-            new_operands = [_replace_all_post_order(o, rules) for o in op_iter(expression)]
+            new_operands = [_replace_all_post_order(o, rules, index, cache, profiler) for o in op_iter(expression)]
             if any(r for _, r in new_operands):
                 new_operands = [o for o, _ in new_operands]
                 expression = create_operation_expression(expression, new_operands)
                 any_replaced = True
-        for pattern, replacement in rules:
-            try:
-                subst = next(iter(match(expression, pattern)))
-                expression = replacement(**subst)
-                replaced = any_replaced = True
-                break
-            except StopIteration:
-                pass
+        rule_match = _match_first_rule(expression, rules, index, profiler)
+        if rule_match is not None:
+            (_, replacement), subst = rule_match
+            expression = _apply_replacement(replacement, subst)
+            replaced = any_replaced = True
+    if cache is not None:
+        _cache_normal_form(cache, key, expression, any_replaced)
     return expression, any_replaced
 
 
-def is_match(subject: Expression, pattern: Expression) -> bool:
+def _cache_normal_form(cache: LRUCache, key: _ExpressionKey, normal_form, replaced: bool) -> None:
+    # The keys distinguish subexpressions of different types which are equal, e.g. symbols of different classes,
+    # because rules can match one of them but not the other
+    cache[key] = (normal_form, replaced)
+    if replaced:
+        # The normal form is often encountered again when its parent is rewritten
+        try:
+            cache[_ExpressionKey(normal_form)] = (normal_form, False)
+        except TypeError:
+            pass
+
+
+def is_match(subject: Expression, pattern: Pattern) -> bool:
     """
     Check whether the given *subject* matches given *pattern*.
 
+    If the pattern has no constraints and every variable occurs only once in it, the operands can be matched
+    independently of each other. Unless the pattern contains associative or one-identity operations or optional
+    wildcards, the check is then done without binding any variables. Otherwise, the first match is searched with
+    :func:`.match`.
+
     Args:
         subject:
             The subject.
@@ -324,5 +921,13 @@ def is_match(subject: Expression, pattern: Expression) -> bool:
 
     Returns:
         True iff the subject matches the pattern.
+
+    Raises:
+        ValueError:
+            If the subject is not constant.
     """
+    if _can_check_existence(pattern):
+        if not is_constant(subject):
+            raise ValueError("The subject for matching must be constant.")
+        return _exists(subject, pattern.expression)
     return any(True for _ in match(subject, pattern))
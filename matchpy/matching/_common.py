@@ -1,18 +1,25 @@
 # -*- coding: utf-8 -*-
 """This module contains the CommutativePatternsParts class which is used by multiple matching algorithms."""
-from typing import Callable, Dict, Iterator, NamedTuple, Optional, Sequence, Type, cast  # pylint: disable=unused-import
+from typing import (  # pylint: disable=unused-import
+    Callable, Dict, Iterable, Iterator, NamedTuple, Optional, Sequence, Set, Type, cast
+)
 
 from multiset import Multiset
 
+from ..expressions.constraints import Constraint
 from ..expressions.expressions import Expression, Operation, Wildcard, CommutativeOperation
 from ..expressions.substitution import Substitution
-from ..expressions.functions import is_constant, is_syntactic, op_iter
+from ..expressions.functions import is_constant, is_syntactic, op_iter, preorder_iter
+from ..utils import VariableWithCount
 
 __all__ = ['CommutativePatternsParts', 'Matcher', 'VarInfo']
 
 Matcher = Callable[[Sequence[Expression], Expression, Substitution], Iterator[Substitution]]
 VarInfo = NamedTuple('VarInfo', [('min_count', int), ('type', Optional[type]), ('default', Optional[Expression])])
 
+# While counting matches, the number of matches that a substitution stands for is stored under this key
+MULTIPLICITY = object()
+
 
 class CommutativePatternsParts(object):
     """Representation of the parts of a commutative pattern expression.
@@ -182,3 +189,35 @@ def check_one_identity(operation):
         else:
             return None, None
     return non_optional, added_subst
+
+
+def get_dependent_variables(expression: Expression, constraints: Iterable[Constraint]) -> Set[str]:
+    """Return the names of the variables that occur more than once in the pattern or in any of the constraints.
+
+    The values of all other variables do not influence whether the rest of the pattern matches. Hence, their
+    possible values can be counted instead of enumerated when only the number of matches is needed.
+    """
+    seen = set()
+    dependent = set()
+    for subexpression in preorder_iter(expression):
+        name = getattr(subexpression, 'variable_name', None)
+        if name is not None:
+            if name in seen:
+                dependent.add(name)
+            seen.add(name)
+    for constraint in constraints:
+        dependent.update(constraint.variables)
+    return dependent
+
+
+def can_count_variables(
+        substitution: Substitution, variables: Sequence[VariableWithCount], dependent_variables: Optional[Set[str]]
+) -> bool:
+    """Check whether the sequence variables can be counted instead of enumerated.
+
+    See :func:`get_dependent_variables` for how the dependent variables are determined.
+    """
+    return dependent_variables is not None and all(
+        v.name is None or (v.name not in dependent_variables and v.name not in substitution) for v in variables
+    )
+
@@ -7,7 +7,7 @@ The `BipartiteGraph` class is used to represent a bipartite graph as a dictionar
 The function `enum_maximum_matchings_iter` can be used to enumerate all maximum matchings of a `BipartiteGraph`.
 """
 
-from typing import (Dict, Generic, Hashable, Iterator, List, Set, Tuple, TypeVar, Union, cast, MutableMapping)
+from typing import (Dict, Generic, Hashable, Iterator, List, Optional, Set, Tuple, TypeVar, Union, cast, MutableMapping)
 
 try:
     from graphviz import Digraph, Graph
@@ -15,6 +15,8 @@ except ImportError:
     Digraph = Graph = None
 from hopcroftkarp import HopcroftKarp
 
+from ..utils import Budget
+
 __all__ = ['BipartiteGraph', 'enum_maximum_matchings_iter']
 
 T = TypeVar('T')
@@ -258,17 +260,33 @@ class _DirectedMatchGraph(Dict[Node, NodeSet], Generic[TLeft, TRight]):
         return cast(NodeList, [])
 
 
-def enum_maximum_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue]) -> Iterator[Dict[TLeft, TRight]]:
+def enum_maximum_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue],
+                                budget: Optional[Budget]=None) -> Iterator[Dict[TLeft, TRight]]:
+    """Enumerate all maximum matchings of the graph.
+
+    Args:
+        graph:
+            The bipartite graph.
+        budget:
+            An optional :class:`.Budget` that is charged one step for every step of the enumeration.
+
+    Yields:
+        All maximum matchings of the graph.
+
+    Raises:
+        BudgetExceeded:
+            If the *budget* is exhausted.
+    """
     matching = graph.find_matching()
     if matching:
         yield matching
         graph = graph.__copy__()
-        yield from _enum_maximum_matchings_iter(graph, matching, _DirectedMatchGraph(graph, matching))
+        yield from _enum_maximum_matchings_iter(graph, matching, _DirectedMatchGraph(graph, matching), budget)
 
 
 def _enum_maximum_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue], matching: Dict[TLeft, TRight],
-                                 directed_match_graph: _DirectedMatchGraph[TLeft, TRight]) \
-        -> Iterator[Dict[TLeft, TRight]]:
+                                 directed_match_graph: _DirectedMatchGraph[TLeft, TRight],
+                                 budget: Optional[Budget]=None) -> Iterator[Dict[TLeft, TRight]]:
     # Algorithm described in "Algorithms for Enumerating All Perfect, Maximum and Maximal Matchings in Bipartite Graphs"
     # By Takeaki Uno in "Algorithms and Computation: 8th International Symposium, ISAAC '97 Singapore,
     # December 17-19, 1997 Proceedings"
@@ -277,6 +295,8 @@ def _enum_maximum_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue
     # Step 1
     if len(graph) == 0:
         return
+    if budget is not None:
+        budget.step()
 
     # Step 2
     # Find a circle in the directed matching graph
@@ -314,7 +334,7 @@ def _enum_maximum_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue
         # Recurse with the new matching M' but without the edge e
         directed_match_graph_minus = _DirectedMatchGraph(graph, new_match)
 
-        yield from _enum_maximum_matchings_iter(graph, new_match, directed_match_graph_minus)
+        yield from _enum_maximum_matchings_iter(graph, new_match, directed_match_graph_minus, budget)
 
         graph[edge] = old_value
 
@@ -331,7 +351,7 @@ def _enum_maximum_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue
 
         directed_match_graph_plus = _DirectedMatchGraph(graph_plus, matching)
 
-        yield from _enum_maximum_matchings_iter(graph_plus, matching, directed_match_graph_plus)
+        yield from _enum_maximum_matchings_iter(graph_plus, matching, directed_match_graph_plus, budget)
 
         for left, right, value in edges:
             graph_plus[left, right] = value
@@ -381,7 +401,7 @@ def _enum_maximum_matchings_iter(graph: BipartiteGraph[TLeft, TRight, TEdgeValue
         dgm_minus = _DirectedMatchGraph(graph_minus, matching)
 
         # Step 9
-        yield from _enum_maximum_matchings_iter(graph_plus, new_match, dgm_plus)
+        yield from _enum_maximum_matchings_iter(graph_plus, new_match, dgm_plus, budget)
 
         # Step 10
-        yield from _enum_maximum_matchings_iter(graph_minus, matching, dgm_minus)
+        yield from _enum_maximum_matchings_iter(graph_minus, matching, dgm_minus, budget)
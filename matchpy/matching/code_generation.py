@@ -4,7 +4,7 @@ from ..expressions.expressions import Wildcard, AssociativeOperation, SymbolWild
 from ..expressions.constraints import CustomConstraint
 from ..expressions.functions import op_iter, get_variables
 from .syntactic import OPERATION_END, is_operation
-from .many_to_one import _EPS
+from .many_to_one import _EPS, _iter_bits
 from ..utils import get_short_lambda_source
 
 COLLAPSE_IF_RE = re.compile(
@@ -25,11 +25,12 @@ class CodeGenerator:
         self._code = ''
         self._subjects = ['subjects']
         self._substs = 0
-        self._patterns = set(range(len(matcher.patterns)))
+        self._patterns = ((1 << len(matcher.patterns)) - 1) & ~matcher.removed_patterns
         self._associative = 0
         self._associative_stack = [None]
         self._global_code = []
         self._imports = set()
+        self._commutative_matchers = {}
 
     def indent(self):
         self._level += 1
@@ -66,47 +67,12 @@ class CodeGenerator:
 
     def generate_state_code(self, state):
         if state.matcher is not None:
-            self._imports.add('from matchpy.matching.many_to_one import CommutativeMatcher')
-            self._imports.add('from multiset import Multiset')
-            self._imports.add('from matchpy.utils import VariableWithCount')
-            generator = type(self)(state.matcher.automaton)
-            generator.indent()
-            global_code, code = generator.generate_code(func_name='get_match_iter', add_imports=False)
-            self._global_code.append(global_code)
-            patterns = self.commutative_patterns(state.matcher.patterns)
-            subjects = repr(state.matcher.subjects)
-            subjects_by_id = repr(state.matcher.subjects_by_id)
-            associative = self.operation_symbol(state.matcher.associative)
-            max_optional_count = repr(state.matcher.max_optional_count)
-            anonymous_patterns = repr(state.matcher.anonymous_patterns)
-            self._global_code.append(
-                '''
-class CommutativeMatcher{0}(CommutativeMatcher):
-\t_instance = None
-\tpatterns = {1}
-\tsubjects = {2}
-\tsubjects_by_id = {7}
-\tbipartite = BipartiteGraph()
-\tassociative = {3}
-\tmax_optional_count = {4}
-\tanonymous_patterns = {5}
-
-\tdef __init__(self):
-\t\tself.add_subject(None)
-
-\t@staticmethod
-\tdef get():
-\t\tif CommutativeMatcher{0}._instance is None:
-\t\t\tCommutativeMatcher{0}._instance = CommutativeMatcher{0}()
-\t\treturn CommutativeMatcher{0}._instance
-
-\t@staticmethod
-{6}'''.strip().format(
-                    state.number, patterns, subjects, associative, max_optional_count, anonymous_patterns, code,
-                    subjects_by_id
-                )
-            )
-            self.add_line('matcher = CommutativeMatcher{}.get()'.format(state.number))
+            # The commutative matchers are shared between states, so only one class is generated for each of them
+            matcher_number = self._commutative_matchers.get(id(state.matcher))
+            if matcher_number is None:
+                matcher_number = self._commutative_matchers[id(state.matcher)] = state.number
+                self.generate_commutative_matcher_code(state.matcher, matcher_number)
+            self.add_line('matcher = CommutativeMatcher{}.get()'.format(matcher_number))
             tmp = self.get_var_name('tmp')
             self.add_line('{} = {}'.format(tmp, self._subjects[-1]))
             self.add_line('{} = []'.format(self._subjects[-1]))
@@ -116,7 +82,9 @@ class CommutativeMatcher{0}(CommutativeMatcher):
             subjects = self._subjects.pop()
             self.dedent()
             self.add_line(
-                'for pattern_index, subst{} in matcher.match({}, subst{}):'.format(self._substs + 1, tmp, self._substs)
+                'for pattern_index, subst{} in matcher.match({}, subst{}, {!r}):'.format(
+                    self._substs + 1, tmp, self._substs, set(state.transitions)
+                )
             )
             self._substs += 1
             self.indent()
@@ -145,7 +113,7 @@ class CommutativeMatcher{0}(CommutativeMatcher):
                 self.add_line('if len({}) == 0:'.format(self._subjects[-1]))
                 self.indent()
                 self.add_line('pass')
-                for pattern_index in self._patterns:
+                for pattern_index in _iter_bits(self._patterns):
                     constraints = self._matcher.patterns[pattern_index][0].global_constraints
                     for constraint in constraints:
                         self.enter_global_constraint(constraint)
@@ -158,6 +126,48 @@ class CommutativeMatcher{0}(CommutativeMatcher):
                     for transition in transitions:
                         self.generate_transition_code(transition)
 
+    def generate_commutative_matcher_code(self, matcher, number):
+        self._imports.add('from matchpy.matching.many_to_one import CommutativeMatcher')
+        self._imports.add('from multiset import Multiset')
+        self._imports.add('from matchpy.utils import VariableWithCount')
+        generator = type(self)(matcher.automaton)
+        generator.indent()
+        global_code, code = generator.generate_code(func_name='get_match_iter', add_imports=False)
+        self._global_code.append(global_code)
+        patterns = self.commutative_patterns(matcher.patterns)
+        subjects = repr(matcher.subjects)
+        subjects_by_id = repr(matcher.subjects_by_id)
+        associative = self.operation_symbol(matcher.associative)
+        max_optional_count = repr(matcher.max_optional_count)
+        anonymous_patterns = repr(matcher.anonymous_patterns)
+        self._global_code.append(
+            '''
+class CommutativeMatcher{0}(CommutativeMatcher):
+\t_instance = None
+\tpatterns = {1}
+\tsubjects = {2}
+\tsubjects_by_id = {7}
+\tbipartite = BipartiteGraph()
+\tassociative = {3}
+\tmax_optional_count = {4}
+\tanonymous_patterns = {5}
+
+\tdef __init__(self):
+\t\tself.add_subject(None)
+
+\t@staticmethod
+\tdef get():
+\t\tif CommutativeMatcher{0}._instance is None:
+\t\t\tCommutativeMatcher{0}._instance = CommutativeMatcher{0}()
+\t\treturn CommutativeMatcher{0}._instance
+
+\t@staticmethod
+{6}'''.strip().format(
+                number, patterns, subjects, associative, max_optional_count, anonymous_patterns, code,
+                subjects_by_id
+            )
+        )
+
     def commutative_var_entry(self, entry):
         return '(VariableWithCount({!r}, {}, {}, {}), {})'.format(
             entry[0][0], entry[0][1], entry[0][2],
@@ -439,14 +449,14 @@ class CommutativeMatcher{0}(CommutativeMatcher):
     def generate_constraints(self, constraints, transitions):
         if len(constraints) == 0:
             for transition in transitions:
-                removed = self._patterns - transition.patterns
-                self._patterns.intersection_update(transition.patterns)
+                removed = self._patterns & ~transition.patterns
+                self._patterns &= transition.patterns
                 self.generate_state_code(transition.target)
-                self._patterns.update(removed)
+                self._patterns |= removed
         else:
             constraint_index, *remaining = constraints
             constraint, patterns = self._matcher.constraints[constraint_index]
-            remaining_patterns = self._patterns - patterns
+            remaining_patterns = self._patterns & ~patterns
             remaining_transitions = [t for t in transitions if t.patterns & remaining_patterns]
             checked_patterns = self._patterns & patterns
             checked_transitions = [t for t in transitions if t.patterns & checked_patterns]
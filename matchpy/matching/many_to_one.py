@@ -31,12 +31,21 @@ some label matched with {x ↦ a, y ↦ b}
 Also contains the :class:`ManyToOneReplacer` which can replace a set :class:`ReplacementRule` at one using a
 :class:`ManyToOneMatcher` for finding the matches.
 """
+import copyreg
+import gc
+import io
 import math
 import html
+import multiprocessing
+import pickle
+import sys
+import time
 import itertools
 from collections import deque
 from operator import itemgetter
-from typing import Container, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple, Type, Union
+from typing import (
+    Any, Callable, Container, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple, Type, Union
+)
 
 try:
     from graphviz import Digraph, Graph
@@ -46,20 +55,24 @@ except ImportError:
 from multiset import Multiset
 
 from ..expressions.expressions import (
-    Expression, Operation, Symbol, SymbolWildcard, Wildcard, Pattern, AssociativeOperation, CommutativeOperation, OneIdentityOperation
+    Expression, Operation, Symbol, SymbolWildcard, Wildcard, Pattern, AssociativeOperation, CommutativeOperation,
+    OneIdentityOperation, _OperationMeta
 )
 from ..expressions.substitution import Substitution
 from ..expressions.functions import (
     is_anonymous, contains_variables_from_set, create_operation_expression, preorder_iter_with_position,
-    rename_variables, op_iter, preorder_iter, op_len
+    rename_variables, op_iter, preorder_iter, op_len, get_variables, _ExpressionKey, _is_identical
+)
+from ..utils import (
+    VariableWithCount, commutative_sequence_variable_partition_iter, commutative_sequence_variable_partition_count,
+    LRUCache, Budget, BudgetExceeded
 )
-from ..utils import (VariableWithCount, commutative_sequence_variable_partition_iter)
 from .. import functions
 from .bipartite import BipartiteGraph, enum_maximum_matchings_iter, LEFT
 from .syntactic import OPERATION_END, is_operation
-from ._common import check_one_identity
+from ._common import check_one_identity, can_count_variables, get_dependent_variables, MULTIPLICITY
 
-__all__ = ['ManyToOneMatcher', 'ManyToOneReplacer']
+__all__ = ['ManyToOneMatcher', 'ManyToOneReplacer', 'SubjectMatches']
 
 LabelType = Union[Expression, Type[Operation]]
 HeadType = Optional[Union[Expression, Type[Operation], Type[Symbol]]]
@@ -78,7 +91,7 @@ _Transition = NamedTuple('_Transition', [
     ('label', LabelType),
     ('target', _State),
     ('variable_name', Optional[str]),
-    ('patterns', Set[int]),
+    ('patterns', int),
     ('check_constraints', Optional[Set[int]]),
     ('subst', Substitution),
 ])  # yapf: disable
@@ -86,19 +99,118 @@ _Transition = NamedTuple('_Transition', [
 
 _VISITED = set()
 
+
+def _iter_bits(mask: int) -> Iterator[int]:
+    """Yield the indices of the bits set in the given mask in ascending order.
+
+    Pattern and constraint sets are represented as integer bitmasks where bit *i* is set iff the pattern/constraint
+    with index *i* is contained in the set:
+
+    >>> list(_iter_bits(0b10110))
+    [1, 2, 4]
+    """
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+
+def _preorder_iter_from(expression: Expression,
+                        position: Tuple[int, ...]) -> Iterator[Tuple[Expression, Tuple[int, ...]]]:
+    """Iterate over the expression in preorder, starting at the given position.
+
+    Of the subexpressions that come before the position in preorder, only its ancestors are yielded. The position
+    itself does not have to exist anymore, e.g. when the last operand has been removed.
+
+    >>> [str(e) for e, _ in _preorder_iter_from(f(a, f(b), f(c)), (1, 0))]
+    ['f(a, f(b), f(c))', 'f(b)', 'b', 'f(c)', 'c']
+    """
+    parents = []
+    subexpression = expression
+    for depth, index in enumerate(position):
+        yield subexpression, position[:depth]
+        operands = list(op_iter(subexpression))
+        parents.append(operands)
+        if depth + 1 < len(position):
+            subexpression = operands[index]
+    start = 0
+    for depth in reversed(range(len(position))):
+        operands = parents[depth]
+        for i in range(position[depth] + start, len(operands)):
+            for child, child_position in preorder_iter_with_position(operands[i]):
+                yield child, position[:depth] + (i, ) + child_position
+        start = 1
+    if not position:
+        yield from preorder_iter_with_position(expression)
+
+
+def _sizeof_matches(matches: List[Tuple[Any, Substitution]]) -> int:
+    """Estimate the memory used by a list of cached matches, not counting the expressions it refers to."""
+    return sys.getsizeof(matches) + sum(sys.getsizeof(match) + sys.getsizeof(match[1]) for match in matches)
+
+
+class _UnfinishedPatternFilter:
+    """Contains the indices of the commutative patterns that can still lead to a pattern which has not matched yet.
+
+    The matches of a commutative operation are only enumerated for the patterns in the filter, so when searching
+    for the first match of each pattern, the enumeration stops once all reachable patterns have matched.
+    """
+    __slots__ = ('match_iter', 'transitions')
+
+    def __init__(self, match_iter: '_MatchIter', transitions: Dict[int, List[_Transition]]) -> None:
+        self.match_iter = match_iter
+        self.transitions = transitions
+
+    def __contains__(self, index: int) -> bool:
+        transition_set = self.transitions.get(index)
+        if transition_set is None:
+            return False
+        patterns = self.match_iter.patterns
+        return any(patterns & transition.patterns for transition in transition_set)
+
+
 class _MatchIter:
-    def __init__(self, matcher, subject, intial_associative=None):
+    def __init__(self, matcher, subject, intial_associative=None, budget=None, dependent=None):
         self.matcher = matcher
+        self.budget = budget
+        # Only set when counting matches, see get_dependent_variables()
+        self.dependent = dependent
         self.subjects = deque([subject]) if subject is not None else deque()
-        self.patterns = set(range(len(matcher.patterns)))
+        self.patterns = ((1 << len(matcher.patterns)) - 1) & ~matcher.removed_patterns
         self.substitution = Substitution()
-        self.constraints = set(range(len(matcher.constraints)))
+        self.constraints = (1 << len(matcher.constraints)) - 1
         self.associative = [intial_associative]
+        # Only set when searching for the first match of each pattern, see matched_pattern_indices()
+        self.first_matches_only = False
 
     def __iter__(self):
+        cache = self.matcher.match_cache
+        if cache is not None and len(self.subjects) == 1:
+            yield from self._cached_iter(cache, self.subjects[0])
+            return
         for _ in self._match(self.matcher.root):
             yield from self._internal_iter()
 
+    def _cached_iter(self, cache, subject):
+        key = _ExpressionKey(subject)
+        try:
+            matches = cache.get(key)
+        except TypeError:
+            # Subjects that are not hashable cannot be cached
+            cache = matches = None
+        if matches is None:
+            matches = []
+            for _ in self._match(self.matcher.root):
+                for label, substitution in self._internal_iter():
+                    matches.append((label, substitution))
+                    yield label, Substitution(substitution)
+            # Only complete results are cached, i.e. not if the iteration was aborted
+            if cache is not None:
+                cache[key] = matches
+        else:
+            for label, substitution in matches:
+                yield label, Substitution(substitution)
+
     def grouped(self):
         """
         Yield the matches grouped by their final state in the automaton, i.e. structurally identical patterns
@@ -111,32 +223,99 @@ class _MatchIter:
         for _ in self._match(self.matcher.root):
             yield list(self._internal_iter())
 
+    def indexed(self):
+        """
+        Yield the matches with the index of the matched pattern in the matcher's patterns instead of its label.
+
+        Yields:
+            For every match, a tuple of the pattern index and the match substitution.
+        """
+        for _ in self._match(self.matcher.root):
+            yield from self._internal_iter(indexed=True)
+
     def any(self):
         """
         Returns:
             True, if any match is found.
         """
-        try:
-            next(self)
-        except StopIteration:
-            return False
-        return True
+        for _ in self._match(self.matcher.root):
+            for _ in self._valid_pattern_indices():
+                return True
+        return False
+
+    def count(self):
+        """
+        Returns:
+            The number of matches.
+        """
+        count = 0
+        for _ in self._match(self.matcher.root):
+            multiplicity = self.substitution.get(MULTIPLICITY, 1)
+            for _ in self._valid_pattern_indices():
+                count += multiplicity
+        return count
+
+    def matched_pattern_indices(self) -> List[int]:
+        """
+        Find the patterns that match without enumerating all their matches.
+
+        Once a pattern has matched, it is excluded from the remaining search, so the search ends as soon as every
+        pattern has either matched or cannot match anymore.
 
-    def _internal_iter(self):
-        for pattern_index in self.patterns:
-            renaming = self.matcher.pattern_vars[pattern_index]
-            new_substitution = self.substitution.rename({renamed: original for original, renamed in renaming.items()})
-            pattern, label, _ = self.matcher.patterns[pattern_index]
+        Returns:
+            The sorted indices of the matching patterns in the matcher's patterns.
+        """
+        self.first_matches_only = True
+        # The current patterns are narrowed down during the search, so the unmatched patterns are tracked separately
+        unmatched = self.patterns
+        indices = []
+        for _ in self._match(self.matcher.root):
+            for pattern_index in list(self._valid_pattern_indices()):
+                indices.append(pattern_index)
+                self.patterns &= ~(1 << pattern_index)
+                unmatched &= ~(1 << pattern_index)
+            if not unmatched:
+                break
+        indices.sort()
+        return indices
+
+    def _valid_pattern_indices(self):
+        """Yield the indices of the patterns matched by the current substitution that satisfy their global constraints.
+
+        In contrast to :meth:`_internal_iter`, the substitution is only renamed for patterns that have global
+        constraints.
+        """
+        matcher = self.matcher
+        for pattern_index in _iter_bits(self.patterns):
+            global_constraints = matcher.global_constraints[pattern_index]
+            if global_constraints:
+                substitution = self._renamed_substitution(pattern_index)
+                if not all(constraint(substitution) for constraint in global_constraints):
+                    continue
+            yield pattern_index
+
+    def _renamed_substitution(self, pattern_index):
+        reverse_renaming = self.matcher.reverse_pattern_vars[pattern_index]
+        if reverse_renaming is None:
+            return Substitution(self.substitution)
+        return Substitution((reverse_renaming.get(name, name), value) for name, value in self.substitution.items())
+
+    def _internal_iter(self, indexed=False):
+        matcher = self.matcher
+        for pattern_index in _iter_bits(self.patterns):
+            new_substitution = self._renamed_substitution(pattern_index)
             valid = True
-            for constraint in pattern.global_constraints:
+            for constraint in matcher.global_constraints[pattern_index]:
                 if not constraint(new_substitution):
                     valid = False
                     break
             if valid:
-                yield label, new_substitution
+                yield (pattern_index if indexed else matcher.patterns[pattern_index][1]), new_substitution
 
     def _match(self, state: _State) -> Iterator[_State]:
         _VISITED.add(state.number)
+        if self.budget is not None:
+            self.budget.step()
         if len(self.subjects) == 0:
             if state.number in self.matcher.finals or OPERATION_END in state.transitions:
                 yield state
@@ -148,7 +327,7 @@ class _MatchIter:
                 yield from self._match_transition(transition)
 
     def _match_transition(self, transition: _Transition) -> Iterator[_State]:
-        if self.patterns.isdisjoint(transition.patterns):
+        if not self.patterns & transition.patterns:
             return
         label = transition.label
         if label is _EPS:
@@ -176,10 +355,10 @@ class _MatchIter:
         yield from self._check_transition(transition, subject)
 
     def _check_transition(self, transition, subject, restore_subject=True):
-        if self.patterns.isdisjoint(transition.patterns):
+        if not self.patterns & transition.patterns:
             return
-        restore_constraints = set()
-        restore_patterns = self.patterns - transition.patterns
+        restore_constraints = 0
+        restore_patterns = self.patterns & ~transition.patterns
         self.patterns &= transition.patterns
         old_values = {}
         try:
@@ -202,7 +381,9 @@ class _MatchIter:
                     self.substitution.try_add_variable(transition.variable_name, subject)
                 except ValueError:
                     return
-                self._check_constraints(transition.check_constraints, restore_constraints, restore_patterns)
+                restore_constraints, restore_patterns = self._check_constraints(
+                    transition.check_constraints, restore_constraints, restore_patterns
+                )
                 if not self.patterns:
                     return
 
@@ -219,24 +400,26 @@ class _MatchIter:
                 else:
                     self.substitution[k] = v
 
-    def _check_constraints(self, variable: str, restore_constraints, restore_patterns) -> bool:
+    def _check_constraints(self, variable: str, restore_constraints: int, restore_patterns: int) -> Tuple[int, int]:
         if isinstance(variable, str):
             check_constraints = self.matcher.constraint_vars.get(variable, [])
         else:
             check_constraints = variable
         variables = set(self.substitution.keys())
         for constraint_index in check_constraints:
-            if constraint_index not in self.constraints:
+            constraint_bit = 1 << constraint_index
+            if not self.constraints & constraint_bit:
                 continue
             constraint, patterns = self.matcher.constraints[constraint_index]
-            if constraint.variables <= variables and not self.patterns.isdisjoint(patterns):
-                self.constraints.remove(constraint_index)
-                restore_constraints.add(constraint_index)
+            if constraint.variables <= variables and self.patterns & patterns:
+                self.constraints ^= constraint_bit
+                restore_constraints |= constraint_bit
                 if not constraint(self.substitution):
                     restore_patterns |= self.patterns & patterns
-                    self.patterns -= patterns
+                    self.patterns &= ~patterns
                     if not self.patterns:
                         break
+        return restore_constraints, restore_patterns
 
     @staticmethod
     def _get_heads(expression: Expression) -> Iterator[HeadType]:
@@ -276,20 +459,28 @@ class _MatchIter:
         subject = self.subjects.popleft()
         matcher = state.matcher
         substitution = self.substitution
-        matcher.add_subject(None)
+        matcher.add_subject(None, self.budget)
         for operand in op_iter(subject):
-            matcher.add_subject(operand)
-        for matched_pattern, new_substitution in matcher.match(subject, substitution):
-            restore_constraints = set()
+            matcher.add_subject(operand, self.budget)
+        pattern_filter = state.transitions
+        if self.first_matches_only:
+            pattern_filter = _UnfinishedPatternFilter(self, pattern_filter)
+        matches = matcher.match(subject, substitution, pattern_filter, self.budget, self.dependent)
+        for matched_pattern, new_substitution in matches:
+            restore_constraints = 0
             diff = set(new_substitution.keys()) - set(substitution.keys())
+            diff.discard(MULTIPLICITY)
             self.substitution = new_substitution
             transition_set = state.transitions[matched_pattern]
-            t_iter = iter(t.patterns for t in transition_set)
-            potential_patterns = next(t_iter).union(*t_iter)
-            restore_patterns = self.patterns - potential_patterns
+            potential_patterns = 0
+            for transition in transition_set:
+                potential_patterns |= transition.patterns
+            restore_patterns = self.patterns & ~potential_patterns
             self.patterns &= potential_patterns
             for variable in diff:
-                self._check_constraints(variable, restore_constraints, restore_patterns)
+                restore_constraints, restore_patterns = self._check_constraints(
+                    variable, restore_constraints, restore_patterns
+                )
                 if not self.patterns:
                     break
             if self.patterns:
@@ -320,23 +511,51 @@ class _MatchIter:
 
 
 class ManyToOneMatcher:
-    __slots__ = ('patterns', 'states', 'root', 'pattern_vars', 'constraints', 'constraint_vars', 'finals', 'rename')
+    __slots__ = (
+        'patterns', 'states', 'root', 'pattern_vars', 'reverse_pattern_vars', 'global_constraints', 'constraints',
+        'constraint_vars', 'finals', 'rename', 'removed_patterns', 'owned_states', 'commutative_matchers',
+        '_dependent_variables', 'match_cache'
+    )
 
     _state_id = 0
 
-    def __init__(self, *patterns: Expression, rename=True) -> None:
+    def __init__(self, *patterns: Expression, rename=True, cache_size: int=0,
+                 cache_memory: Optional[int]=None) -> None:
         """
+        The matches of recently matched subjects can optionally be cached. Then, matching the same subject again only
+        copies the cached substitutions. The cache is invalidated whenever the matcher's patterns change. Its hit and
+        miss statistics are available from ``matcher.match_cache.cache_info()``:
+
+        >>> matcher = ManyToOneMatcher(Pattern(f(a, x_)), cache_size=100)
+        >>> for _ in range(3):
+        ...     matches = list(matcher.match(f(a, b)))
+        >>> matcher.match_cache.cache_info()
+        CacheInfo(hits=2, misses=1, maxsize=100, currsize=1)
+
         Args:
             *patterns: The patterns which the matcher should match.
+            cache_size:
+                The maximum number of subjects whose matches are cached. By default, nothing is cached.
+            cache_memory:
+                The maximum total size of the cached matches in bytes. It is estimated from the sizes of the
+                containers holding the matches, excluding the subjects and the values of the substitutions that are
+                shared with them. If None, only the number of cached subjects is bounded.
         """
         self.patterns = []
-        self.states = []
+        self.states = {}
+        self.owned_states = None
+        self.commutative_matchers = {}
         self.root = self._create_state()
         self.pattern_vars = []
+        self.reverse_pattern_vars = []
+        self.global_constraints = []
         self.constraints = []
         self.constraint_vars = {}
         self.finals = set()
         self.rename = rename
+        self._dependent_variables = None
+        self.removed_patterns = 0
+        self.match_cache = LRUCache(cache_size, cache_memory, _sizeof_matches) if cache_size > 0 else None
 
         for pattern in patterns:
             self.add(pattern)
@@ -350,6 +569,7 @@ class ManyToOneMatcher:
 
         Equivalent patterns with the same label are not added again. However, patterns that are structurally equivalent,
         but have different constraints or different variable names are distinguished by the matcher.
+        Adding a previously :meth:`removed <remove>` pattern again re-enables it.
 
         Args:
             pattern:
@@ -359,9 +579,11 @@ class ManyToOneMatcher:
         """
         if label is None:
             label = pattern
+        self._invalidate_match_cache()
         for i, (p, l, _) in enumerate(self.patterns):
             if pattern == p and label == l:
-                return i
+                self.removed_patterns &= ~(1 << i)
+                return
         # TODO: Avoid renaming in the pattern, use variable indices instead
         renaming = self._collect_variable_renaming(pattern.expression) if self.rename else {}
         self._internal_add(pattern, label, renaming)
@@ -383,8 +605,11 @@ class ManyToOneMatcher:
         constraint_indices = [self._add_constraint(c, pattern_index) for c in renamed_constraints]
         self.patterns.append((pattern, label, constraint_indices))
         self.pattern_vars.append(renaming)
+        reverse_renaming = {renamed: original for original, renamed in renaming.items() if renamed != original}
+        self.reverse_pattern_vars.append(reverse_renaming or None)
+        self.global_constraints.append(tuple(pattern.global_constraints))
         pattern = rename_variables(pattern.expression, renaming)
-        state = self.root
+        state = self._owned_root()
         patterns_stack = [deque([pattern])]
 
         self._process_pattern_stack(state, patterns_stack, renamed_constraints, pattern_index)
@@ -417,34 +642,401 @@ class ManyToOneMatcher:
         self.finals.add(state.number)
 
 
+    def remove(self, pattern: Pattern, label=None) -> None:
+        """Remove a pattern from the matcher.
+
+        The pattern is only disabled, the automaton itself is left unchanged. Hence, removing a pattern is cheap and
+        does not modify any states that are shared with a :meth:`snapshot` of the matcher.
+
+        >>> matcher = ManyToOneMatcher(Pattern(f(a, x_)), Pattern(f(y_, b)))
+        >>> matcher.remove(Pattern(f(y_, b)))
+        >>> [str(pattern) for pattern, _ in matcher.match(f(a, b))]
+        ['f(a, x_)']
+
+        Args:
+            pattern:
+                The pattern to remove.
+            label:
+                The label the pattern was added with. Defaults to the pattern itself.
+
+        Raises:
+            ValueError:
+                If the pattern with the given label is not contained in the matcher.
+        """
+        if label is None:
+            label = pattern
+        for i, (p, l, _) in enumerate(self.patterns):
+            if not self.removed_patterns >> i & 1 and pattern == p and label == l:
+                self.removed_patterns |= 1 << i
+                self._invalidate_match_cache()
+                return
+        raise ValueError("The pattern {!s} with label {!r} is not contained in the matcher.".format(pattern, label))
+
+    def snapshot(self) -> 'ManyToOneMatcher':
+        """Create a new version of the matcher.
+
+        The new version shares all its states with this matcher. Both matchers can be modified independently
+        afterwards: Adding a pattern to either of them copies only the states on the path of the new pattern
+        (copy-on-write) and removing a pattern only disables it. Ongoing matches using one version are therefore not
+        affected by modifications of the other version. This allows cheap reloads of large pattern sets:
+
+        >>> matcher = ManyToOneMatcher(Pattern(f(a, x_)))
+        >>> new_matcher = matcher.snapshot()
+        >>> new_matcher.add(Pattern(f(y_, b)))
+        >>> len(list(matcher.match(f(a, b)))), len(list(new_matcher.match(f(a, b))))
+        (1, 2)
+
+        Returns:
+            The new version of the matcher.
+        """
+        new_matcher = object.__new__(type(self))
+        new_matcher.patterns = list(self.patterns)
+        new_matcher.states = dict(self.states)
+        new_matcher.root = self.root
+        new_matcher.pattern_vars = list(self.pattern_vars)
+        new_matcher.reverse_pattern_vars = list(self.reverse_pattern_vars)
+        new_matcher.global_constraints = list(self.global_constraints)
+        new_matcher.constraints = list(self.constraints)
+        new_matcher.constraint_vars = {var: set(indices) for var, indices in self.constraint_vars.items()}
+        new_matcher.finals = set(self.finals)
+        new_matcher.rename = self.rename
+        new_matcher.removed_patterns = self.removed_patterns
+        new_matcher._dependent_variables = self._dependent_variables
+        cache = self.match_cache
+        new_matcher.match_cache = None if cache is None else LRUCache(cache.maxsize, cache.maxmemory, cache.sizeof)
+        new_matcher.commutative_matchers = {op: m.snapshot() for op, m in self.commutative_matchers.items()}
+        self.commutative_matchers = {op: m.snapshot() for op, m in self.commutative_matchers.items()}
+        # From now on, neither version owns the shared states and has to copy them before modifying them.
+        new_matcher.owned_states = set()
+        self.owned_states = set()
+        return new_matcher
+
+    def clear_subject_caches(self) -> None:
+        """Clear the operands of previous subjects that the commutative matchers keep.
+
+        When matching commutative operations, the operands of the subject are matched against the subpatterns once and
+        the results are kept for subsequent subjects with the same operands. For long running matchers with ever new
+        subjects, the caches should be cleared from time to time to bound their memory usage. This must not be done
+        while a match is in progress.
+        """
+        matchers = {id(m): m for m in self.commutative_matchers.values()}
+        for state in self.states.values():
+            if state.matcher is not None:
+                matchers[id(state.matcher)] = state.matcher
+        for matcher in matchers.values():
+            matcher._clear_subjects()
+            matcher.automaton.clear_subject_caches()
+
+    def _invalidate_match_cache(self) -> None:
+        if self.match_cache is not None:
+            self.match_cache.clear(statistics=False)
+
+    def _owned_root(self) -> _State:
+        if self.owned_states is not None and self.root.number not in self.owned_states:
+            self.root = self._copy_state(self.root, None)
+        return self.root
+
+    def _owned_target(self, transitions: List[_Transition], index: int) -> _State:
+        """Return the target of the transition, copying it first if it is shared with another version.
+
+        The transitions must belong to a state owned by this matcher.
+        """
+        transition = transitions[index]
+        target = transition.target
+        if self.owned_states is None or target.number in self.owned_states:
+            return target
+        target = self._copy_state(target, transition.label)
+        transitions[index] = transition._replace(target=target)
+        return target
+
+    def _copy_state(self, state: _State, label: LabelType) -> _State:
+        # All commutative matchers for the same operation stem from the same original matcher, so the pattern ids
+        # used as transition labels stay valid when switching to this version's matcher.
+        matcher = self._get_commutative_matcher(label) if state.matcher is not None else None
+        new_state = self._create_state(matcher)
+        for head, transitions in state.transitions.items():
+            new_state.transitions[head] = list(transitions)
+        if state.number in self.finals:
+            self.finals.add(new_state.number)
+        del self.states[state.number]
+        return new_state
+
     def _add_constraint(self, constraint, pattern):
         index = None
         for i, (c, patterns) in enumerate(self.constraints):
             if c == constraint:
-                patterns.add(pattern)
+                self.constraints[i] = (c, patterns | 1 << pattern)
                 index = i
                 break
         else:
             index = len(self.constraints)
-            self.constraints.append((constraint, set([pattern])))
+            self.constraints.append((constraint, 1 << pattern))
         for var in constraint.variables:
             self.constraint_vars.setdefault(var, set()).add(index)
         return index
 
-    def match(self, subject: Expression) -> Iterator[Tuple[Expression, Substitution]]:
+    def merge(self, other: 'ManyToOneMatcher') -> None:
+        """Merge the patterns of another matcher into this matcher.
+
+        Instead of adding the other matcher's patterns one by one, the automata are merged structurally: States that
+        are reached by equivalent transitions in both matchers are combined and the remaining parts of the other
+        automaton are copied over. This includes the automata of the commutative sub-matchers.
+
+        >>> matcher1 = ManyToOneMatcher(Pattern(f(a, x_)))
+        >>> matcher2 = ManyToOneMatcher(Pattern(f(y_, b)))
+        >>> matcher1.merge(matcher2)
+        >>> for matched_pattern, substitution in sorted(map(lambda m: (str(m[0]), str(m[1])), matcher1.match(f(a, b)))):
+        ...     print('{} matched with {}'.format(matched_pattern, substitution))
+        f(a, x_) matched with {x ↦ b}
+        f(y_, b) matched with {y ↦ a}
+
+        The patterns of the other matcher are added after this matcher's patterns. Patterns that are already contained
+        in this matcher with the same label are not added again. The other matcher is not modified.
+
+        Args:
+            other:
+                The matcher whose patterns are merged into this matcher.
+        """
+        self._merge(other)
+
+    @classmethod
+    def union(cls, *matchers: 'ManyToOneMatcher') -> 'ManyToOneMatcher':
+        """Create a new matcher that contains the patterns of all the given matchers.
+
+        The automata of the matchers are merged structurally (see :meth:`merge`), the given matchers are not modified.
+
+        Args:
+            *matchers:
+                The matchers to combine.
+
+        Returns:
+            The combined matcher.
+        """
+        new_matcher = cls(rename=all(matcher.rename for matcher in matchers))
+        for matcher in matchers:
+            new_matcher.merge(matcher)
+        return new_matcher
+
+    def _merge(self, other: 'ManyToOneMatcher') -> List[int]:
+        """Merge the other matcher into this one.
+
+        Returns:
+            A list that maps the other matcher's pattern indices to the pattern indices in this matcher.
+        """
+        self._invalidate_match_cache()
+        existing_patterns = {}
+        for i, (pattern, _, _) in enumerate(self.patterns):
+            existing_patterns.setdefault(self._pattern_hash(pattern), []).append(i)
+        pattern_mapping = []
+        new_patterns = []
+        next_index = len(self.patterns)
+        for i, (pattern, label, _) in enumerate(other.patterns):
+            if other.removed_patterns >> i & 1:
+                pattern_mapping.append(None)
+                continue
+            for j in existing_patterns.get(self._pattern_hash(pattern), ()):
+                existing_pattern, existing_label, _ = self.patterns[j]
+                if pattern == existing_pattern and label == existing_label:
+                    self.removed_patterns &= ~(1 << j)
+                    pattern_mapping.append(j)
+                    break
+            else:
+                pattern_mapping.append(next_index)
+                new_patterns.append(i)
+                next_index += 1
+
+        # Patterns already contained in this matcher are dropped from the other automaton.
+        offset = len(self.patterns)
+        if len(new_patterns) == len(other.patterns):
+            remap = lambda mask: mask << offset
+        else:
+            new_mask = 0
+            for i in new_patterns:
+                new_mask |= 1 << i
+
+            def remap(mask):
+                result = 0
+                for index in _iter_bits(mask & new_mask):
+                    result |= 1 << pattern_mapping[index]
+                return result
+
+        existing_constraints = {constraint: i for i, (constraint, _) in enumerate(self.constraints)}
+        constraint_mapping = []
+        for constraint, patterns in other.constraints:
+            patterns = remap(patterns)
+            if not patterns:
+                # The constraint only belongs to patterns that are already contained in this matcher.
+                constraint_mapping.append(None)
+                continue
+            index = existing_constraints.get(constraint)
+            if index is not None:
+                existing_constraint, existing_patterns = self.constraints[index]
+                self.constraints[index] = (existing_constraint, existing_patterns | patterns)
+            else:
+                index = existing_constraints[constraint] = len(self.constraints)
+                self.constraints.append((constraint, patterns))
+            for var in constraint.variables:
+                self.constraint_vars.setdefault(var, set()).add(index)
+            constraint_mapping.append(index)
+
+        for i in new_patterns:
+            pattern, label, constraint_indices = other.patterns[i]
+            self.patterns.append((pattern, label, [constraint_mapping[c] for c in constraint_indices]))
+            self.pattern_vars.append(other.pattern_vars[i])
+            self.reverse_pattern_vars.append(other.reverse_pattern_vars[i])
+            self.global_constraints.append(other.global_constraints[i])
+
+        commutative_mappings = {}
+        state_stack = [(self._owned_root(), other.root)]
+        while state_stack:
+            state, other_state = state_stack.pop()
+            if other_state.number in other.finals:
+                self.finals.add(state.number)
+            label_mapping = None
+            if other_state.matcher is not None:
+                # The other matcher's commutative matchers are shared between states, so each is only merged once.
+                label_mapping = commutative_mappings.get(id(other_state.matcher))
+                if label_mapping is None:
+                    label_mapping = commutative_mappings[id(other_state.matcher)] = state.matcher._merge(
+                        other_state.matcher
+                    )
+            for head, other_transitions in other_state.transitions.items():
+                if label_mapping is not None:
+                    head = label_mapping[head]
+                transitions = state.transitions.setdefault(head, [])
+                for other_transition in other_transitions:
+                    patterns = remap(other_transition.patterns)
+                    if not patterns:
+                        continue
+                    label = other_transition.label if label_mapping is None else head
+                    check_constraints = other_transition.check_constraints
+                    if check_constraints is not None:
+                        check_constraints = set(
+                            constraint_mapping[c] for c in check_constraints if constraint_mapping[c] is not None
+                        )
+                    for i, transition in enumerate(transitions):
+                        if (transition.variable_name == other_transition.variable_name and transition.label == label and
+                                transition.subst == other_transition.subst):
+                            if check_constraints is not None:
+                                check_constraints = transition.check_constraints | check_constraints
+                            transitions[i] = transition._replace(
+                                patterns=transition.patterns | patterns, check_constraints=check_constraints
+                            )
+                            target = self._owned_target(transitions, i)
+                            break
+                    else:
+                        matcher = None
+                        if other_transition.target.matcher is not None:
+                            matcher = self._get_commutative_matcher(label)
+                        target = self._create_state(matcher)
+                        transitions.append(
+                            _Transition(
+                                label, target, other_transition.variable_name, patterns, check_constraints,
+                                other_transition.subst
+                            )
+                        )
+                    state_stack.append((target, other_transition.target))
+                if not transitions:
+                    del state.transitions[head]
+
+        return pattern_mapping
+
+    @staticmethod
+    def _pattern_hash(pattern: Pattern) -> Optional[int]:
+        try:
+            return hash(pattern.expression)
+        except TypeError:
+            return None
+
+    def match(self, subject: Expression, budget: Optional[Budget]=None) -> Iterator[Tuple[Expression, Substitution]]:
         """Match the subject against all the matcher's patterns.
 
         Args:
             subject: The subject to match.
+            budget: An optional :class:`.Budget` that limits the time and steps spent on the matching.
 
         Yields:
             For every match, a tuple of the matching pattern and the match substitution.
+
+        Raises:
+            BudgetExceeded:
+                If the *budget* is exhausted. The matches yielded before remain valid.
         """
-        return _MatchIter(self, subject)
+        return _MatchIter(self, subject, budget=budget)
+
+    def count(self, subject: Expression, budget: Optional[Budget]=None) -> int:
+        """Count the matches of the subject for all the matcher's patterns.
+
+        The result is the same as ``len(list(matcher.match(subject)))``, but as in :func:`.count_matches`, the
+        sequence variables of commutative operations are not bound if their values do not matter for any pattern.
+        Instead, the number of ways to distribute the operands among them is computed combinatorially:
+
+        >>> f_c = Operation.new('f_c', Arity.variadic, commutative=True)
+        >>> matcher = ManyToOneMatcher(Pattern(f_c(Wildcard.plus('x'), Wildcard.plus('y'))), Pattern(f_c(x_, y_)))
+        >>> matcher.count(f_c(*(Symbol(str(i)) for i in range(40))))
+        1099511627774
+
+        Because the variables of all patterns are renamed by their position, a variable is bound whenever its value
+        matters for any pattern that has a variable at the same position.
+
+        Args:
+            subject: The subject to match.
+            budget: An optional :class:`.Budget` that limits the time and steps spent on the matching.
+
+        Returns:
+            The number of matches.
+
+        Raises:
+            BudgetExceeded:
+                If the *budget* is exhausted.
+        """
+        matches = self._get_cached_matches(subject)
+        if matches is not None:
+            return len(matches)
+        return _MatchIter(self, subject, budget=budget, dependent=self._get_dependent_variables()).count()
+
+    def match_anywhere(self, subject: Expression, budget: Optional[Budget]=None) -> 'SubjectMatches':
+        """Match every subexpression of the subject against all the matcher's patterns.
+
+        After the subject is edited with :func:`.replace` or :func:`.replace_many`, the matches can be updated with
+        :meth:`SubjectMatches.update` instead of matching the whole subject again.
+
+        Args:
+            subject: The subject to match.
+            budget: An optional :class:`.Budget` that limits the time and steps spent on the matching.
+
+        Returns:
+            The matches at all positions of the subject.
+
+        Raises:
+            BudgetExceeded:
+                If the *budget* is exhausted.
+        """
+        return SubjectMatches(self, subject, budget)
+
+    def _get_dependent_variables(self) -> Set[str]:
+        """Return the (renamed) variables whose values matter for any of the patterns, see :meth:`count`."""
+        # Patterns are only appended or disabled, so the number of patterns and the removed ones identify the set
+        key = (len(self.patterns), self.removed_patterns)
+        if self._dependent_variables is None or self._dependent_variables[0] != key:
+            dependent = set()
+            for pattern_index, (pattern, _, _) in enumerate(self.patterns):
+                if self.removed_patterns >> pattern_index & 1:
+                    continue
+                if pattern.global_constraints:
+                    pattern_dependent = get_variables(pattern.expression)
+                else:
+                    pattern_dependent = get_dependent_variables(pattern.expression, pattern.local_constraints)
+                renaming = self.pattern_vars[pattern_index]
+                dependent.update(renaming.get(name, name) for name in pattern_dependent)
+            self._dependent_variables = (key, dependent)
+        return self._dependent_variables[1]
 
     def is_match(self, subject: Expression) -> bool:
         """Check if the subject matches any of the matcher's patterns.
 
+        The matching stops at the first match and no substitution is built for it.
+
         Args:
             subject: The subject to match.
 
@@ -452,8 +1044,21 @@ class ManyToOneMatcher:
             True, if the subject is matched by any of the matcher's patterns.
             False, otherwise.
         """
+        matches = self._get_cached_matches(subject)
+        if matches is not None:
+            return bool(matches)
         return _MatchIter(self, subject).any()
 
+    def _get_cached_matches(self, subject: Expression) -> Optional[List[Tuple[Any, Substitution]]]:
+        """Return the cached matches of the subject, if there are any, without counting a cache miss otherwise."""
+        key = _ExpressionKey(subject)
+        try:
+            if self.match_cache is not None and key in self.match_cache:
+                return self.match_cache.get(key)
+        except TypeError:
+            pass
+        return None
+
     def _create_expression_transition(
             self, state: _State, expression: Expression, variable_name: Optional[str], index: int, subst=None
     ) -> _State:
@@ -461,43 +1066,58 @@ class ManyToOneMatcher:
         transitions = state.transitions.setdefault(head, [])
         commutative = isinstance(expression, CommutativeOperation)
         matcher = None
-        for transition in transitions:
+        for i, transition in enumerate(transitions):
             if transition.variable_name == variable_name and transition.label == label and transition.subst == subst:
-                transition.patterns.add(index)
+                transition = transition._replace(patterns=transition.patterns | 1 << index)
                 if variable_name is not None:
                     constraints = set(
                         self.constraint_vars[variable_name] if variable_name in self.constraint_vars else []
                     )
                     for c in list(constraints):
                         patterns = self.constraints[c][1]
-                        if patterns.isdisjoint(transition.patterns):
+                        if not patterns & transition.patterns:
                             constraints.discard(c)
-                    transition.check_constraints.update(constraints)
-                state = transition.target
+                    # The constraint set might be shared with a snapshot, so it must not be modified in place
+                    transition = transition._replace(check_constraints=transition.check_constraints | constraints)
+                transitions[i] = transition
+                state = self._owned_target(transitions, i)
                 break
         else:
             if commutative:
-                matcher = CommutativeMatcher(type(expression) if isinstance(expression, AssociativeOperation) else None)
+                matcher = self._get_commutative_matcher(type(expression))
             state = self._create_state(matcher)
             if variable_name is not None:
                 constraints = set(self.constraint_vars[variable_name] if variable_name in self.constraint_vars else [])
                 for c in list(constraints):
                     patterns = self.constraints[c][1]
-                    if index not in patterns:
+                    if not patterns >> index & 1:
                         constraints.discard(c)
             else:
                 constraints = None
-            transition = _Transition(label, state, variable_name, {index}, constraints, subst)
+            transition = _Transition(label, state, variable_name, 1 << index, constraints, subst)
             transitions.append(transition)
         return state
 
+    def _get_commutative_matcher(self, operation: Type[CommutativeOperation]) -> 'CommutativeMatcher':
+        """Return the commutative matcher for the given operation.
+
+        All states for the same commutative operation share a single commutative matcher, so that the operands of a
+        subject are only matched once per operation instead of once per state. The transitions of each state only
+        cover the ids of its own subpatterns in the shared matcher.
+        """
+        matcher = self.commutative_matchers.get(operation)
+        if matcher is None:
+            associative = operation if issubclass(operation, AssociativeOperation) else None
+            matcher = self.commutative_matchers[operation] = CommutativeMatcher(associative)
+        return matcher
+
     def _create_simple_transition(self, state: _State, label: LabelType, index: int, variable_name=None) -> _State:
         if label in state.transitions:
-            transition = state.transitions[label][0]
-            transition.patterns.add(index)
-            return transition.target
+            transitions = state.transitions[label]
+            transitions[0] = transitions[0]._replace(patterns=transitions[0].patterns | 1 << index)
+            return self._owned_target(transitions, 0)
         new_state = self._create_state()
-        transition = _Transition(label, new_state, variable_name, {index}, None, None)
+        transition = _Transition(label, new_state, variable_name, 1 << index, None, None)
         state.transitions[label] = [transition]
         return new_state
 
@@ -524,7 +1144,9 @@ class ManyToOneMatcher:
 
     def _create_state(self, matcher: 'CommutativeMatcher'=None) -> _State:
         state = _State(ManyToOneMatcher._state_id, dict(), matcher)
-        self.states.append(state)
+        self.states[state.number] = state
+        if self.owned_states is not None:
+            self.owned_states.add(state.number)
         ManyToOneMatcher._state_id += 1
         return state
 
@@ -635,7 +1257,7 @@ class ManyToOneMatcher:
 
     @classmethod
     def _format_pattern_set(cls, patterns):  # pragma: no cover
-        return '{{{}}}'.format(', '.join(map(cls._colored_pattern, patterns)))
+        return '{{{}}}'.format(', '.join(map(cls._colored_pattern, _iter_bits(patterns))))
 
     @classmethod
     def _format_constraint_set(cls, constraints):  # pragma: no cover
@@ -667,11 +1289,12 @@ class ManyToOneMatcher:
 
     def _make_graph_nodes(self, graph: Digraph, finals: Optional[List[str]]) -> None:  # pragma: no cover
         state_patterns = {}
-        for state in self.states:
-            state_patterns.setdefault(state.number, set())
+        for state in self.states.values():
+            state_patterns.setdefault(state.number, 0)
             for transition in itertools.chain.from_iterable(state.transitions.values()):
-                state_patterns.setdefault(transition.target.number, set()).update(transition.patterns)
-        for state in self.states:
+                target_number = transition.target.number
+                state_patterns[target_number] = state_patterns.get(target_number, 0) | transition.patterns
+        for state in self.states.values():
             name = 'n{!s}'.format(state.number)
             if state.matcher:
                 has_states = len(state.matcher.automaton.states) > 1
@@ -709,7 +1332,7 @@ class ManyToOneMatcher:
                         '{}: {}'.format(
                             self._colored_pattern(i),
                             ', '.join('{} -&gt; {}'.format(self._colored_variable(o), n) for n, o in r.items())
-                        ) for i, r in enumerate(self.pattern_vars) if i in sp
+                        ) for i, r in enumerate(self.pattern_vars) if sp >> i & 1
                     ]
                     graph.node(
                         name + '-out', '<<b>Pattern Variables:</b><br/>\n{}>'.format('<br/>\n'.join(variables)),
@@ -718,7 +1341,7 @@ class ManyToOneMatcher:
                     graph.edge(name, name + '-out')
 
     def _make_graph_edges(self, graph: Digraph) -> None:  # pragma: no cover
-        for state in self.states:
+        for state in self.states.values():
             for _, transitions in state.transitions.items():
                 for transition in transitions:
                     t_label = '<'
@@ -741,10 +1364,233 @@ class ManyToOneMatcher:
                     graph.edge(start, end, t_label)
 
 
+class _MatchNode:
+    __slots__ = ('expression', 'matches', 'children')
+
+    def __init__(self, expression: Expression, matches: List[Tuple[Any, Substitution]],
+                 children: Tuple['_MatchNode', ...]) -> None:
+        self.expression = expression
+        self.matches = matches
+        self.children = children
+
+
+class SubjectMatches:
+    """The matches of a :class:`ManyToOneMatcher`'s patterns at every position of a subject.
+
+    The matches are stored per subexpression. Since the matches of a subexpression do not depend on where it occurs,
+    they can be reused after the subject has been edited locally. The functions :func:`.replace` and
+    :func:`.replace_many` only create new expressions along the paths to the edited positions and keep all other
+    subexpressions. Hence, :meth:`update` only has to match the new subexpressions:
+
+    >>> matcher = ManyToOneMatcher(Pattern(f(x_)))
+    >>> matches = matcher.match_anywhere(f(f(a), f(b), c))
+    >>> [(str(substitution), position) for _, substitution, position in matches]
+    [('{x ↦ a}', (0,)), ('{x ↦ b}', (1,))]
+    >>> new_subject = replace(matches.subject, (2, ), f(c))
+    >>> new_matches = matches.update(new_subject, [(2, )])
+    >>> [(str(substitution), position) for _, substitution, position in new_matches]
+    [('{x ↦ a}', (0,)), ('{x ↦ b}', (1,)), ('{x ↦ c}', (2,))]
+
+    Attributes:
+        matcher:
+            The matcher whose patterns were matched.
+        subject:
+            The matched subject.
+    """
+
+    __slots__ = ('matcher', 'subject', '_root', '_version')
+
+    def __init__(self, matcher: ManyToOneMatcher, subject: Expression, budget: Optional[Budget]=None) -> None:
+        self.matcher = matcher
+        self.subject = subject
+        self._version = (len(matcher.patterns), matcher.removed_patterns)
+        self._root = self._build(subject, {}, budget)
+
+    def _build(self, expression: Expression, reusable: Dict[int, _MatchNode], budget: Optional[Budget]) -> _MatchNode:
+        node = reusable.get(id(expression))
+        if node is not None and node.expression is expression:
+            return node
+        matches = list(self.matcher.match(expression, budget))
+        if isinstance(expression, Operation):
+            children = tuple(self._build(operand, reusable, budget) for operand in op_iter(expression))
+        else:
+            children = ()
+        return _MatchNode(expression, matches, children)
+
+    def update(self, subject: Expression, edited_positions: Iterable[Sequence[int]],
+               budget: Optional[Budget]=None) -> 'SubjectMatches':
+        """Get the matches for an edited version of the subject.
+
+        Only the subexpressions that contain an edited position or that were inserted by the edit are matched again.
+        The matches of all other subexpressions are reused, even if their position changed because a sequence of
+        expressions was inserted in front of them. If the matcher's patterns changed in the meantime, the whole subject
+        is matched again. This object itself is not modified.
+
+        Args:
+            subject:
+                The edited subject. Subexpressions that were not edited must be the same objects as in the original
+                subject, as is the case for the result of :func:`.replace` and :func:`.replace_many`.
+            edited_positions:
+                The positions that were replaced, relative to the original subject.
+            budget:
+                An optional :class:`.Budget` that limits the time and steps spent on the matching.
+
+        Returns:
+            The matches at all positions of the edited subject.
+
+        Raises:
+            BudgetExceeded:
+                If the *budget* is exhausted.
+        """
+        reusable = {}
+        if self._version == (len(self.matcher.patterns), self.matcher.removed_patterns):
+            # Every subexpression that was not edited is either the whole subject or an operand of one of the edited
+            # positions' ancestors
+            reusable[id(self.subject)] = self._root
+            for position in edited_positions:
+                node = self._root
+                for index in position:
+                    for child in node.children:
+                        reusable[id(child.expression)] = child
+                    if index >= len(node.children):
+                        break
+                    node = node.children[index]
+        new_matches = object.__new__(SubjectMatches)
+        new_matches.matcher = self.matcher
+        new_matches.subject = subject
+        new_matches._version = (len(self.matcher.patterns), self.matcher.removed_patterns)
+        new_matches._root = new_matches._build(subject, reusable, budget)
+        return new_matches
+
+    def at(self, position: Sequence[int]) -> List[Tuple[Any, Substitution]]:
+        """Return the matches of the subexpression at the given position.
+
+        Args:
+            position:
+                The position of the subexpression.
+
+        Returns:
+            A list of tuples of the matching pattern (or its label) and the match substitution.
+
+        Raises:
+            IndexError:
+                If the position is invalid.
+        """
+        node = self._root
+        for index in position:
+            if index >= len(node.children):
+                raise IndexError("Invalid position {!r} for expression {!s}".format(position, self.subject))
+            node = node.children[index]
+        return [(label, Substitution(substitution)) for label, substitution in node.matches]
+
+    def __iter__(self) -> Iterator[Tuple[Any, Substitution, Tuple[int, ...]]]:
+        """Yield all matches in preorder of their positions as tuples of pattern, substitution and position."""
+        stack = [(self._root, ())]
+        while stack:
+            node, position = stack.pop()
+            for label, substitution in node.matches:
+                yield label, Substitution(substitution), position
+            for index in reversed(range(len(node.children))):
+                stack.append((node.children[index], position + (index, )))
+
+    def __len__(self) -> int:
+        count = 0
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            count += len(node.matches)
+            stack.extend(node.children)
+        return count
+
+
+_BatchState = NamedTuple(
+    '_BatchState', [
+        ('replacer', 'ManyToOneReplacer'), ('arguments', Dict[str, object]), ('reset_interval', Optional[int]),
+        ('operation_classes', List[Type[Operation]]), ('class_indices', Dict[Type[Operation], int])
+    ]
+)
+
+# The state of the current batch replacement (see ManyToOneReplacer.replace_batch), which is inherited by the forked
+# worker processes: The replacer, the replacement arguments and the operation classes that existed before the fork.
+_BATCH_STATE = None  # type: Optional[_BatchState]
+# The number of expressions replaced by the current worker process since its caches were last reset
+_BATCH_REPLACED = 0
+
+
+def _all_operation_classes(cls=Operation) -> Iterator[Type[Operation]]:
+    for subclass in cls.__subclasses__():
+        yield subclass
+        yield from _all_operation_classes(subclass)
+
+
+def _get_batch_operation_class(index: int) -> Type[Operation]:
+    return _BATCH_STATE.operation_classes[index]
+
+
+def _reduce_operation_class(cls):
+    # Operation classes are often created dynamically with Operation.new and cannot be pickled by name. Since the
+    # worker processes are forked, they refer to the same classes by their index in the list of operation classes.
+    return _get_batch_operation_class, (_BATCH_STATE.class_indices[cls], )
+
+
+_BATCH_DISPATCH_TABLE = dict(copyreg.dispatch_table)
+_BATCH_DISPATCH_TABLE[_OperationMeta] = _reduce_operation_class
+
+
+def _batch_dumps(obj) -> bytes:
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer, pickle.HIGHEST_PROTOCOL)
+    pickler.dispatch_table = _BATCH_DISPATCH_TABLE
+    pickler.dump(obj)
+    return buffer.getvalue()
+
+
+def _can_fork() -> bool:
+    try:
+        multiprocessing.get_context('fork')
+    except ValueError:
+        return False
+    return True
+
+
+def _replace_batch_chunk(chunk: bytes) -> bytes:
+    global _BATCH_REPLACED  # pylint: disable=global-statement
+    replacer, arguments, reset_interval, _, _ = _BATCH_STATE
+    results = []
+    for expression in pickle.loads(chunk):
+        if reset_interval is not None and _BATCH_REPLACED >= reset_interval:
+            replacer.clear_caches()
+            _BATCH_REPLACED = 0
+        _BATCH_REPLACED += 1
+        try:
+            results.append((True, replacer.replace(expression, **arguments)))
+        except Exception as e:  # pylint: disable=broad-except
+            results.append((False, e))
+    try:
+        return _batch_dumps(results)
+    except Exception:  # pylint: disable=broad-except
+        # Pickle the results individually, so that only the ones that cannot be pickled fail
+        pass
+    safe_results = []
+    for result in results:
+        try:
+            _batch_dumps(result)
+        except Exception as e:  # pylint: disable=broad-except
+            result = (False, RuntimeError('Cannot transfer the result: {!r}'.format(e)))
+        safe_results.append(result)
+    return _batch_dumps(safe_results)
+
+
 class ManyToOneReplacer:
     """Class that contains a set of replacement rules and can apply them efficiently to an expression."""
 
-    def __init__(self, *rules):
+    def __init__(
+            self,
+            *rules,
+            cache_size: int=1024,
+            profiler: 'functions.RuleProfiler'=None,
+            remove_subsumed: bool=False
+    ):
         """
         A replacement rule consists of a *pattern*, that is matched against any subexpression
         of the expression. If a match is found, the *replacement* callback of the rule is called with
@@ -755,11 +1601,42 @@ class ManyToOneReplacer:
         Note that the pattern can therefore not be a single sequence variable/wildcard, because only single expressions
         will be matched.
 
+        The normal forms computed by :meth:`replace_post_order` are cached, so that repeated subexpressions are only
+        rewritten once. The cache is cleared whenever the rules change.
+
+        With *remove_subsumed*, a rule is not added to the automaton if an earlier rule without constraints has the
+        same pattern up to the names of its variables. The earlier rule is always matched first then, so the later
+        rule can never be applied. Rules whose patterns are merely instances of earlier patterns are kept, because the
+        rules are not tried in their order, e.g. specific symbols are tried before wildcards. The removed rules are
+        reported in :attr:`subsumed_rules`:
+
+        >>> replacer = ManyToOneReplacer(
+        ...     ReplacementRule(Pattern(f(x_, a)), lambda x: x),
+        ...     ReplacementRule(Pattern(f(b, a)), lambda: c),
+        ...     ReplacementRule(Pattern(f(y_, a)), lambda y: a),
+        ...     remove_subsumed=True
+        ... )
+        >>> [(str(r.pattern), str(s.pattern)) for r, s in replacer.subsumed_rules]
+        [('f(y_, a)', 'f(x_, a)')]
+        >>> print(replacer.replace(f(b, a)))
+        c
+
         Args:
             *rules:
                 The replacement rules.
+            cache_size:
+                The maximum number of normal forms to cache. Use zero to disable the cache.
+            profiler:
+                An optional :class:`.RuleProfiler` that collects statistics about the rules. It can also be set later
+                via the *profiler* attribute.
+            remove_subsumed:
+                If True, rules that can never be applied because of an earlier rule are not added to the automaton.
         """
         self.matcher = ManyToOneMatcher()
+        self.normal_form_cache = LRUCache(cache_size)
+        self.profiler = profiler
+        self.remove_subsumed = remove_subsumed
+        self.subsumed_rules = []  # type: List[Tuple[functions.ReplacementRule, functions.ReplacementRule]]
         for rule in rules:
             self.add(rule)
 
@@ -770,11 +1647,135 @@ class ManyToOneReplacer:
             rule:
                 The rule to add.
         """
+        rule = functions.ReplacementRule(*rule)
+        if self.remove_subsumed:
+            subsuming_rule = self._find_subsuming_rule(rule)
+            if subsuming_rule is not None:
+                self.subsumed_rules.append((rule, subsuming_rule))
+                return
         self.matcher.add(rule.pattern, rule.replacement)
+        self.normal_form_cache.clear()
 
-    def replace(self, expression: Expression, max_count: int=math.inf) -> Union[Expression, Sequence[Expression]]:
+    def _find_subsuming_rule(self, rule: 'functions.ReplacementRule') -> Optional['functions.ReplacementRule']:
+        """Find an earlier rule that is always matched instead of the given rule.
+
+        That is a rule without constraints whose pattern is identical after renaming the variables. Both patterns
+        then end in the same final state of the automaton, where the pattern with the lower index is yielded first.
+        """
+        matcher = self.matcher
+        rule_index = len(matcher.patterns)
+        for index, (pattern, replacement, _) in enumerate(matcher.patterns):
+            if pattern == rule.pattern and replacement == rule.replacement:
+                # A removed rule that is added again keeps its index
+                rule_index = index
+                break
+        expression = self._renamed_expression(rule.pattern.expression)
+        for index in range(rule_index):
+            pattern, replacement, _ = matcher.patterns[index]
+            if matcher.removed_patterns & (1 << index) or pattern.constraints:
+                continue
+            if _is_identical(self._renamed_expression(pattern.expression), expression):
+                return functions.ReplacementRule(pattern, replacement)
+        return None
+
+    def _renamed_expression(self, expression: Expression) -> Expression:
+        """Rename the variables in the expression in the same way as the matcher does when the pattern is added."""
+        if not self.matcher.rename:
+            return expression
+        return rename_variables(expression, self.matcher._collect_variable_renaming(expression))
+
+    def remove(self, rule: 'functions.ReplacementRule') -> None:
+        """Remove a rule from the replacer.
+
+        Args:
+            rule:
+                The rule to remove.
+
+        Raises:
+            ValueError:
+                If the rule is not contained in the replacer.
+        """
+        rule = functions.ReplacementRule(*rule)
+        for i, (subsumed_rule, _) in enumerate(self.subsumed_rules):
+            if subsumed_rule == rule:
+                del self.subsumed_rules[i]
+                return
+        self.matcher.remove(rule.pattern, rule.replacement)
+        self.normal_form_cache.clear()
+        # The rules that were only subsumed by the removed rule can be used now
+        uncovered = [r for r, subsuming_rule in self.subsumed_rules if subsuming_rule == rule]
+        if uncovered:
+            self.subsumed_rules = [(r, s) for r, s in self.subsumed_rules if s != rule]
+            for uncovered_rule in uncovered:
+                self.add(uncovered_rule)
+
+    def snapshot(self) -> 'ManyToOneReplacer':
+        """Create a new version of the replacer.
+
+        The new version shares the automaton of this replacer (see :meth:`ManyToOneMatcher.snapshot`), so it is cheap
+        to create, even for large rule sets. Rules can then be added to or removed from the new version without
+        affecting replacements that are currently in progress with this version.
+
+        Returns:
+            The new version of the replacer.
+        """
+        new_replacer = type(self)(
+            cache_size=self.normal_form_cache.maxsize, profiler=self.profiler, remove_subsumed=self.remove_subsumed
+        )
+        new_replacer.matcher = self.matcher.snapshot()
+        new_replacer.subsumed_rules = list(self.subsumed_rules)
+        return new_replacer
+
+    def clear_caches(self) -> None:
+        """Clear the normal form cache and the subject caches of the matcher.
+
+        See :meth:`ManyToOneMatcher.clear_subject_caches`. This must not be done while a replacement is in progress.
+        """
+        self.normal_form_cache.clear()
+        self.matcher.clear_subject_caches()
+
+    def replace(
+            self, expression: Expression, max_count: int=math.inf, strategy='leftmost-outermost',
+            on_cycle: Optional[str]=None, budget: Optional[Budget]=None
+    ) -> Union[Expression, Sequence[Expression]]:
         """Replace all occurrences of the patterns according to the replacement rules.
 
+        The order in which the rules are applied is determined by the *strategy*:
+
+        ``'leftmost-outermost'``
+            Replaces the first match in preorder, one replacement at a time.
+        ``'parallel-outermost'``
+            Replaces all outermost matches at once and then repeats this for the resulting expression. This usually
+            needs far fewer passes over the expression than the leftmost-outermost strategy.
+        ``'innermost'``
+            Replaces innermost expressions first, see :meth:`replace_post_order`. The *max_count* is ignored.
+        ``'bottom-up'``
+            Applies at most one replacement to every subexpression in a single post-order pass and repeats
+            this for the resulting expression.
+
+        All strategies stop once the expression does not change anymore. Subexpressions that are already known to
+        not match any rule are not matched again, so detecting this fixed point does not require an extra pass over
+        the whole expression. Custom strategies can be given as a callable which is called with the replacer,
+        the expression and the *max_count*.
+
+        >>> replacer = ManyToOneReplacer(ReplacementRule(Pattern(f(a)), lambda: b))
+        >>> print(replacer.replace(f(f(a), f(a)), strategy='parallel-outermost'))
+        f(b, b)
+
+        With *on_cycle* set, the intermediate expressions after each replacement (or each pass for the
+        parallel-outermost and bottom-up strategies) are remembered to detect when the rules rewrite the expression in
+        a cycle. This is not supported for the innermost strategy and custom strategies.
+
+        >>> replacer.add(ReplacementRule(Pattern(b), lambda: f(a)))
+        >>> print(replacer.replace(f(a), on_cycle='stop'))
+        f(a)
+
+        A *budget* limits the time and steps spent on matching. Once it is exhausted, a
+        :class:`~matchpy.utils.BudgetExceeded` is raised with the expression after the last completed replacement (or
+        the last completed pass for the parallel-outermost and bottom-up strategies) as its *result*. For the
+        innermost strategy, there is no such partial result, but the normal forms found so far stay cached. Budgets
+        are not supported for custom strategies.
+
         Args:
             expression:
                 The expression to which the replacement rules are applied.
@@ -782,28 +1783,363 @@ class ManyToOneReplacer:
                 If given, at most *max_count* applications of the rules are performed. Otherwise, the rules
                 are applied until there is no more match. If the set of replacement rules is not confluent,
                 the replacement might not terminate without a *max_count* set.
+            strategy:
+                The name of the rewriting strategy or a custom strategy callable.
+            on_cycle:
+                If given, cycles are detected and either ``'stop'`` the replacement or ``'raise'`` a
+                :class:`~matchpy.functions.RewriteCycleError`. Otherwise, cycles are not detected.
+            budget:
+                An optional :class:`~matchpy.utils.Budget` that limits the time and steps spent on matching.
 
         Returns:
             The resulting expression after the application of the replacement rules. This can also be a sequence of
             expressions, if the root expression is replaced with a sequence of expressions by a rule.
+
+        Raises:
+            ValueError:
+                If the strategy is unknown or does not support cycle detection or budgets.
+            RewriteCycleError:
+                If *on_cycle* is ``'raise'`` and a cycle is detected.
+            BudgetExceeded:
+                If the *budget* is exhausted.
         """
+        if callable(strategy) or strategy == 'innermost':
+            if on_cycle is not None:
+                raise ValueError("Cycle detection is not supported for the strategy {!r}.".format(strategy))
+            if callable(strategy):
+                if budget is not None:
+                    raise ValueError("Budgets are not supported for the strategy {!r}.".format(strategy))
+                return strategy(self, expression, max_count)
+        try:
+            strategy = self._STRATEGIES[strategy]
+        except KeyError:
+            raise ValueError("Unknown strategy {!r}, expected one of {}.".format(strategy, ', '.join(self._STRATEGIES)))
+        cycles = functions._CycleDetector(expression, on_cycle) if on_cycle is not None else None
+        return strategy(self, expression, max_count, cycles, budget)
+
+    def _match_first(self, expression: Expression, budget: Optional[Budget]=None) \
+            -> Optional[Tuple['functions.ReplacementRule', Substitution]]:
+        if self.profiler is not None:
+            return self._profiled_match_first(expression, budget)
+        rule_match = next(self.matcher.match(expression, budget).indexed(), None)
+        if rule_match is None:
+            return None
+        pattern_index, subst = rule_match
+        pattern, replacement, _ = self.matcher.patterns[pattern_index]
+        return functions.ReplacementRule(pattern, replacement), subst
+
+    def _profiled_match_first(self, expression: Expression, budget: Optional[Budget]=None) \
+            -> Optional[Tuple['functions.ReplacementRule', Substitution]]:
+        profiler = self.profiler
+        start = time.perf_counter()
+        rule_match = next(self.matcher.match(expression, budget).indexed(), None)
+        profiler.record_many_to_one_match(time.perf_counter() - start)
+        if rule_match is None:
+            return None
+        pattern_index, subst = rule_match
+        pattern, replacement, _ = self.matcher.patterns[pattern_index]
+        profiler.get(pattern, replacement).matches += 1
+        replacement = profiler.profiled_replacement(pattern, replacement, expression)
+        return functions.ReplacementRule(pattern, replacement), subst
+
+    def _replace_leftmost_outermost(self, expression, max_count, cycles=None, budget=None):
         replaced = True
         replace_count = 0
-        while replaced and replace_count < max_count:
-            replaced = False
-            for subexpr, pos in preorder_iter_with_position(expression):
-                try:
-                    replacement, subst = next(iter(self.matcher.match(subexpr)))
-                    result = replacement(**subst)
-                    expression = functions.replace(expression, pos, result)
-                    replaced = True
+        # The subexpressions before the last replaced position in preorder, except for its ancestors, are unaffected
+        # by the replacement and already known to not match any rule. Hence, the search for the next match can skip
+        # them, while still finding the first match in preorder.
+        position = ()
+        try:
+            while replaced and replace_count < max_count:
+                replaced = False
+                for subexpr, pos in _preorder_iter_from(expression, position):
+                    rule_match = self._match_first(subexpr, budget)
+                    if rule_match is not None:
+                        rule, subst = rule_match
+                        result = functions._apply_replacement(rule.replacement, subst)
+                        expression = functions.replace(expression, pos, result)
+                        position = pos
+                        replaced = True
+                        if cycles is not None and cycles.step(expression, [rule]):
+                            return expression
+                        break
+                replace_count += 1
+        except BudgetExceeded as e:
+            e.result = expression
+            raise
+        return expression
+
+    def _replace_parallel_outermost(self, expression, max_count, cycles=None, budget=None):
+        # Maps the ids of subexpressions that are known to not contain any match to the subexpressions. The
+        # subexpressions are kept, so that their ids are not reused. Since the replacement only rebuilds the
+        # operations above the replaced positions, the remaining subexpressions are found again by identity.
+        normal = {}
+        replace_count = 0
+        applied = [] if cycles is not None else None
+        try:
+            while replace_count < max_count:
+                replacements = []
+                self._collect_outermost_replacements(
+                    expression, (), replacements, normal, max_count - replace_count, applied, budget
+                )
+                if not replacements:
                     break
-                except StopIteration:
-                    pass
-            replace_count += 1
+                replace_count += len(replacements)
+                expression = functions.replace_many(expression, replacements)
+                if cycles is not None:
+                    if cycles.step(expression, applied):
+                        break
+                    applied = []
+        except BudgetExceeded as e:
+            e.result = expression
+            raise
         return expression
 
-    def replace_post_order(self, expression: Expression) -> Union[Expression, Sequence[Expression]]:
+    def _collect_outermost_replacements(
+            self, expression, position, replacements, normal, max_count, applied=None, budget=None
+    ) -> bool:
+        """Collect the replacements for the outermost matches in the expression.
+
+        Returns:
+            True, iff the expression is known to not contain any match.
+        """
+        if id(expression) in normal:
+            return True
+        if len(replacements) >= max_count:
+            return False
+        rule_match = self._match_first(expression, budget)
+        if rule_match is not None:
+            rule, subst = rule_match
+            replacements.append((position, functions._apply_replacement(rule.replacement, subst)))
+            if applied is not None:
+                applied.append(rule)
+            return False
+        is_normal = True
+        if isinstance(expression, Operation):
+            for i, operand in enumerate(op_iter(expression)):
+                if not self._collect_outermost_replacements(
+                        operand, position + (i, ), replacements, normal, max_count, applied, budget
+                ):
+                    is_normal = False
+        if is_normal:
+            normal[id(expression)] = expression
+        return is_normal
+
+    def _replace_innermost(self, expression, max_count, cycles=None, budget=None):
+        return self.replace_post_order(expression, budget)
+
+    def _replace_bottom_up(self, expression, max_count, cycles=None, budget=None):
+        normal = {}
+        remaining = [max_count]
+        applied = [] if cycles is not None else None
+        try:
+            while remaining[0] > 0:
+                expression, is_normal = self._bottom_up_pass(expression, normal, remaining, applied, budget)
+                if is_normal:
+                    break
+                if cycles is not None:
+                    if applied and cycles.step(expression, applied):
+                        break
+                    applied = []
+        except BudgetExceeded as e:
+            e.result = expression
+            raise
+        return expression
+
+    def _bottom_up_pass(self, expression, normal, remaining, applied=None, budget=None):
+        """Apply at most one replacement to every subexpression, innermost first.
+
+        Returns:
+            The new expression and whether it is known to not contain any match.
+        """
+        if id(expression) in normal:
+            return expression, True
+        is_normal = True
+        if isinstance(expression, Operation):
+            operands = list(op_iter(expression))
+            new_operands = []
+            for operand in operands:
+                new_operand, operand_normal = self._bottom_up_pass(operand, normal, remaining, applied, budget)
+                is_normal = is_normal and operand_normal
+                if isinstance(new_operand, (list, tuple)):
+                    new_operands.extend(new_operand)
+                else:
+                    new_operands.append(new_operand)
+            if len(new_operands) != len(operands) or any(n is not o for n, o in zip(new_operands, operands)):
+                expression = create_operation_expression(expression, new_operands)
+        if remaining[0] <= 0:
+            return expression, False
+        rule_match = self._match_first(expression, budget)
+        if rule_match is not None:
+            rule, subst = rule_match
+            remaining[0] -= 1
+            if applied is not None:
+                applied.append(rule)
+            return functions._apply_replacement(rule.replacement, subst), False
+        if is_normal:
+            normal[id(expression)] = expression
+        return expression, is_normal
+
+    _STRATEGIES = {
+        'leftmost-outermost': _replace_leftmost_outermost,
+        'parallel-outermost': _replace_parallel_outermost,
+        'innermost': _replace_innermost,
+        'bottom-up': _replace_bottom_up,
+    }
+
+    def replace_batch(
+            self,
+            expressions: Iterable[Expression],
+            workers: Optional[int]=None,
+            chunksize: int=64,
+            max_count: int=math.inf,
+            strategy='leftmost-outermost'
+    ) -> Iterator[Union[Expression, Sequence[Expression], Exception]]:
+        """Replace the patterns in many independent expressions using multiple worker processes.
+
+        The worker processes are forked, so they share the replacer with this process (copy-on-write) and the rules do
+        not have to be pickled. The garbage collector is frozen while the workers run, so that it does not copy the
+        shared memory pages by touching the objects. The expressions are sent to the workers in chunks of
+        *chunksize* expressions and the results are yielded in the order of the expressions.
+
+        An exception raised while replacing one of the expressions does not abort the batch, instead the exception is
+        yielded in place of its result.
+
+        >>> replacer = ManyToOneReplacer(ReplacementRule(Pattern(f(a)), lambda: b))
+        >>> [str(e) for e in replacer.replace_batch([f(a), f(f(a)), a], workers=1)]
+        ['b', 'f(b)', 'a']
+
+        Without ``fork`` support or with a single worker, the expressions are replaced in this process. Only one batch
+        replacement can run at a time.
+
+        Args:
+            expressions:
+                The expressions to which the replacement rules are applied.
+            workers:
+                The number of worker processes. Defaults to the number of CPUs.
+            chunksize:
+                The number of expressions that are sent to a worker at once.
+            max_count:
+                The maximum number of replacements per expression, see :meth:`replace`.
+            strategy:
+                The rewriting strategy, see :meth:`replace`.
+
+        Yields:
+            The result of the replacement or the raised exception for every expression.
+        """
+        arguments = dict(max_count=max_count, strategy=strategy)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers <= 1 or not _can_fork():
+            for expression in expressions:
+                try:
+                    yield self.replace(expression, **arguments)
+                except Exception as e:  # pylint: disable=broad-except
+                    yield e
+            return
+        for _, result in self._replace_in_workers(expressions, workers, chunksize, None, arguments):
+            yield result
+
+    def replace_stream(
+            self,
+            expressions: Iterable[Expression],
+            max_count: int=math.inf,
+            strategy='leftmost-outermost',
+            on_cycle: Optional[str]=None,
+            workers: int=1,
+            chunksize: int=64,
+            reset_interval: Optional[int]=1024
+    ) -> Iterator[Union[Expression, Sequence[Expression]]]:
+        """Replace the patterns in a stream of expressions.
+
+        The expressions are consumed lazily and the results are yielded in the same order, so that arbitrarily long
+        streams can be processed, e.g. when reading the expressions from a file:
+
+        >>> replacer = ManyToOneReplacer(ReplacementRule(Pattern(f(a)), lambda: b))
+        >>> for result in replacer.replace_stream(iter([f(a), f(c)])):
+        ...     print(result)
+        b
+        f(c)
+
+        The caches of the replacer (see :meth:`clear_caches`) are shared between the expressions, but they are reset
+        after every *reset_interval* expressions to bound their memory usage.
+
+        With multiple *workers*, the expressions are replaced in forked worker processes as in :meth:`replace_batch`.
+        Each worker resets its own caches. At most two chunks per worker are in flight at a time, so the memory usage
+        stays bounded even if the stream is consumed slower than it is produced.
+
+        Args:
+            expressions:
+                The expressions to which the replacement rules are applied.
+            max_count:
+                The maximum number of replacements per expression, see :meth:`replace`.
+            strategy:
+                The rewriting strategy, see :meth:`replace`.
+            on_cycle:
+                The cycle detection, see :meth:`replace`.
+            workers:
+                The number of worker processes. By default, the expressions are replaced in this process.
+            chunksize:
+                The number of expressions that are sent to a worker at once.
+            reset_interval:
+                The number of expressions after which the caches are reset. If None, the caches are never reset.
+
+        Yields:
+            The result of the replacement for every expression.
+
+        Raises:
+            Exception:
+                Any exception raised while replacing one of the expressions is raised again.
+        """
+        arguments = dict(max_count=max_count, strategy=strategy, on_cycle=on_cycle)
+        if workers > 1 and _can_fork():
+            for success, result in self._replace_in_workers(expressions, workers, chunksize, reset_interval, arguments):
+                if not success:
+                    raise result
+                yield result
+            return
+        replaced = 0
+        for expression in expressions:
+            if reset_interval is not None and replaced >= reset_interval:
+                self.clear_caches()
+                replaced = 0
+            replaced += 1
+            yield self.replace(expression, **arguments)
+
+    def _replace_in_workers(self, expressions, workers, chunksize, reset_interval, arguments):
+        """Replace the expressions in forked worker processes.
+
+        Yields:
+            For every expression, whether the replacement was successful and its result or the raised exception.
+        """
+        global _BATCH_STATE  # pylint: disable=global-statement
+        if _BATCH_STATE is not None:
+            raise RuntimeError("Only one batch replacement can run at a time.")
+        operation_classes = list(_all_operation_classes())
+        class_indices = {cls: i for i, cls in enumerate(operation_classes)}
+        _BATCH_STATE = _BatchState(self, arguments, reset_interval, operation_classes, class_indices)
+        frozen = hasattr(gc, 'freeze')
+        if frozen:
+            gc.freeze()
+        try:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                iterator = iter(expressions)
+                chunks = iter(lambda: list(itertools.islice(iterator, chunksize)), [])
+                # Pool.imap would consume the whole input at once, so the number of pending chunks is limited here
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(_replace_batch_chunk, (_batch_dumps(chunk), )))
+                    if len(pending) >= 2 * workers:
+                        yield from pickle.loads(pending.popleft().get())
+                while pending:
+                    yield from pickle.loads(pending.popleft().get())
+        finally:
+            if frozen:
+                gc.unfreeze()
+            _BATCH_STATE = None
+
+    def replace_post_order(self, expression: Expression,
+                           budget: Optional[Budget]=None) -> Union[Expression, Sequence[Expression]]:
         """Replace all occurrences of the patterns according to the replacement rules.
 
         Replaces innermost expressions first.
@@ -815,31 +2151,109 @@ class ManyToOneReplacer:
                 If given, at most *max_count* applications of the rules are performed. Otherwise, the rules
                 are applied until there is no more match. If the set of replacement rules is not confluent,
                 the replacement might not terminate without a *max_count* set.
+            budget:
+                An optional :class:`~matchpy.utils.Budget` that limits the time and steps spent on matching.
 
         Returns:
             The resulting expression after the application of the replacement rules. This can also be a sequence of
             expressions, if the root expression is replaced with a sequence of expressions by a rule.
+
+        Raises:
+            BudgetExceeded:
+                If the *budget* is exhausted.
         """
-        return self._replace_post_order(expression)[0]
+        return self._replace_post_order(expression, budget)[0]
 
-    def _replace_post_order(self, expression):
+    def _replace_post_order(self, expression, budget=None):
+        cache = self.normal_form_cache
+        key = _ExpressionKey(expression)
+        try:
+            cached = cache.get(key)
+        except TypeError:
+            # Expressions that are not hashable cannot be cached
+            cached = cache = None
+        if cached is not None:
+            return cached
         any_replaced = False
         while True:
             if isinstance(expression, Operation):
-                new_operands = [self._replace_post_order(o) for o in op_iter(expression)]
+                new_operands = [self._replace_post_order(o, budget) for o in op_iter(expression)]
                 if any(r for _, r in new_operands):
                     new_operands = [o for o, _ in new_operands]
                     expression = create_operation_expression(expression, new_operands)
                     any_replaced = True
-            try:
-                replacement, subst = next(iter(self.matcher.match(expression)))
-                expression = replacement(**subst)
-                any_replaced = True
-            except StopIteration:
+            rule_match = self._match_first(expression, budget)
+            if rule_match is None:
                 break
+            rule, subst = rule_match
+            expression = functions._apply_replacement(rule.replacement, subst)
+            any_replaced = True
+        if cache is not None:
+            functions._cache_normal_form(cache, key, expression, any_replaced)
         return expression, any_replaced
 
 
+_MISSING = object()
+
+
+def _union_iter(
+        substitution: Substitution, substitution_lists: Sequence[Sequence[Substitution]], budget: Optional[Budget]=None
+) -> Iterator[Substitution]:
+    """Yield the union of the substitution with every combination of one substitution from each of the lists.
+
+    The combinations are yielded in the same order as by :func:`itertools.product`, but instead of merging every
+    combination separately, the substitutions are merged one at a time into a single working substitution and undone
+    again when backtracking. Hence, a conflict prunes all the combinations that contain it at once and the memory
+    needed stays proportional to the number of lists.
+
+    >>> lists = [[Substitution({'x': a}), Substitution({'x': b})], [Substitution({'x': b, 'y': a})]]
+    >>> [str(s) for s in _union_iter(Substitution(), lists)]
+    ['{x ↦ b, y ↦ a}']
+    """
+    count = len(substitution_lists)
+    if count == 0:
+        yield Substitution(substitution)
+        return
+    working = Substitution(substitution)
+    iterators = [iter(substitution_lists[0])] + [None] * (count - 1)  # type: List[Optional[Iterator[Substitution]]]
+    # For every level, the previous values of the variables that the current substitution of that level changed
+    undo = [None] * count  # type: List[Optional[Dict[str, Any]]]
+    level = 0
+    while level >= 0:
+        if undo[level] is not None:
+            _undo_union(working, undo[level])
+            undo[level] = None
+        other = next(iterators[level], None)
+        if other is None:
+            level -= 1
+            continue
+        if budget is not None:
+            budget.step()
+        changes = {}
+        try:
+            for name, value in other.items():
+                if name not in changes:
+                    changes[name] = working.get(name, _MISSING)
+                working.try_add_variable(name, value)
+        except ValueError:
+            _undo_union(working, changes)
+            continue
+        undo[level] = changes
+        if level + 1 == count:
+            yield Substitution(working)
+        else:
+            level += 1
+            iterators[level] = iter(substitution_lists[level])
+
+
+def _undo_union(substitution: Substitution, changes: Dict[str, Any]) -> None:
+    for name, value in changes.items():
+        if value is _MISSING:
+            del substitution[name]
+        else:
+            substitution[name] = value
+
+
 Subgraph = BipartiteGraph[Tuple[int, int], Tuple[int, int], Substitution]
 Matching = Dict[Tuple[int, int], Tuple[int, int]]
 
@@ -857,7 +2271,7 @@ class CommutativeMatcher(object):
         self.bipartite = BipartiteGraph()
         self.associative = associative
         self.max_optional_count = 0
-        self.anonymous_patterns = set()
+        self.anonymous_patterns = 0
 
     def add_pattern(self, operands: Iterable[Expression], constraints) -> int:
         pattern_set, pattern_vars = self._extract_sequence_wildcards(operands, constraints)
@@ -871,59 +2285,114 @@ class CommutativeMatcher(object):
             inserted_id = self.patterns[pattern_key][0]
         return inserted_id
 
-    def get_match_iter(self, subject):
-        match_iter = _MatchIter(self.automaton, subject, self.associative)
+    def _merge(self, other: 'CommutativeMatcher') -> Dict[int, int]:
+        """Merge the patterns of the other commutative matcher into this one.
+
+        Returns:
+            A dictionary that maps the other matcher's pattern ids to the pattern ids in this matcher.
+        """
+        automaton_mapping = self.automaton._merge(other.automaton)
+        pattern_mapping = {}
+        for other_id, pattern_set, pattern_vars in other.patterns.values():
+            new_pattern_set = Multiset({automaton_mapping[i]: count for i, count in pattern_set.items()})
+            pattern_key = tuple(sorted(new_pattern_set)) + pattern_vars
+            if pattern_key not in self.patterns:
+                inserted_id = len(self.patterns)
+                self.patterns[pattern_key] = (inserted_id, new_pattern_set, pattern_vars)
+            else:
+                inserted_id = self.patterns[pattern_key][0]
+            pattern_mapping[other_id] = inserted_id
+        for index in _iter_bits(other.anonymous_patterns):
+            self.anonymous_patterns |= 1 << automaton_mapping[index]
+        self.max_optional_count = max(self.max_optional_count, other.max_optional_count)
+        self._clear_subjects()
+        return pattern_mapping
+
+    def snapshot(self) -> 'CommutativeMatcher':
+        """Create a new version of the matcher that shares the states of its automaton with this matcher."""
+        new_matcher = object.__new__(type(self))
+        new_matcher.patterns = dict(self.patterns)
+        new_matcher.automaton = self.automaton.snapshot()
+        new_matcher.associative = self.associative
+        new_matcher.max_optional_count = self.max_optional_count
+        new_matcher.anonymous_patterns = self.anonymous_patterns
+        new_matcher._clear_subjects()
+        return new_matcher
+
+    def _clear_subjects(self) -> None:
+        self.subjects = {}
+        self.subjects_by_id = {}
+        self.bipartite = BipartiteGraph()
+
+    def get_match_iter(self, subject, budget=None):
+        match_iter = _MatchIter(self.automaton, subject, self.associative, budget)
         for _ in match_iter._match(self.automaton.root):
-            for pattern_index in match_iter.patterns:
-                substitution = Substitution(match_iter.substitution)
-                yield pattern_index, substitution
+            for pattern_index in _iter_bits(match_iter.patterns):
+                yield pattern_index, Substitution(match_iter.substitution)
 
 
-    def add_subject(self, subject: Expression) -> None:
+    def add_subject(self, subject: Expression, budget: Optional[Budget]=None) -> None:
         if subject not in self.subjects:
-            subject_id, pattern_set = self.subjects[subject] = (len(self.subjects), set())
+            # The matches are collected first, so that nothing is cached if the budget is exhausted. The budget is only
+            # passed if given, because the matchers created by the code generation do not support it.
+            matches = list(self.get_match_iter(subject) if budget is None else self.get_match_iter(subject, budget))
+            subject_id = len(self.subjects_by_id)
             self.subjects_by_id[subject_id] = subject
-            for pattern_index, substitution in self.get_match_iter(subject):
-                self.bipartite.setdefault((subject_id, pattern_index), []).append(Substitution(substitution))
-                pattern_set.add(pattern_index)
+            pattern_mask = 0
+            for pattern_index, substitution in matches:
+                self.bipartite.setdefault((subject_id, pattern_index), []).append(substitution)
+                pattern_mask |= 1 << pattern_index
+            self.subjects[subject] = (subject_id, pattern_mask)
         else:
             subject_id, _ = self.subjects[subject]
         return subject_id
 
-    def match(self, subjects: Sequence[Expression], substitution: Substitution) -> Iterator[Tuple[int, Substitution]]:
+    def match(self, subjects: Sequence[Expression], substitution: Substitution,
+              pattern_filter: Optional[Container[int]]=None, budget: Optional[Budget]=None,
+              dependent: Optional[Set[str]]=None) -> Iterator[Tuple[int, Substitution]]:
         subject_ids = Multiset()
         pattern_ids = Multiset()
         if self.max_optional_count > 0:
-            subject_id, subject_pattern_ids = self.subjects[None]
+            subject_id, subject_pattern_mask = self.subjects[None]
             subject_ids.add(subject_id)
             for _ in range(self.max_optional_count):
-                pattern_ids.update(subject_pattern_ids)
+                pattern_ids.update(_iter_bits(subject_pattern_mask))
         for subject in op_iter(subjects):
-            subject_id, subject_pattern_ids = self.subjects[subject]
+            subject_id, subject_pattern_mask = self.subjects[subject]
             subject_ids.add(subject_id)
-            pattern_ids.update(subject_pattern_ids)
+            pattern_ids.update(_iter_bits(subject_pattern_mask))
         for pattern_index, pattern_set, pattern_vars in self.patterns.values():
-            if pattern_set:
-                if not pattern_set <= pattern_ids:
-                    continue
-                bipartite_match_iter = self._match_with_bipartite(subject_ids, pattern_set, substitution)
-                for bipartite_substitution, matched_subjects in bipartite_match_iter:
-                    ids = subject_ids - matched_subjects
-                    remaining = Multiset(self.subjects_by_id[id] for id in ids if self.subjects_by_id[id] is not None)
-                    if pattern_vars:
-                        sequence_var_iter = self._match_sequence_variables(
-                            remaining, pattern_vars, bipartite_substitution
-                        )
-                        for result_substitution in sequence_var_iter:
-                            yield pattern_index, result_substitution
-                    elif len(remaining) == 0:
-                        yield pattern_index, bipartite_substitution
-            elif pattern_vars:
-                sequence_var_iter = self._match_sequence_variables(Multiset(op_iter(subjects)), pattern_vars, substitution)
-                for variable_substitution in sequence_var_iter:
-                    yield pattern_index, variable_substitution
-            elif op_len(subjects) == 0:
-                yield pattern_index, substitution
+            if pattern_filter is not None and pattern_index not in pattern_filter:
+                continue
+            if pattern_set and not pattern_set <= pattern_ids:
+                continue
+            pattern_match_iter = self._match_pattern(
+                subjects, subject_ids, pattern_set, pattern_vars, substitution, budget, dependent
+            )
+            for result_substitution in pattern_match_iter:
+                yield pattern_index, result_substitution
+                # The filter can change while matching, e.g. when only the first match of each pattern is needed
+                if pattern_filter is not None and pattern_index not in pattern_filter:
+                    break
+
+    def _match_pattern(self, subjects, subject_ids, pattern_set, pattern_vars, substitution, budget, dependent):
+        if pattern_set:
+            bipartite_match_iter = self._match_with_bipartite(subject_ids, pattern_set, substitution, budget)
+            for bipartite_substitution, matched_subjects in bipartite_match_iter:
+                ids = subject_ids - matched_subjects
+                remaining = Multiset(self.subjects_by_id[id] for id in ids if self.subjects_by_id[id] is not None)
+                if pattern_vars:
+                    yield from self._match_sequence_variables(
+                        remaining, pattern_vars, bipartite_substitution, budget, dependent
+                    )
+                elif len(remaining) == 0:
+                    yield bipartite_substitution
+        elif pattern_vars:
+            yield from self._match_sequence_variables(
+                Multiset(op_iter(subjects)), pattern_vars, substitution, budget, dependent
+            )
+        elif op_len(subjects) == 0:
+            yield substitution
 
     def _extract_sequence_wildcards(self, operands: Iterable[Expression],
                                     constraints) -> Tuple[MultisetOfInt, Dict[str, Tuple[VariableWithCount, bool]]]:
@@ -946,7 +2415,8 @@ class CommutativeMatcher(object):
                     renaming = {n: n for n in vnames}
                     index = self.automaton._internal_add(pattern, None, renaming)
                     if is_anonymous(pattern.expression):
-                        self.anonymous_patterns.add(index)
+                        self.anonymous_patterns |= 1 << index
+                    self._clear_subjects()
                 pattern_set.add(index)
             else:
                 varname = getattr(operand, 'variable_name', None)
@@ -981,19 +2451,19 @@ class CommutativeMatcher(object):
             subject_ids: MultisetOfInt,
             pattern_set: MultisetOfInt,
             substitution: Substitution,
+            budget: Optional[Budget]=None
     ) -> Iterator[Tuple[Substitution, MultisetOfInt]]:
         bipartite = self._build_bipartite(subject_ids, pattern_set)
-        for matching in enum_maximum_matchings_iter(bipartite):
+        for matching in enum_maximum_matchings_iter(bipartite, budget):
             if len(matching) < len(pattern_set):
                 break
             if not self._is_canonical_matching(matching):
                 continue
-            for substs in itertools.product(*(bipartite[edge] for edge in matching.items())):
-                try:
-                    bipartite_substitution = substitution.union(*substs)
-                except ValueError:
-                    continue
-                matched_subjects = Multiset(subexpression for subexpression, _ in matching)
+            edge_substitutions = [bipartite[edge] for edge in matching.items()]
+            matched_subjects = None
+            for bipartite_substitution in _union_iter(substitution, edge_substitutions, budget):
+                if matched_subjects is None:
+                    matched_subjects = Multiset(subexpression for subexpression, _ in matching)
                 yield bipartite_substitution, matched_subjects
 
     def _match_sequence_variables(
@@ -1001,10 +2471,21 @@ class CommutativeMatcher(object):
             subjects: MultisetOfExpression,
             pattern_vars: Sequence[VariableWithCount],
             substitution: Substitution,
+            budget: Optional[Budget]=None,
+            dependent: Optional[Set[str]]=None
     ) -> Iterator[Substitution]:
         only_counts = [info for info, _ in pattern_vars]
+        if can_count_variables(substitution, only_counts, dependent):
+            if budget is not None:
+                budget.step()
+            count = commutative_sequence_variable_partition_count(subjects, only_counts)
+            if count:
+                result_substitution = Substitution(substitution)
+                result_substitution[MULTIPLICITY] = substitution.get(MULTIPLICITY, 1) * count
+                yield result_substitution
+            return
         wrapped_vars = [name for (name, _, _, _), wrap in pattern_vars if wrap and name]
-        for variable_substitution in commutative_sequence_variable_partition_iter(subjects, only_counts):
+        for variable_substitution in commutative_sequence_variable_partition_iter(subjects, only_counts, budget):
             for var in wrapped_vars:
                 operands = variable_substitution[var]
                 if isinstance(operands, (tuple, list, Multiset)):
@@ -1048,7 +2529,7 @@ class CommutativeMatcher(object):
         anonymous_patterns = self.anonymous_patterns
         for (s1, n1), (p1, m1) in matching.items():
             for (s2, n2), (p2, m2) in matching.items():
-                if p1 in anonymous_patterns and p2 in anonymous_patterns:
+                if anonymous_patterns >> p1 & 1 and anonymous_patterns >> p2 & 1:
                     if n1 < n2 and m1 > m2:
                         return False
                 elif s1 == s2 and n1 < n2 and m1 > m2:
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from typing import Iterable, Iterator, List, Sequence, Tuple, cast, Set
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, cast, Set
 
 from multiset import Multiset
 
@@ -9,18 +9,21 @@ from ..expressions.expressions import (
 from ..expressions.constraints import Constraint
 from ..expressions.substitution import Substitution
 from ..expressions.functions import (
-    is_constant, preorder_iter_with_position, match_head, create_operation_expression, op_iter, op_len
+    is_constant, preorder_iter, preorder_iter_with_position, match_head, create_operation_expression, op_iter, op_len
 )
 from ..utils import (
     VariableWithCount, commutative_sequence_variable_partition_iter, fixed_integer_vector_iter, weak_composition_iter,
-    generator_chain, optional_iter
+    generator_chain, optional_iter, Budget, commutative_sequence_variable_partition_count
+)
+from .bipartite import BipartiteGraph
+from ._common import (
+    CommutativePatternsParts, check_one_identity, can_count_variables, get_dependent_variables, MULTIPLICITY
 )
-from ._common import CommutativePatternsParts, check_one_identity
 
-__all__ = ['match', 'match_anywhere']
+__all__ = ['match', 'match_anywhere', 'count_matches']
 
 
-def match(subject: Expression, pattern: Pattern) -> Iterator[Substitution]:
+def match(subject: Expression, pattern: Pattern, budget: Optional[Budget]=None) -> Iterator[Substitution]:
     r"""Tries to match the given *pattern* to the given *subject*.
 
     Yields each match in form of a substitution.
@@ -30,6 +33,8 @@ def match(subject: Expression, pattern: Pattern) -> Iterator[Substitution]:
             An subject to match.
         pattern:
             The pattern to match.
+        budget:
+            An optional :class:`.Budget` that limits the time and steps spent on the matching.
 
     Yields:
         All possible match substitutions.
@@ -37,12 +42,14 @@ def match(subject: Expression, pattern: Pattern) -> Iterator[Substitution]:
     Raises:
         ValueError:
             If the subject is not constant.
+        BudgetExceeded:
+            If the *budget* is exhausted. The matches yielded before remain valid.
     """
     if not is_constant(subject):
         raise ValueError("The subject for matching must be constant.")
     global_constraints = [c for c in pattern.constraints if not c.variables]
     local_constraints = set(c for c in pattern.constraints if c.variables)
-    for subst in _match([subject], pattern.expression, Substitution(), local_constraints):
+    for subst in _match([subject], pattern.expression, Substitution(), local_constraints, budget):
         for constraint in global_constraints:
             if not constraint(subst):
                 break
@@ -50,7 +57,51 @@ def match(subject: Expression, pattern: Pattern) -> Iterator[Substitution]:
             yield subst
 
 
-def match_anywhere(subject: Expression, pattern: Pattern) -> Iterator[Tuple[Substitution, Tuple[int, ...]]]:
+def count_matches(subject: Expression, pattern: Pattern, budget: Optional[Budget]=None) -> int:
+    """Count the matches of the given *pattern* for the given *subject*.
+
+    The result is the same as ``len(list(match(subject, pattern)))``, but the matches are not necessarily built one by
+    one. The sequence variables of a commutative operation that occur nowhere else in the pattern and in none of its
+    constraints are not bound. Instead, the number of ways to distribute the remaining operands among them is
+    computed combinatorially:
+
+    >>> f_c = Operation.new('f_c', Arity.variadic, commutative=True)
+    >>> subject = f_c(*(Symbol(str(i)) for i in range(40)))
+    >>> count_matches(subject, Pattern(f_c(Wildcard.plus('x'), Wildcard.plus('y'))))
+    1099511627774
+
+    Parameters:
+        subject:
+            An subject to match.
+        pattern:
+            The pattern to match.
+        budget:
+            An optional :class:`.Budget` that limits the time and steps spent on the matching.
+
+    Returns:
+        The number of matches.
+
+    Raises:
+        ValueError:
+            If the subject is not constant.
+        BudgetExceeded:
+            If the *budget* is exhausted.
+    """
+    if not is_constant(subject):
+        raise ValueError("The subject for matching must be constant.")
+    global_constraints = [c for c in pattern.constraints if not c.variables]
+    local_constraints = set(c for c in pattern.constraints if c.variables)
+    # Global constraints can depend on any variable
+    dependent = get_dependent_variables(pattern.expression, local_constraints) if not global_constraints else None
+    count = 0
+    for subst in _match([subject], pattern.expression, Substitution(), local_constraints, budget, dependent):
+        if all(constraint(subst) for constraint in global_constraints):
+            count += subst.get(MULTIPLICITY, 1)
+    return count
+
+
+def match_anywhere(subject: Expression, pattern: Pattern,
+                   budget: Optional[Budget]=None) -> Iterator[Tuple[Substitution, Tuple[int, ...]]]:
     """Tries to match the given *pattern* to the any subexpression of the given *subject*.
 
     Yields each match in form of a substitution and a position tuple.
@@ -63,6 +114,8 @@ def match_anywhere(subject: Expression, pattern: Pattern) -> Iterator[Tuple[Subs
             An subject to match.
         pattern:
             The pattern to match.
+        budget:
+            An optional :class:`.Budget` that limits the time and steps spent on the matching.
 
     Yields:
         All possible substitution and position pairs.
@@ -70,17 +123,123 @@ def match_anywhere(subject: Expression, pattern: Pattern) -> Iterator[Tuple[Subs
     Raises:
         ValueError:
             If the subject is not constant.
+        BudgetExceeded:
+            If the *budget* is exhausted. The matches yielded before remain valid.
     """
     if not is_constant(subject):
         raise ValueError("The subject for matching must be constant.")
     for child, pos in preorder_iter_with_position(subject):
         if match_head(child, pattern):
-            for subst in match(child, pattern):
+            for subst in match(child, pattern, budget):
                 yield subst, pos
 
 
-def _match(subjects: List[Expression], pattern: Expression, subst: Substitution,
-           constraints: Set[Constraint]) -> Iterator[Substitution]:
+def _can_check_existence(pattern: Pattern) -> bool:
+    """Check whether :func:`_exists` can decide if the pattern matches.
+
+    That is the case if the pattern has no constraints, every variable occurs only once, and the pattern contains no
+    optional wildcards and no associative or one-identity operations. Then the operands of the pattern can be matched
+    independently of each other and no variable needs to be bound.
+
+    Unnamed symbol wildcards directly inside a commutative operation are also excluded, because :func:`match` does not
+    check their symbol type, and the result must agree with it.
+    """
+    if pattern.constraints:
+        return False
+    seen = set()
+    for expression in preorder_iter(pattern.expression):
+        if isinstance(expression, (AssociativeOperation, OneIdentityOperation)):
+            return False
+        if isinstance(expression, CommutativeOperation) and any(
+                isinstance(o, SymbolWildcard) and o.variable_name is None for o in op_iter(expression)
+        ):
+            return False
+        if isinstance(expression, Wildcard) and expression.optional is not None:
+            return False
+        name = getattr(expression, 'variable_name', None)
+        if name is not None:
+            if name in seen:
+                return False
+            seen.add(name)
+    return True
+
+
+def _exists(subject: Expression, pattern: Expression) -> bool:
+    """Check whether the pattern matches the subject without building any substitution.
+
+    Only valid for patterns for which :func:`_can_check_existence` is true.
+    """
+    if isinstance(pattern, Wildcard):
+        return not isinstance(pattern, SymbolWildcard) or isinstance(subject, pattern.symbol_type)
+    if isinstance(pattern, Symbol):
+        return isinstance(subject, type(pattern)) and subject.name == pattern.name
+    if isinstance(pattern, Operation):
+        if not isinstance(subject, type(pattern)):
+            return False
+        if isinstance(pattern, CommutativeOperation):
+            return _commutative_operands_exist(list(op_iter(subject)), list(op_iter(pattern)))
+        return _operands_exist(list(op_iter(subject)), list(op_iter(pattern)))
+    return subject == pattern
+
+
+def _operands_exist(subjects: List[Expression], patterns: List[Expression]) -> bool:
+    failed = set()
+
+    def _exists_from(subject_index, pattern_index):
+        if pattern_index == len(patterns):
+            return subject_index == len(subjects)
+        if (subject_index, pattern_index) in failed:
+            return False
+        pattern = patterns[pattern_index]
+        if isinstance(pattern, Wildcard):
+            start = subject_index + pattern.min_count
+            end = start if pattern.fixed_size else len(subjects)
+            for next_index in range(start, min(end, len(subjects)) + 1):
+                if isinstance(pattern, SymbolWildcard) and \
+                        not all(isinstance(s, pattern.symbol_type) for s in subjects[subject_index:next_index]):
+                    break
+                if _exists_from(next_index, pattern_index + 1):
+                    return True
+        elif subject_index < len(subjects) and _exists(subjects[subject_index], pattern):
+            if _exists_from(subject_index + 1, pattern_index + 1):
+                return True
+        failed.add((subject_index, pattern_index))
+        return False
+
+    return _exists_from(0, 0)
+
+
+def _commutative_operands_exist(subjects: List[Expression], patterns: List[Expression]) -> bool:
+    fixed_length = 0
+    sequence_min_length = None
+    rest = []
+    for pattern in patterns:
+        if isinstance(pattern, Wildcard) and not isinstance(pattern, SymbolWildcard):
+            if pattern.fixed_size:
+                fixed_length += pattern.min_count
+            else:
+                sequence_min_length = (sequence_min_length or 0) + pattern.min_count
+        else:
+            rest.append(pattern)
+    remaining = len(subjects) - len(rest)
+    if remaining < fixed_length or (sequence_min_length is None and remaining != fixed_length) or \
+            (sequence_min_length is not None and remaining < fixed_length + sequence_min_length):
+        return False
+    if not rest:
+        return True
+    # Every other pattern operand needs a distinct subject operand that it matches
+    graph = BipartiteGraph()
+    for pattern_index, pattern in enumerate(rest):
+        for subject_index, subject in enumerate(subjects):
+            if _exists(subject, pattern):
+                graph[pattern_index, subject_index] = True
+    return len(graph.find_matching()) == len(rest)
+
+
+def _match(subjects: List[Expression], pattern: Expression, subst: Substitution, constraints: Set[Constraint],
+           budget: Optional[Budget]=None, dependent: Optional[Set[str]]=None) -> Iterator[Substitution]:
+    if budget is not None:
+        budget.step()
     match_iter = None
     expr = subjects[0] if subjects else None
     if isinstance(pattern, Wildcard):
@@ -102,13 +261,13 @@ def _match(subjects: List[Expression], pattern: Expression, subst: Substitution,
 
     elif isinstance(pattern, Operation):
         if isinstance(pattern, OneIdentityOperation):
-            yield from _match_one_identity(subjects, pattern, subst, constraints)
+            yield from _match_one_identity(subjects, pattern, subst, constraints, budget, dependent)
         if len(subjects) != 1 or not isinstance(subjects[0], pattern.__class__):
             return
         op_expr = cast(Operation, subjects[0])
         # if not op_expr.symbols >= pattern.symbols:
         #     return
-        match_iter = _match_operation(op_expr, pattern, subst, constraints)
+        match_iter = _match_operation(op_expr, pattern, subst, constraints, budget, dependent)
 
     else:
         if len(subjects) == 1 and subjects[0] == pattern:
@@ -148,9 +307,9 @@ def _check_constraints(substitution, constraints):
             constraints.add(constraint)
 
 
-def _match_factory(subjects, operand, constraints):
+def _match_factory(subjects, operand, constraints, budget, dependent):
     def factory(subst):
-        yield from _match(subjects, operand, subst, constraints)
+        yield from _match(subjects, operand, subst, constraints, budget, dependent)
 
     return factory
 
@@ -216,7 +375,7 @@ def _build_full_partition(
     return result
 
 
-def _non_commutative_match(subjects, operation, subst, constraints):
+def _non_commutative_match(subjects, operation, subst, constraints, budget, dependent):
     try:
         remaining, sequence_var_count, optional_count = _count_seq_vars(subjects, operation)
     except ValueError:
@@ -226,39 +385,43 @@ def _non_commutative_match(subjects, operation, subst, constraints):
             continue
         for part in weak_composition_iter(new_remaining, sequence_var_count):
             partition = _build_full_partition(optional, part, subjects, operation)
-            factories = [_match_factory(e, o, constraints) for e, o in zip(partition, op_iter(operation))]
+            factories = [
+                _match_factory(e, o, constraints, budget, dependent) for e, o in zip(partition, op_iter(operation))
+            ]
 
             for new_subst in generator_chain(subst, *factories):
                 yield new_subst
 
 
-def _match_one_identity(subjects, operation, subst, constraints):
+def _match_one_identity(subjects, operation, subst, constraints, budget, dependent):
     non_optional, added_subst = check_one_identity(operation)
     if non_optional is not None:
         try:
             new_subst = subst.union(added_subst)
         except ValueError:
             return
-        yield from _match(subjects, non_optional, new_subst, constraints)
+        yield from _match(subjects, non_optional, new_subst, constraints, budget, dependent)
 
 
-def _match_operation(subjects, operation, subst, constraints):
+def _match_operation(subjects, operation, subst, constraints, budget, dependent):
     if op_len(operation) == 0:
         if op_len(subjects) == 0:
             yield subst
         return
     if not isinstance(operation, CommutativeOperation):
-        yield from _non_commutative_match(subjects, operation, subst, constraints)
+        yield from _non_commutative_match(subjects, operation, subst, constraints, budget, dependent)
     else:
         parts = CommutativePatternsParts(type(operation), *op_iter(operation))
-        yield from _match_commutative_operation(subjects, parts, subst, constraints)
+        yield from _match_commutative_operation(subjects, parts, subst, constraints, budget, dependent)
 
 
 def _match_commutative_operation(
         subject_operands: Iterable[Expression],
         pattern: CommutativePatternsParts,
         substitution: Substitution,
-        constraints
+        constraints,
+        budget: Optional[Budget]=None,
+        dependent: Optional[Set[str]]=None
 ) -> Iterator[Substitution]:
     subjects = Multiset(op_iter(subject_operands))  # type: Multiset
     if not pattern.constant <= subjects:
@@ -290,7 +453,7 @@ def _match_commutative_operation(
             subjects -= needed_count
             del fixed_vars[name]
 
-    factories = [_fixed_expr_factory(e, constraints) for e in rest_expr]
+    factories = [_fixed_expr_factory(e, constraints, budget, dependent) for e in rest_expr]
 
     if not issubclass(pattern.operation, AssociativeOperation):
         for name, count in fixed_vars.items():
@@ -317,7 +480,19 @@ def _match_commutative_operation(
         if pattern.wildcard_fixed is False:
             sequence_vars += (VariableWithCount(None, 1, pattern.wildcard_min_length, None), )
 
-        for sequence_subst in commutative_sequence_variable_partition_iter(Multiset(rem_expr), sequence_vars):
+        if can_count_variables(substitution, sequence_vars, dependent):
+            # Only the number of matches is needed and the values of the sequence variables are not used anywhere else
+            if budget is not None:
+                budget.step()
+            count = commutative_sequence_variable_partition_count(Multiset(rem_expr), sequence_vars)
+            if count:
+                result = Substitution(substitution)
+                result[MULTIPLICITY] = substitution.get(MULTIPLICITY, 1) * count
+                yield result
+            continue
+
+        sequence_substs = commutative_sequence_variable_partition_iter(Multiset(rem_expr), sequence_vars, budget)
+        for sequence_subst in sequence_substs:
             if issubclass(pattern.operation, AssociativeOperation):
                 for v in fixed_vars.distinct_elements():
                     if v not in sequence_subst:
@@ -348,12 +523,12 @@ def _variables_with_counts(variables, infos):
     )
 
 
-def _fixed_expr_factory(expression, constraints):
+def _fixed_expr_factory(expression, constraints, budget, dependent):
     def factory(data):
         subjects, substitution = data
         for expr in subjects.distinct_elements():
             if match_head(expr, expression):
-                for subst in _match([expr], expression, substitution, constraints):
+                for subst in _match([expr], expression, substitution, constraints, budget, dependent):
                     yield subjects - Multiset({expr: 1}), subst
 
     return factory
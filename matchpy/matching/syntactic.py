@@ -4,6 +4,7 @@
 - There `DiscriminationNet` class that is a many-to-one matcher for syntactic patterns.
 - The `SequenceMatcher` can be used to match patterns with a common surrounding operation with some fixed
   syntactic patterns.
+- The `BottomUpMatcher` finds the matches of many syntactic patterns anywhere in a subject in a single pass.
 - The `FlatTerm` representation for an expression flattens the expression's tree structure and allows faster preoder
   traversal.
 
@@ -11,6 +12,7 @@ Furthermore, the module contains some utility functions for working with flatter
 """
 
 import itertools
+from operator import itemgetter
 from reprlib import recursive_repr
 from typing import (Any, Dict, FrozenSet, Generic, Iterator, List, Optional, Sequence, Set, Tuple, Type, TypeVar, Union)
 
@@ -20,13 +22,14 @@ except ImportError:
     Digraph = None
 
 from ..expressions.expressions import (
-    Expression, Operation, Symbol, SymbolWildcard, Wildcard, Pattern, AssociativeOperation, CommutativeOperation
+    Expression, Operation, Symbol, SymbolWildcard, Wildcard, Pattern, AssociativeOperation, CommutativeOperation,
+    OneIdentityOperation
 )
 from ..expressions.substitution import Substitution
 from ..expressions.functions import is_syntactic, op_iter, op_len
 from ..utils import slot_cached_property
 
-__all__ = ['FlatTerm', 'is_operation', 'is_symbol_wildcard', 'DiscriminationNet', 'SequenceMatcher']
+__all__ = ['FlatTerm', 'is_operation', 'is_symbol_wildcard', 'DiscriminationNet', 'SequenceMatcher', 'BottomUpMatcher']
 
 T = TypeVar('T')
 
@@ -870,3 +873,219 @@ class SequenceMatcher:
     def as_graph(self) -> Digraph:  # pragma: no cover
         """Renders the underlying discrimination net as graphviz digraph."""
         return self._net.as_graph()
+
+
+class BottomUpMatcher(Generic[T]):
+    """A bottom-up tree automaton that finds the matches of :term:`syntactic` patterns anywhere in a subject.
+
+    Instead of matching the patterns against every subexpression of the subject separately, the automaton labels
+    every subexpression with the set of subpatterns it matches in a single post-order pass. Since the label of an
+    operation only depends on its type and the labels of its operands, the transitions between the labels are cached.
+    Once the automaton has seen similar subjects, finding all match positions takes time linear in the subject size:
+
+    >>> matcher = BottomUpMatcher(Pattern(f(x_, a)), Pattern(f(b, x_)))
+    >>> for pattern, substitution, position in matcher.match_anywhere(f(f(b, a), f(c, a), a)):
+    ...     print(pattern, substitution, position)
+    f(x_, a) {x ↦ b} (0,)
+    f(b, x_) {x ↦ a} (0,)
+    f(x_, a) {x ↦ c} (1,)
+
+    Like the :class:`DiscriminationNet`, the automaton treats the patterns as linear. Non-linear variables and
+    constraints are only checked for the subexpressions that match the linear pattern.
+    """
+
+    def __init__(self, *patterns: Pattern) -> None:
+        """
+        Args:
+            *patterns:
+                Optional patterns to initially add to the matcher.
+        """
+        self._patterns = []
+        self._pattern_roots = []
+        # Maps the subpatterns to their ids. A subpattern is represented by Wildcard, a symbol type (for a symbol
+        # wildcard), a tuple of a symbol type and name, another atom or a list of an operation type and operand ids.
+        self._subpatterns = {}
+        self._wildcard_subpatterns = []
+        self._atom_subpatterns = []
+        self._operation_subpatterns = {}
+        self._clear_states()
+        for pattern in patterns:
+            self.add(pattern)
+
+    def _clear_states(self) -> None:
+        self._states = {}
+        self._state_subpatterns = []
+        self._state_finals = []
+        self._atom_transitions = {}
+        self._operation_transitions = {}
+        self._operation_candidates = {}
+
+    def add(self, pattern: Pattern, final_label: T=None) -> int:
+        """Add a pattern to the matcher.
+
+        Args:
+            pattern:
+                The pattern to add.
+            final_label:
+                A label that is returned if the pattern matches. This will default to the pattern itself.
+
+        Returns:
+            The index of the newly added pattern.
+
+        Raises:
+            ValueError:
+                If the pattern is not syntactic.
+        """
+        root = self._add_subpattern(pattern.expression)
+        index = len(self._patterns)
+        self._patterns.append((pattern, pattern if final_label is None else final_label))
+        self._pattern_roots.append(root)
+        self._clear_states()
+        return index
+
+    def _add_subpattern(self, expression: Expression) -> int:
+        if isinstance(expression, Wildcard):
+            if expression.min_count != 1 or not expression.fixed_size or expression.optional is not None:
+                raise ValueError("The pattern contains the sequence wildcard {!s}.".format(expression))
+            key = expression.symbol_type if isinstance(expression, SymbolWildcard) else Wildcard
+        elif isinstance(expression, Operation):
+            if isinstance(expression, (AssociativeOperation, CommutativeOperation, OneIdentityOperation)):
+                raise ValueError("The pattern contains the non-syntactic operation {!s}.".format(expression))
+            key = (type(expression), tuple(self._add_subpattern(o) for o in op_iter(expression)))
+        elif isinstance(expression, Symbol):
+            key = (type(expression), expression.name)
+        else:
+            key = expression
+        subpattern_id = self._subpatterns.get(key)
+        if subpattern_id is None:
+            subpattern_id = self._subpatterns[key] = len(self._subpatterns)
+            if isinstance(key, type):
+                self._wildcard_subpatterns.append((key, subpattern_id))
+            elif isinstance(key, tuple) and issubclass(key[0], Operation):
+                self._operation_subpatterns.setdefault(key[0], []).append((key[1], subpattern_id))
+            else:
+                self._atom_subpatterns.append((key, subpattern_id))
+        return subpattern_id
+
+    def _get_state(self, subpatterns: Set[int]) -> int:
+        subpatterns = frozenset(subpatterns)
+        state = self._states.get(subpatterns)
+        if state is None:
+            state = self._states[subpatterns] = len(self._state_subpatterns)
+            self._state_subpatterns.append(subpatterns)
+            self._state_finals.append([i for i, root in enumerate(self._pattern_roots) if root in subpatterns])
+        return state
+
+    def _matching_wildcards(self, subject: Expression) -> Set[int]:
+        return set(
+            subpattern_id for key, subpattern_id in self._wildcard_subpatterns
+            if key is Wildcard or isinstance(subject, key)
+        )
+
+    def _atom_state(self, subject: Expression) -> int:
+        # Equal atoms of different types, e.g. symbols of different classes, can match different subpatterns
+        key = (type(subject), subject)
+        try:
+            return self._atom_transitions[key]
+        except KeyError:
+            pass
+        subpatterns = self._matching_wildcards(subject)
+        for key, subpattern_id in self._atom_subpatterns:
+            if isinstance(key, tuple):
+                if isinstance(subject, key[0]) and subject.name == key[1]:
+                    subpatterns.add(subpattern_id)
+            elif subject == key:
+                subpatterns.add(subpattern_id)
+        state = self._atom_transitions[key] = self._get_state(subpatterns)
+        return state
+
+    def _operation_state(self, subject: Operation, operand_states: Tuple[int, ...]) -> int:
+        operation = type(subject)
+        key = (operation, operand_states)
+        try:
+            return self._operation_transitions[key]
+        except KeyError:
+            pass
+        candidates = self._operation_candidates.get(operation)
+        if candidates is None:
+            candidates = self._operation_candidates[operation] = [
+                entry for pattern_operation, entries in self._operation_subpatterns.items()
+                if issubclass(operation, pattern_operation) for entry in entries
+            ]
+        subpatterns = self._matching_wildcards(subject)
+        operand_subpatterns = [self._state_subpatterns[state] for state in operand_states]
+        for operands, subpattern_id in candidates:
+            if len(operands) == len(operand_subpatterns) and \
+                    all(o in s for o, s in zip(operands, operand_subpatterns)):
+                subpatterns.add(subpattern_id)
+        state = self._operation_transitions[key] = self._get_state(subpatterns)
+        return state
+
+    def _label(self, subject: Expression, position: Tuple[int, ...], labeled: List) -> int:
+        if isinstance(subject, Operation):
+            operand_states = tuple(
+                self._label(operand, position + (i, ), labeled) for i, operand in enumerate(op_iter(subject))
+            )
+            state = self._operation_state(subject, operand_states)
+        else:
+            state = self._atom_state(subject)
+        finals = self._state_finals[state]
+        if finals:
+            labeled.append((position, subject, finals))
+        return state
+
+    def label(self, subject: Expression) -> List[Tuple[Tuple[int, ...], List[int]]]:
+        """Find the positions of the subexpressions that match the linear patterns.
+
+        Args:
+            subject:
+                The subject that is matched. Must be constant.
+
+        Returns:
+            For every position in the subject where at least one of the patterns matches (when considered as linear),
+            a tuple of the position and the indices of the patterns. The positions are in preorder.
+        """
+        labeled = []
+        self._label(subject, (), labeled)
+        labeled.sort(key=itemgetter(0))
+        return [(position, finals) for position, _, finals in labeled]
+
+    def match_anywhere(self, subject: Expression) -> Iterator[Tuple[T, Substitution, Tuple[int, ...]]]:
+        """Match the patterns against all subexpressions of the subject.
+
+        Args:
+            subject:
+                The subject that is matched. Must be constant.
+
+        Yields:
+            For every match, a tuple of the final label of the pattern, the match substitution and the position of the
+            matched subexpression. The matches are yielded in preorder of their positions and in the order the patterns
+            were added for the same position.
+        """
+        labeled = []
+        self._label(subject, (), labeled)
+        labeled.sort(key=itemgetter(0))
+        for position, expression, finals in labeled:
+            for index in finals:
+                pattern, label = self._patterns[index]
+                subst = Substitution()
+                if subst.extract_substitution(expression, pattern.expression):
+                    for constraint in pattern.constraints:
+                        if not constraint(subst):
+                            break
+                    else:
+                        yield label, subst, position
+
+    def match(self, subject: Expression) -> Iterator[Tuple[T, Substitution]]:
+        """Match the patterns against the subject.
+
+        Args:
+            subject:
+                The subject that is matched. Must be constant.
+
+        Yields:
+            For every match, a tuple of the final label of the pattern and the match substitution.
+        """
+        for label, subst, position in self.match_anywhere(subject):
+            if position == ():
+                yield label, subst
@@ -5,8 +5,10 @@ import itertools
 import math
 import ast
 import os
+import sys
 import tokenize
-import copy
+import time
+from collections import OrderedDict
 from types import LambdaType
 
 # pylint: disable=unused-import
@@ -17,14 +19,16 @@ from multiset import Multiset
 
 __all__ = [
     'fixed_integer_vector_iter', 'weak_composition_iter', 'commutative_sequence_variable_partition_iter',
+    'commutative_sequence_variable_partition_count',
     'get_short_lambda_source', 'solve_linear_diop', 'generator_chain', 'cached_property', 'slot_cached_property',
-    'extended_euclid', 'base_solution_linear'
+    'extended_euclid', 'base_solution_linear', 'LRUCache', 'Budget', 'BudgetExceeded'
 ]
 
 T = TypeVar('T')
 VariableWithCount = NamedTuple(
     'VariableWithCount', [('name', str), ('count', int), ('minimum', int), ('default', Optional[Any])]
 )
+CacheInfo = NamedTuple('CacheInfo', [('hits', int), ('misses', int), ('maxsize', int), ('currsize', int)])
 
 
 def fixed_integer_vector_iter(max_vector: Tuple[int, ...], vector_sum: int) -> Iterator[Tuple[int, ...]]:
@@ -132,21 +136,25 @@ def optional_iter(remaining, count):
 _linear_diop_solution_cache = {}  # type: Dict[Tuple[int, ...], List[Tuple[int, ...]]]
 
 
+def _linear_diop_solutions(total: int, var_counts: List[int]) -> List[Tuple[int, ...]]:
+    cache_key = (total, *var_counts)
+    if cache_key in _linear_diop_solution_cache:
+        return _linear_diop_solution_cache[cache_key]
+    solutions = list(solve_linear_diop(total, *var_counts))
+    _linear_diop_solution_cache[cache_key] = solutions
+    return solutions
+
+
 def _make_variable_generator_factory(value, total, variables: List[VariableWithCount]):
     var_counts = [v.count for v in variables]
-    cache_key = (total, *var_counts)
 
     def _factory(subst):
-        if cache_key in _linear_diop_solution_cache:
-            solutions = _linear_diop_solution_cache[cache_key]
-        else:
-            solutions = list(solve_linear_diop(total, *var_counts))
-            _linear_diop_solution_cache[cache_key] = solutions
+        solutions = _linear_diop_solutions(total, var_counts)
+        # The counts are updated in place, every later factory overwrites its own counts before the next solution
         for solution in solutions:
-            new_subst = copy.copy(subst)
             for var, count in zip(variables, solution):
-                new_subst[var.name][value] = count
-            yield new_subst
+                subst[var.name][value] = count
+            yield subst
 
     return _factory
 
@@ -170,8 +178,8 @@ def _commutative_single_variable_partiton_iter(values: 'Multiset[T]',
             yield {name: new_values} if name is not None else {}
 
 
-def commutative_sequence_variable_partition_iter(values: Multiset, variables: List[VariableWithCount]
-                                                ) -> Iterator[Dict[str, Multiset]]:
+def commutative_sequence_variable_partition_iter(values: Multiset, variables: List[VariableWithCount],
+                                                 budget: Optional['Budget']=None) -> Iterator[Dict[str, Multiset]]:
     """Yield all possible variable substitutions for given values and variables.
 
     .. note::
@@ -205,11 +213,19 @@ def commutative_sequence_variable_partition_iter(values: Multiset, variables: Li
         variables:
             A list of the variables to distribute the values among. Each variable has a name, a count of how many times
             it occurs and a minimum number of values it needs.
+        budget:
+            An optional :class:`Budget` that is charged one step for every candidate partitioning.
 
     Yields:
         Each possible substitutions that is a valid partitioning of the values among the variables.
+
+    Raises:
+        BudgetExceeded:
+            If the *budget* is exhausted.
     """
     if len(variables) == 1:
+        if budget is not None:
+            budget.step()
         yield from _commutative_single_variable_partiton_iter(values, variables[0])
         return
 
@@ -217,19 +233,64 @@ def commutative_sequence_variable_partition_iter(values: Multiset, variables: Li
     for value, count in values.items():
         generators.append(_make_variable_generator_factory(value, count, variables))
 
-    initial = dict((var.name, Multiset()) for var in variables)  # type: Dict[str, 'Multiset[T]']
-    for subst in generator_chain(initial, *generators):
-        valid = True
+    # All the partial partitions are built in this one substitution, so that the memory does not grow with the
+    # number of partitions. Only the valid ones are copied.
+    current = dict((var.name, Multiset()) for var in variables)  # type: Dict[str, 'Multiset[T]']
+    for subst in generator_chain(current, *generators):
+        if budget is not None:
+            budget.step()
+        result = {}
         for var in variables:
-            if var.default is not None and len(subst[var.name]) == 0:
-                subst[var.name] = var.default
-            elif len(subst[var.name]) < var.minimum:
-                valid = False
+            var_values = subst[var.name]
+            if var.default is not None and len(var_values) == 0:
+                result[var.name] = var.default
+            elif len(var_values) < var.minimum:
                 break
-        if valid:
-            if None in subst:
-                del subst[None]
-            yield subst
+            else:
+                result[var.name] = Multiset(var_values)
+        else:
+            result.pop(None, None)
+            yield result
+
+
+def commutative_sequence_variable_partition_count(values: Multiset, variables: List[VariableWithCount]) -> int:
+    """Count the substitutions yielded by :func:`commutative_sequence_variable_partition_iter`.
+
+    The substitutions are not built. Instead, the partitionings are counted by only keeping track of the number of
+    partitionings for every combination of the variables' lengths, which are capped at their minimum length.
+
+    >>> x = VariableWithCount(name='x', count=1, minimum=1, default=None)
+    >>> y = VariableWithCount(name='y', count=2, minimum=0, default=None)
+    >>> commutative_sequence_variable_partition_count(Multiset('aaabbc'), [x, y])
+    4
+
+    Args:
+        values:
+            The multiset of values which are partitioned and distributed among the variables.
+        variables:
+            A list of the variables to distribute the values among.
+
+    Returns:
+        The number of valid partitionings of the values among the variables.
+    """
+    if len(variables) == 1:
+        return sum(1 for _ in _commutative_single_variable_partiton_iter(values, variables[0]))
+    var_counts = [v.count for v in variables]
+    # A length of 1 has to be distinguished from 0 for the variables with a default
+    caps = [max(v.minimum, 1) for v in variables]
+    counts = {tuple(0 for _ in variables): 1}  # type: Dict[Tuple[int, ...], int]
+    for total in values.values():
+        new_counts = {}  # type: Dict[Tuple[int, ...], int]
+        for solution in _linear_diop_solutions(total, var_counts):
+            for lengths, count in counts.items():
+                new_lengths = tuple(min(l + n, cap) for l, n, cap in zip(lengths, solution, caps))
+                new_counts[new_lengths] = new_counts.get(new_lengths, 0) + count
+        counts = new_counts
+    return sum(
+        count for lengths, count in counts.items()
+        if all((v.default is not None and l == 0) or l >= v.minimum for v, l in zip(variables, lengths))
+    )
+
 
 class LambdaNodeVisitor(ast.NodeVisitor):
     def __init__(self, lines):
@@ -650,3 +711,189 @@ def slot_cached_property(slot):
         return cached_property(getter, slot)
 
     return _wrapper
+
+
+class LRUCache:
+    """A cache with a bounded size that discards the least recently used entries first.
+
+    It also keeps statistics about the cache hits and misses:
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> print(cache.get('b'))
+    None
+    >>> cache.cache_info()
+    CacheInfo(hits=1, misses=1, maxsize=2, currsize=2)
+
+    Optionally, the total size of the cached values can be bounded as well:
+
+    >>> cache = LRUCache(10, maxmemory=10, sizeof=len)
+    >>> cache['a'] = 'aaaa'
+    >>> cache['b'] = 'bbbb'
+    >>> cache['c'] = 'cccc'
+    >>> 'a' in cache, cache.memory
+    (False, 8)
+
+    Just like a dictionary, the cache requires its keys to be hashable.
+    """
+
+    def __init__(self, maxsize: int=1024, maxmemory: Optional[int]=None,
+                 sizeof: Callable[[Any], int]=sys.getsizeof) -> None:
+        """
+        Args:
+            maxsize:
+                The maximum number of entries in the cache. If it is zero, nothing is cached.
+            maxmemory:
+                The maximum total size of the cached values as measured by *sizeof*. Values larger than that are not
+                cached at all. If None, only the number of entries is bounded.
+            sizeof:
+                A function that estimates the size of a value. Defaults to :func:`sys.getsizeof`. It is only used if
+                *maxmemory* is given.
+        """
+        self.maxsize = maxsize
+        self.maxmemory = maxmemory
+        self.sizeof = sizeof
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # type: Dict[Any, Tuple[Any, int]]
+
+    def get(self, key, default=None):
+        """Return the value for the key and mark it as recently used.
+
+        Args:
+            key:
+                The key to look up.
+            default:
+                The value that is returned if the key is not in the cache.
+
+        Returns:
+            The cached value or the *default*.
+        """
+        try:
+            value, _ = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        if self.maxsize <= 0:
+            return
+        size = self.sizeof(value) if self.maxmemory is not None else 0
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self.memory -= old_entry[1]
+        if self.maxmemory is not None and size > self.maxmemory:
+            return
+        self._entries[key] = (value, size)
+        self.memory += size
+        while len(self._entries) > self.maxsize or (self.maxmemory is not None and self.memory > self.maxmemory):
+            _, (_, old_size) = self._entries.popitem(last=False)
+            self.memory -= old_size
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self, statistics: bool=True) -> None:
+        """Remove all entries from the cache.
+
+        Args:
+            statistics:
+                Whether to reset the statistics as well.
+        """
+        self._entries.clear()
+        self.memory = 0
+        if statistics:
+            self.hits = 0
+            self.misses = 0
+
+    def cache_info(self) -> CacheInfo:
+        """Return the statistics of the cache.
+
+        Returns:
+            A tuple with the number of *hits* and *misses*, the *maxsize* and the current size (*currsize*) of the
+            cache.
+        """
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+
+class BudgetExceeded(Exception):
+    """Raised when a :class:`Budget` is exhausted.
+
+    Attributes:
+        budget:
+            The exhausted budget.
+        result:
+            The partial result of the aborted operation, if it has one. For the replacement functions, this is the
+            expression after the last completed replacement. Otherwise, it is None.
+    """
+
+    def __init__(self, budget: 'Budget', reason: str) -> None:
+        self.budget = budget
+        self.result = None
+        super().__init__('The {} budget was exhausted after {} steps.'.format(reason, budget.steps))
+
+
+class Budget:
+    """Limits the time and/or the number of steps spent on matching or replacement.
+
+    Some patterns, e.g. commutative ones with several sequence variables, have a huge number of ways to match a
+    subject. A budget can be passed to the matching and replacement functions to abort them once they have used up
+    their time or steps. A step is taken for every state of the search, e.g. every candidate matching or partitioning
+    in the enumeration of the commutative matches:
+
+    >>> f_c = Operation.new('f_c', Arity.variadic, commutative=True)
+    >>> subject = f_c(*(Symbol(str(i)) for i in range(20)))
+    >>> pattern = Pattern(f_c(Wildcard.plus('x'), Wildcard.plus('y'), Wildcard.plus('z')))
+    >>> matches = list(match(subject, pattern, Budget(max_steps=100)))
+    Traceback (most recent call last):
+    ...
+    matchpy.utils.BudgetExceeded: The step budget was exhausted after 100 steps.
+
+    The time limit is measured from the creation of the budget, so the same budget can be shared by several
+    operations, e.g. all the operations that handle one request.
+    """
+
+    __slots__ = ('deadline', 'max_steps', 'steps')
+
+    def __init__(self, timeout: Optional[float]=None, max_steps: Optional[int]=None) -> None:
+        """
+        Args:
+            timeout:
+                The maximum time in seconds. If None, the time is unlimited.
+            max_steps:
+                The maximum number of steps. If None, the number of steps is unlimited.
+        """
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.max_steps = max_steps
+        self.steps = 0
+
+    @property
+    def exhausted(self) -> bool:
+        """True, iff the time or the steps are used up."""
+        if self.max_steps is not None and self.steps >= self.max_steps:
+            return True
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def step(self) -> None:
+        """Take a step.
+
+        Raises:
+            BudgetExceeded:
+                If the time or the steps are used up.
+        """
+        if self.max_steps is not None and self.steps >= self.max_steps:
+            raise BudgetExceeded(self, 'step')
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise BudgetExceeded(self, 'time')
+        self.steps += 1
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from matchpy.egraph import EGraph
+from matchpy.expressions.expressions import Arity, Operation, Pattern, Symbol
+from matchpy.functions import ReplacementRule, Template
+from .common import *
+
+mul = Operation.new('*', Arity.binary, 'Mul', infix=True)
+div = Operation.new('/', Arity.binary, 'Div', infix=True)
+shl = Operation.new('<<', Arity.binary, 'Shl', infix=True)
+one = Symbol('1')
+two = Symbol('2')
+
+
+def test_add_hash_consing():
+    egraph = EGraph()
+    root = egraph.add(f(f2(a), f2(a)))
+
+    assert egraph.add(f(f2(a), f2(a))) == root
+    assert egraph.lookup(f2(a)) == egraph.add(f2(a))
+    assert egraph.lookup(f2(b)) is None
+    assert egraph.node_count == egraph.class_count == 3
+
+
+def test_add_commutative():
+    egraph = EGraph()
+
+    assert egraph.add(f_c(a, f(b))) == egraph.add(f_c(f(b), a))
+    egraph.union(egraph.add(a), egraph.add(c))
+    egraph.rebuild()
+    assert egraph.equivalent(f_c(a, f(b)), f_c(f(b), c))
+
+
+def test_union_congruence():
+    egraph = EGraph()
+    egraph.add(f(f2(a), b))
+    egraph.add(f(f2(c), b))
+
+    assert not egraph.equivalent(f(f2(a), b), f(f2(c), b))
+    egraph.union(egraph.add(a), egraph.add(c))
+    egraph.rebuild()
+    assert egraph.equivalent(f(f2(a), b), f(f2(c), b))
+    assert egraph.class_count == 4
+
+
+def test_saturate_and_extract():
+    rules = [
+        ReplacementRule(Pattern(mul(x_, two)), Template(shl(x_, one))),
+        ReplacementRule(Pattern(div(mul(x_, y_), z_)), Template(mul(x_, div(y_, z_)))),
+        ReplacementRule(Pattern(div(x_, x_)), Template(one)),
+        ReplacementRule(Pattern(mul(x_, one)), Template(x_)),
+    ]
+    egraph = EGraph()
+    root = egraph.add(div(mul(a, two), two))
+
+    assert egraph.saturate(rules)
+    assert egraph.equivalent(div(mul(a, two), two), a)
+    assert egraph.equivalent(mul(a, two), shl(a, one))
+    assert egraph.extract(root) == a
+    assert egraph.extract(mul(a, two)) == mul(a, two)
+
+    def _cost(head, operand_costs):
+        return (1 if head == shl else 5) + sum(operand_costs)
+
+    assert egraph.extract(mul(a, two), _cost) == shl(a, one)
+    with pytest.raises(KeyError):
+        egraph.extract(mul(b, two))
+
+
+def test_saturate_commutativity():
+    egraph = EGraph()
+    egraph.add(f2(a, f2(b, c)))
+
+    assert egraph.saturate([ReplacementRule(Pattern(f2(x_, y_)), lambda x, y: f2(y, x))])
+    assert egraph.equivalent(f2(a, f2(b, c)), f2(f2(c, b), a))
+    assert egraph.class_count == 5
+
+
+def test_saturate_budget():
+    rules = [ReplacementRule(Pattern(f(x_)), lambda x: f(f2(x)))]
+
+    egraph = EGraph()
+    egraph.add(f(a))
+    assert not egraph.saturate(rules, node_limit=20)
+    assert egraph.node_count <= 25
+
+    egraph = EGraph()
+    egraph.add(f(a))
+    assert not egraph.saturate(rules, max_iterations=3)
+    assert egraph.equivalent(f(a), f(f2(f2(f2(a)))))
+    assert not egraph.equivalent(f(a), f(f2(f2(f2(f2(a))))))
+    assert egraph.extract(f(f2(f2(a)))) == f(a)
+
+
+def test_saturate_cycle():
+    egraph = EGraph()
+    egraph.add(a)
+
+    assert egraph.saturate([ReplacementRule(Pattern(x_), lambda x: f(x))])
+    assert egraph.equivalent(a, f(a))
+    assert egraph.lookup(f(f(f(a)))) == egraph.lookup(a)
+    assert egraph.extract(f(f(a))) == a
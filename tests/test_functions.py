@@ -1,13 +1,24 @@
 # -*- coding: utf-8 -*-
+import json
+import math
+
 from hypothesis import assume, given
+from multiset import Multiset
 import hypothesis.strategies as st
 import pytest
 
+from matchpy.expressions.constraints import CustomConstraint
 from matchpy.expressions.expressions import Arity, Operation, Symbol, Wildcard, Pattern
-from matchpy.functions import ReplacementRule, replace, replace_all, substitute, replace_many, is_match
+from matchpy.functions import (
+    ReplacementRule, replace, replace_all, substitute, replace_many, is_match, replace_all_post_order, RuleProfiler,
+    RewriteCycleError, Template, compile_substitution
+)
+from matchpy.utils import Budget, BudgetExceeded, LRUCache
+from matchpy import functions
 from matchpy.matching.one_to_one import match_anywhere
 from matchpy.matching.one_to_one import match as match_one_to_one
 from matchpy.matching.many_to_one import ManyToOneReplacer
+from matchpy.expressions.functions import preorder_iter, preorder_iter_with_position
 from .common import *
 
 
@@ -23,7 +34,49 @@ def test_is_match(expr, pattern, do_match):
     assert is_match(expr, Pattern(pattern)) == do_match
 
 
+@pytest.mark.parametrize(
+    '   expr,                       pattern',
+    [
+        (f(a, b, c),                f(x___, b, y__)),
+        (f(a, b, c),                f(x__, a, y___)),
+        (f(a, b, b, c),             f(___, f2(x_), ___)),
+        (f(a, f2(b), c),            f(___, f2(x_), ___)),
+        (f(a, b),                   f(Wildcard.dot(), _s)),
+        (f(a, f2(b)),               f(Wildcard.dot(), _s)),
+        (f_c(a, b, f(c)),           f_c(f(x_), y__)),
+        (f_c(a, b, f(c)),           f_c(f(x_), y_)),
+        (f_c(a, b, f(c)),           f_c(f(x_), y_, z_)),
+        (f_c(f(a), f(b), f(a, b)),  f_c(f(x_), f(y_), f(z__))),
+        (f_c(f(a), f(b), f(a)),     f_c(f(x_), f(y_), f(z__))),
+        (f_c(f(a), f(a, b), c),     f_c(f(___, b), f(a, ___), c)),
+        (f(a, a),                   f(x_, x_)),
+        (f(a, b),                   f(x_, x_)),
+        (f_a(a, b, c),              f_a(x_, c)),
+        (f_i(a),                    f_i(x_, y___)),
+        (f_c(f(a), f_c()),          f_c(_s, x_)),
+        (f_c(f()),                  f_c(_ss)),
+        (f_c(a, s),                 f_c(_ss, x_)),
+    ]
+)  # yapf: disable
+def test_is_match_agrees_with_match(expr, pattern):
+    pattern = Pattern(pattern)
+    assert is_match(expr, pattern) == any(True for _ in match_one_to_one(expr, pattern))
+
+
+def test_is_match_many_operands():
+    expr = f_c(*(f(Symbol('s{}'.format(i))) for i in range(100)), *(f2(Symbol('s{}'.format(i))) for i in range(50)))
+    assert is_match(expr, Pattern(f_c(f2(x_), f2(y_), f(z_), ___)))
+    assert not is_match(expr, Pattern(f_c(*(f2(Wildcard.dot()) for _ in range(51)), ___)))
+    with pytest.raises(ValueError):
+        is_match(f(x_), Pattern(f(y_)))
+
+
+def compiled_substitute_wrapper(expression, substitution):
+    return compile_substitution(expression)(substitution)
+
+
 class TestSubstitute:
+    @pytest.mark.parametrize('substitute', [substitute, compiled_substitute_wrapper])
     @pytest.mark.parametrize(
         '   expression,                         substitution,           expected_result,    replaced',
         [
@@ -42,10 +95,12 @@ class TestSubstitute:
             (f(x_, y_),                         {'x': a, 'y': b},       f(a, b),            True),
             (f(x_, y_),                         {'x': [a, c], 'y': b},  f(a, c, b),         True),
             (f(x_, y_),                         {'x': a, 'y': [b, c]},  f(a, b, c),         True),
+            (f_c(x_, c),                        {'x': Multiset([b, a])},f_c(a, b, c),       True),
+            (f(f(x_), f(b)),                    {'x': a},               f(f(a), f(b)),      True),
             (Pattern(f(x_)),                    {'x': a},               f(a),               True)
         ]
     )  # yapf: disable
-    def test_substitute(self, expression, substitution, expected_result, replaced):
+    def test_substitute(self, substitute, expression, substitution, expected_result, replaced):
         result = substitute(expression, substitution)
         assert result == expected_result, "Substitution did not yield expected result"
         if replaced:
@@ -175,11 +230,15 @@ def test_match_error():
         next(match_one_to_one(f(x_), f(x_)))
 
 
-def _many_to_one_replace(expression, rules):
-    return ManyToOneReplacer(*rules).replace(expression)
+def _many_to_one_replace(expression, rules, strategy='leftmost-outermost'):
+    return ManyToOneReplacer(*rules).replace(expression, strategy=strategy)
+
+
+STRATEGIES = ['leftmost-outermost', 'parallel-outermost', 'innermost', 'bottom-up']
+
 
 @pytest.mark.parametrize(
-    'replacer', [replace_all, _many_to_one_replace]
+    'replacer', [replace_all] + [lambda e, r, s=s: _many_to_one_replace(e, r, s) for s in STRATEGIES[:2]]
 )
 def test_logic_simplify(replacer):
     LAnd = Operation.new('and', Arity.variadic, 'LAnd', associative=True, one_identity=True, commutative=True)
@@ -331,3 +390,563 @@ def test_logic_simplify(replacer):
     result = replacer(expression, rules)
 
     assert result == LBot
+
+
+def test_many_to_one_replacer_snapshot():
+    rule_a = ReplacementRule(Pattern(f(a)), lambda: b)
+    rule_b = ReplacementRule(Pattern(f(b)), lambda: c)
+    replacer = ManyToOneReplacer(rule_a)
+
+    new_replacer = replacer.snapshot()
+    new_replacer.add(rule_b)
+
+    assert replacer.replace(f(f(a))) == f(b)
+    assert new_replacer.replace(f(f(a))) == c
+
+    new_replacer.remove(rule_a)
+
+    assert replacer.replace(f(f(a))) == f(b)
+    assert new_replacer.replace(f(f(a))) == f(f(a))
+    assert new_replacer.replace(f(b)) == c
+
+
+@pytest.mark.parametrize(
+    '   general,            specific,               subsumed',
+    [
+        (f(x_),             f(x_),                  True),
+        (f(x_),             f(y_),                  True),
+        (f2(x_, x_),        f2(y_, y_),             True),
+        (f_c(x_, a),        f_c(a, y_),             True),
+        (f_a(x_, a),        f_a(y_, a),             True),
+        (f(_s),             f(_s),                  True),
+        (f(x_),             f(a),                   False),
+        (f2(x_, x_),        f2(a, y_),              False),
+        (f2(x_, y_),        f2(z_, z_),             False),
+        (f2(x_, a),         f2(a, x_),              False),
+        (f(x_),             f(f(x__)),              False),
+        (f(x__),            f(x_),                  False),
+        (f(x_),             f(x__),                 False),
+        (f(_s),             f(s),                   False),
+        (f(_s),             f(_ss),                 False),
+        (f(b),              f(SpecialSymbol('b')),  False),
+        (f_c(x_, a),        f_c(b, a),              False),
+    ]
+)  # yapf: disable
+def test_many_to_one_replacer_remove_subsumed(general, specific, subsumed):
+    general_rule = ReplacementRule(Pattern(general), lambda **kw: b)
+    specific_rule = ReplacementRule(Pattern(specific), lambda **kw: c)
+    replacer = ManyToOneReplacer(general_rule, specific_rule, remove_subsumed=True)
+
+    if subsumed:
+        assert replacer.subsumed_rules == [(specific_rule, general_rule)]
+        assert len(replacer.matcher.patterns) == 1
+    else:
+        assert replacer.subsumed_rules == []
+        assert len(replacer.matcher.patterns) == 2
+
+    # Removing the rules does not change the result of the replacement
+    full_replacer = ManyToOneReplacer(general_rule, specific_rule)
+    for subject in [f(a), f(b), f(s), f(SpecialSymbol('b')), f(f(a)), f2(a, a), f2(a, b), f_c(a, b), f_a(b, a)]:
+        assert replacer.replace(subject, max_count=1) == full_replacer.replace(subject, max_count=1)
+
+
+def test_many_to_one_replacer_remove_subsumed_keeps_specific_rules():
+    replacer = ManyToOneReplacer(
+        ReplacementRule(Pattern(f(x_, a)), lambda x: x),
+        ReplacementRule(Pattern(f(b, a)), lambda: c),
+        remove_subsumed=True
+    )
+
+    assert replacer.subsumed_rules == []
+    assert replacer.replace(f(b, a)) == c
+    assert replacer.replace(f(a, a)) == a
+
+
+def test_many_to_one_replacer_remove_subsumed_constraints():
+    constraint = CustomConstraint(lambda x: x != a)
+    constrained_rule = ReplacementRule(Pattern(f(x_), constraint), lambda x: b)
+    rule = ReplacementRule(Pattern(f(y_)), lambda y: c)
+    replacer = ManyToOneReplacer(constrained_rule, rule, remove_subsumed=True)
+
+    assert replacer.subsumed_rules == []
+    assert replacer.replace(f(a)) == c
+    assert replacer.replace(f(b)) == b
+
+    replacer = ManyToOneReplacer(rule, constrained_rule, remove_subsumed=True)
+    assert replacer.subsumed_rules == [(constrained_rule, rule)]
+    assert replacer.replace(f(b)) == c
+
+
+def test_many_to_one_replacer_remove_subsumed_update():
+    rule = ReplacementRule(Pattern(f(x_)), lambda x: b)
+    shadowed_rule = ReplacementRule(Pattern(f(y_)), lambda y: c)
+    replacer = ManyToOneReplacer(rule, shadowed_rule, remove_subsumed=True)
+
+    assert replacer.replace(f(a)) == b
+    snapshot = replacer.snapshot()
+
+    replacer.remove(rule)
+    assert replacer.subsumed_rules == []
+    assert replacer.replace(f(a)) == c
+    assert replacer.replace(f2(a)) == f2(a)
+
+    snapshot.remove(shadowed_rule)
+    assert snapshot.subsumed_rules == []
+    assert snapshot.replace(f(a)) == b
+    snapshot.remove(rule)
+    assert snapshot.replace(f(a)) == f(a)
+
+    # A removed rule that is added again keeps its index, so the shadowed rule does not take precedence over it
+    replacer.add(rule)
+    assert replacer.subsumed_rules == []
+    assert replacer.replace(f(a)) == b
+
+
+class _CountingMatcher:
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.subjects = []
+
+    def match(self, subject, budget=None):
+        self.subjects.append(subject)
+        return self.matcher.match(subject, budget)
+
+    def __getattr__(self, name):
+        return getattr(self.matcher, name)
+
+
+def _naive_many_to_one_replace(expression, rules):
+    matcher = _CountingMatcher(ManyToOneReplacer(*rules).matcher)
+    replaced = True
+    while replaced:
+        replaced = False
+        for subexpr, pos in preorder_iter_with_position(expression):
+            for replacement, subst in matcher.match(subexpr):
+                expression = replace(expression, pos, replacement(**subst))
+                replaced = True
+                break
+            if replaced:
+                break
+    return expression, len(matcher.subjects)
+
+
+@pytest.mark.parametrize(
+    '   expression,                                 expected_result',
+    [
+        (f2(f(a), b, f(f(a)), a),                   f2(b, b, c)),
+        (f2(f(b), f(f(b)), f(b)),                   f2(b)),
+        (f2(f2(f(b), a), f(c, f(b)), f2(a, f(a))),  f2(f2(c), c, f2(c, b))),
+        (f(f(f(a))),                                b),
+        (f(b),                                      f(b)),
+    ]
+)  # yapf: disable
+def test_many_to_one_replacer_incremental(expression, expected_result):
+    rules = [
+        ReplacementRule(Pattern(f(a)), lambda: b),
+        ReplacementRule(Pattern(f(f(b))), lambda: f(a)),
+        ReplacementRule(Pattern(f2(x___, f(b), y___)), lambda x, y: f2(*x, *y)),
+        ReplacementRule(Pattern(f(c, x_)), lambda x: c),
+        ReplacementRule(Pattern(f2(x___, a, y___)), lambda x, y: f2(*x, c, *y)),
+    ]
+    replacer = ManyToOneReplacer(*rules)
+    replacer.matcher = _CountingMatcher(replacer.matcher)
+
+    result = replacer.replace(expression)
+
+    naive_result, naive_match_count = _naive_many_to_one_replace(expression, rules)
+    assert result == expected_result
+    assert result == naive_result
+    assert len(replacer.matcher.subjects) <= naive_match_count
+
+
+def _counting_rules(call_counts):
+    def replace_a():
+        call_counts['a'] += 1
+        return b
+
+    def replace_f():
+        call_counts['f'] += 1
+        return f2(b)
+
+    return [ReplacementRule(Pattern(f(a)), replace_a), ReplacementRule(Pattern(f(b)), replace_f)]
+
+
+def test_replace_all_post_order_cache():
+    call_counts = {'a': 0, 'f': 0}
+    rules = _counting_rules(call_counts)
+    cache = LRUCache()
+
+    result = replace_all_post_order(f2(f(f(a)), f(f(a)), f(f(a))), rules, cache)
+
+    assert result == f2(f2(b), f2(b), f2(b))
+    assert call_counts == {'a': 1, 'f': 1}
+    assert cache.hits > 0
+
+    call_counts = {'a': 0, 'f': 0}
+    result = replace_all_post_order(f2(f(f(a)), f(f(a))), _counting_rules(call_counts), LRUCache(0))
+
+    assert result == f2(f2(b), f2(b))
+    assert call_counts == {'a': 2, 'f': 2}
+
+
+def test_many_to_one_replacer_post_order_cache():
+    call_counts = {'a': 0, 'f': 0}
+    rules = _counting_rules(call_counts)
+    replacer = ManyToOneReplacer(*rules)
+
+    assert replacer.replace_post_order(f2(f(f(a)), f(f(a)))) == f2(f2(b), f2(b))
+    assert replacer.replace_post_order(f(f(a))) == f2(b)
+    assert call_counts == {'a': 1, 'f': 1}
+    assert replacer.normal_form_cache.hits > 0
+
+    replacer.add(ReplacementRule(Pattern(f2(b)), lambda: c))
+
+    assert len(replacer.normal_form_cache) == 0
+    assert replacer.replace_post_order(f(f(a))) == c
+
+
+def test_post_order_cache_distinguishes_symbol_types():
+    # Symbol('b') == SpecialSymbol('b'), but only the latter is matched by the rule
+    subject = f2(Symbol('b'), SpecialSymbol('b'))
+    rule = ReplacementRule(Pattern(ss_), lambda ss: c)
+
+    assert replace_all_post_order(subject, [rule]) == f2(b, c)
+    assert ManyToOneReplacer(rule).replace_post_order(subject) == f2(b, c)
+
+
+@pytest.mark.parametrize('threshold', [0, 1000])
+@pytest.mark.parametrize('replacer', [replace_all, replace_all_post_order])
+def test_replace_all_many_to_one_dispatch(monkeypatch, threshold, replacer):
+    monkeypatch.setattr(functions, 'MANY_TO_ONE_THRESHOLD', threshold)
+    rules = [
+        ReplacementRule(Pattern(f(a, x_)), lambda x: f2(x)),
+        ReplacementRule(Pattern(f(x_, b)), lambda x: f2(x, x)),
+        ReplacementRule(Pattern(f_c(x_, y___)), lambda x, y: f2(x, *y)),
+        ReplacementRule(Pattern(f_c(a, x___)), lambda x: f2(*x)),
+        ReplacementRule(Pattern(f2(x_, x_)), lambda x: x),
+    ]
+
+    assert replacer(f(a, b), rules) == f2(b)
+    assert replacer(f(b, b), rules) == b
+    assert replacer(f(c, f(a, c)), rules) == f(c, f2(c))
+    assert replacer(f_c(a, b, c), rules) == replacer(f_c(a, b, c), rules[2:3])
+
+
+def _unrelated_rules(count):
+    return [ReplacementRule(Pattern(f2(Symbol('r{}'.format(i)), x_)), lambda x: x) for i in range(count)]
+
+
+@pytest.mark.parametrize('replacer', [replace_all, replace_all_post_order])
+def test_replace_all_many_to_one_unsupported_pattern(replacer):
+    # The many-to-one matcher does not support fixed size wildcards matching two expressions
+    rules = [ReplacementRule(Pattern(f_c(Wildcard(2, True))), lambda: a)] + _unrelated_rules(10)
+
+    assert replacer(f(f_c(b, c), f_c(b), f2(Symbol('r3'), c)), rules) == f(a, f_c(b), c)
+
+
+def test_replace_all_many_to_one_first_match():
+    rules = [ReplacementRule(Pattern(f_c(x__, y__)), lambda x, y: a)] + _unrelated_rules(9)
+    subject = f_c(*(Symbol('s{}'.format(i)) for i in range(16)))
+
+    # Enumerating all the 65534 matches would exceed the budget
+    assert replace_all(subject, rules, max_count=1, budget=Budget(max_steps=100)) == a
+
+
+def test_replace_all_head_index(monkeypatch):
+    rules = [
+        ReplacementRule(Pattern(f(a, x_)), lambda x: f2(x)),
+        ReplacementRule(Pattern(f2(x_, x_)), lambda x: x),
+        ReplacementRule(Pattern(f_i(x_, a)), lambda x: x),
+        ReplacementRule(Pattern(f(x_, b)), lambda x: f2(x, x)),
+        ReplacementRule(Pattern(ss_), lambda ss: a),
+        ReplacementRule(Pattern(c), lambda: d),
+    ]
+    index = functions._HeadIndex(rules)
+
+    assert index.candidates(f(a)) == [0, 2, 3]
+    assert index.candidates(f2(a)) == [1, 2]
+    assert index.candidates(a) == [2, 5]
+    assert index.candidates(s) == [2, 4, 5]
+
+    attempts = []
+
+    def _counting_match(subject, pattern, budget=None):
+        attempts.append((subject, pattern))
+        return match_one_to_one(subject, pattern, budget)
+
+    monkeypatch.setattr(functions, 'match', _counting_match)
+    assert replace_all(f2(f(c, b), s), rules) == f2(d, a)
+    assert all(type(subject) != f2 or pattern != rules[0].pattern for subject, pattern in attempts)
+    assert all(type(subject) != Symbol or pattern != rules[4].pattern for subject, pattern in attempts)
+    assert (f2(f(c, b), s), rules[1].pattern) in attempts
+
+
+@pytest.mark.parametrize('strategy', STRATEGIES)
+def test_many_to_one_replacer_strategies(strategy):
+    rules = [
+        ReplacementRule(Pattern(f(a)), lambda: b),
+        ReplacementRule(Pattern(f(b)), lambda: f(c)),
+        ReplacementRule(Pattern(f2(x___, c, y___)), lambda x, y: f2(*x, *y)),
+    ]
+    replacer = ManyToOneReplacer(*rules)
+
+    assert replacer.replace(f2(f(a), c, f(f(a)), f2(c)), strategy=strategy) == f2(b, f(c), f2())
+    assert replacer.replace(f2(a, b), strategy=strategy) == f2(a, b)
+
+
+def test_many_to_one_replacer_parallel_outermost():
+    replacer = ManyToOneReplacer(ReplacementRule(Pattern(f(x_)), lambda x: x))
+    replacer.matcher = _CountingMatcher(replacer.matcher)
+
+    result = replacer.replace(f2(f(f(a)), f(f(b)), f(c), f2(a, b)), strategy='parallel-outermost')
+
+    assert result == f2(a, b, c, f2(a, b))
+    # The second pass only matches the new parts of the expression and the last one only the root
+    assert len(replacer.matcher.subjects) == 7 + 4 + 1
+
+
+@pytest.mark.parametrize('strategy', ['leftmost-outermost', 'parallel-outermost', 'bottom-up'])
+def test_many_to_one_replacer_strategy_max_count(strategy):
+    replacer = ManyToOneReplacer(ReplacementRule(Pattern(f(x_)), lambda x: x))
+
+    result = replacer.replace(f2(f(f(a)), f(b)), max_count=2, strategy=strategy)
+
+    assert sum(1 for e in preorder_iter(result) if isinstance(e, f)) == 1
+
+
+def test_many_to_one_replacer_custom_strategy():
+    replacer = ManyToOneReplacer(ReplacementRule(Pattern(f(a)), lambda: b))
+
+    assert replacer.replace(f(a), strategy=lambda r, e, m: (r, e, m)) == (replacer, f(a), math.inf)
+    with pytest.raises(ValueError):
+        replacer.replace(f(a), strategy='unknown')
+
+
+def _cycling_rules():
+    return [
+        ReplacementRule(Pattern(f(a)), lambda: f(b)),
+        ReplacementRule(Pattern(f(b)), lambda: f(c)),
+        ReplacementRule(Pattern(f(c)), lambda: f(a)),
+        ReplacementRule(Pattern(f2(x_, a)), lambda x: x),
+    ]
+
+
+def _check_cycle_detection(rules, replace_with_detection):
+    assert replace_with_detection(f2(f(a), b), 'stop') == f2(f(a), b)
+    assert replace_with_detection(f2(f(c), a), 'stop') in (f(a), f(b), f(c))
+    assert replace_with_detection(f2(b, c), 'raise') == f2(b, c)
+    with pytest.raises(RewriteCycleError) as exc_info:
+        replace_with_detection(f2(b, f(b)), 'raise')
+    assert exc_info.value.expression == f2(b, f(b))
+    assert exc_info.value.rules == [rules[1], rules[2], rules[0]]
+    with pytest.raises(ValueError):
+        replace_with_detection(f(a), 'ignore')
+
+
+def test_replace_all_cycle_detection():
+    rules = _cycling_rules()
+    _check_cycle_detection(rules, lambda e, on_cycle: replace_all(e, rules, on_cycle=on_cycle))
+
+
+@pytest.mark.parametrize('strategy', ['leftmost-outermost', 'parallel-outermost', 'bottom-up'])
+def test_many_to_one_replacer_cycle_detection(strategy):
+    rules = _cycling_rules()
+    replacer = ManyToOneReplacer(*rules)
+    _check_cycle_detection(rules, lambda e, on_cycle: replacer.replace(e, strategy=strategy, on_cycle=on_cycle))
+
+
+def test_many_to_one_replacer_cycle_detection_unsupported():
+    replacer = ManyToOneReplacer(*_cycling_rules())
+    with pytest.raises(ValueError):
+        replacer.replace(f(a), strategy='innermost', on_cycle='stop')
+    with pytest.raises(ValueError):
+        replacer.replace(f(a), strategy=lambda r, e, m: e, on_cycle='stop')
+
+
+
+def test_replace_all_budget():
+    rules = [ReplacementRule(Pattern(a), lambda: b)]
+
+    with pytest.raises(BudgetExceeded) as exc_info:
+        replace_all(f(a, a, a, a), rules, budget=Budget(max_steps=5))
+    partial = exc_info.value.result
+    assert partial not in (f(a, a, a, a), f(b, b, b, b))
+    assert replace_all(partial, rules) == f(b, b, b, b)
+    assert replace_all(f(a, a, a, a), rules, budget=Budget(max_steps=100)) == f(b, b, b, b)
+
+    rules = [ReplacementRule(Pattern(f_c(x__, y__, z__)), lambda x, y, z: a)] * functions.MANY_TO_ONE_THRESHOLD
+    with pytest.raises(BudgetExceeded) as exc_info:
+        replace_all(f(f_c(a, b, c, d)), rules, budget=Budget(max_steps=10))
+    assert exc_info.value.result == f(f_c(a, b, c, d))
+
+
+@pytest.mark.parametrize('strategy', STRATEGIES)
+def test_many_to_one_replacer_budget(strategy):
+    replacer = ManyToOneReplacer(ReplacementRule(Pattern(a), lambda: b))
+
+    with pytest.raises(BudgetExceeded) as exc_info:
+        replacer.replace(f(a, f2(a, a), a), strategy=strategy, budget=Budget(max_steps=2))
+    partial = exc_info.value.result
+    if strategy == 'innermost':
+        assert partial is None
+    else:
+        assert replacer.replace(partial) == f(b, f2(b, b), b)
+    replacer.normal_form_cache.clear()
+    budget = Budget(max_steps=1000)
+    assert replacer.replace(f(a, f2(a, a), a), strategy=strategy, budget=budget) == f(b, f2(b, b), b)
+
+    with pytest.raises(ValueError):
+        replacer.replace(f(a), strategy=lambda r, e, m: e, budget=budget)
+
+
+def _profiled_rules():
+    return [
+        ReplacementRule(Pattern(f(a)), lambda: f2(b, c)),
+        ReplacementRule(Pattern(f2(x_, c)), lambda x: x),
+        ReplacementRule(Pattern(f(c)), lambda: c),
+    ]
+
+
+def _check_profile(profiler, rules, many_to_one):
+    statistics = [profiler.get(pattern, replacement) for pattern, replacement in rules]
+    assert [s.applications for s in statistics] == [2, 2, 0]
+    assert [s.growth for s in statistics] == [2, -4, 0]
+    assert statistics[0].matches == statistics[1].matches == 2
+    assert statistics[2].matches == 0
+    assert all(s.replacement_time >= 0 for s in statistics)
+    if many_to_one:
+        assert profiler.many_to_one_attempts > 0
+    else:
+        # The last rule is never tried, since the first rule matches all subexpressions with the same head first
+        assert [s.attempts > 0 for s in statistics] == [True, True, False]
+
+    data = json.loads(profiler.to_json())
+    assert [r['applications'] for r in data['rules'][:3]] == [2, 2, 0]
+    table = profiler.table().splitlines()
+    assert len(table) == 1 + len(profiler.rules) + (1 if profiler.many_to_one_attempts else 0)
+    assert 'Applications' in table[0]
+
+
+@pytest.mark.parametrize('threshold', [0, 1000])
+@pytest.mark.parametrize('replacer', [replace_all, replace_all_post_order])
+def test_replace_all_profiler(monkeypatch, threshold, replacer):
+    monkeypatch.setattr(functions, 'MANY_TO_ONE_THRESHOLD', threshold)
+    rules = _profiled_rules()
+    profiler = RuleProfiler()
+
+    # Without the cache, both occurrences of f(a) are replaced individually
+    kwargs = {'cache': LRUCache(0)} if replacer is replace_all_post_order else {}
+
+    assert replacer(f2(f(a), f(a)), rules, profiler=profiler, **kwargs) == f2(b, b)
+
+    _check_profile(profiler, rules, threshold == 0)
+
+
+@pytest.mark.parametrize('strategy', STRATEGIES)
+def test_many_to_one_replacer_profiler(strategy):
+    rules = _profiled_rules()
+    profiler = RuleProfiler()
+    replacer = ManyToOneReplacer(*rules, cache_size=0, profiler=profiler)
+
+    assert replacer.replace(f2(f(a), f(a)), strategy=strategy) == f2(b, b)
+
+    _check_profile(profiler, rules, True)
+
+
+def test_many_to_one_replacer_batch():
+    def _replace_f(x):
+        if x == c:
+            raise ValueError('c')
+        return f2(x)
+
+    replacer = ManyToOneReplacer(ReplacementRule(Pattern(f(x_)), _replace_f))
+    expressions = [f(a), f(b), f(c), f(f(a)), a, f2(f(b))] * 5
+
+    results = list(replacer.replace_batch(expressions, workers=2, chunksize=4))
+
+    assert len(results) == len(expressions)
+    for expression, result in zip(expressions, results):
+        if expression == f(c):
+            assert isinstance(result, ValueError)
+        else:
+            assert result == replacer.replace(expression)
+    sequential = list(replacer.replace_batch(expressions[:4], workers=1))
+    assert sequential[:2] == results[:2] and isinstance(sequential[2], ValueError)
+
+
+def _commutative_subject_count(replacer):
+    return sum(len(m.subjects) for m in replacer.matcher.commutative_matchers.values())
+
+
+def test_many_to_one_replacer_stream():
+    replacer = ManyToOneReplacer(ReplacementRule(Pattern(f_c(a, x_)), lambda x: f(x)))
+    expressions = [f_c(a, Symbol('s{}'.format(i))) for i in range(10)]
+    results = replacer.replace_stream(iter(expressions), reset_interval=3)
+
+    for i, result in enumerate(results):
+        assert result == f(Symbol('s{}'.format(i)))
+        # The optional operand (None), the symbol a and at most three symbols s_i
+        assert _commutative_subject_count(replacer) <= 5
+
+    list(replacer.replace_stream(expressions, reset_interval=None))
+    assert _commutative_subject_count(replacer) == 12
+
+
+def test_many_to_one_replacer_stream_parallel():
+    def _replace_f(x):
+        if x == c:
+            raise ValueError('c')
+        return f2(x)
+
+    replacer = ManyToOneReplacer(ReplacementRule(Pattern(f(x_)), _replace_f))
+    expressions = [f(a), f(b), f(f(a)), a, f2(f(b))] * 10
+
+    results = list(replacer.replace_stream(iter(expressions), workers=2, chunksize=3, reset_interval=4))
+    assert results == [replacer.replace(e) for e in expressions]
+
+    with pytest.raises(ValueError):
+        list(replacer.replace_stream(expressions + [f(c)], workers=2, chunksize=3))
+
+
+@pytest.mark.parametrize(
+    '   template,           substitution,                   expected_result',
+    [
+        (a,                 {'x': b},                       a),
+        (x_,                {'x': b},                       b),
+        (x_,                {'x': [a, b]},                  [a, b]),
+        (f(x_, c),          {'x': [a, b]},                  f(a, b, c)),
+        (f(x_, c),          {'x': Multiset([b, a, b])},     f(a, b, b, c)),
+        (f(x_, y_),         {'x': a},                       f(a, y_)),
+        (f(f2(x_), f(b)),   {'x': a},                       f(f2(a), f(b))),
+        (f_c(x_, b),        {'x': [c, a]},                  f_c(a, b, c)),
+        (f(x_, y_),         {'x': [], 'y': a},              f(a)),
+    ]
+)  # yapf: disable
+def test_template(template, substitution, expected_result):
+    template_replacement = Template(template)
+    result = template_replacement.substitute(substitution)
+    assert result == expected_result
+    assert result == substitute(template, substitution)
+    assert template_replacement(**substitution) == expected_result
+
+
+def test_template_reuses_constant_subexpressions():
+    constant = f2(f(b), c)
+    template = Template(Pattern(f(x_, constant)))
+    result = template.substitute({'x': a})
+    assert result == f(a, constant)
+    assert result.operands[1] is constant
+    assert template.substitute({}) is template.template
+    assert Template(constant).substitute({'x': a}) is constant
+
+
+@pytest.mark.parametrize(
+    'replacer', [replace_all, replace_all_post_order] +
+    [lambda e, r, s=s: ManyToOneReplacer(*r).replace(e, strategy=s) for s in STRATEGIES]
+)
+def test_template_rules(replacer):
+    rules = [
+        ReplacementRule(Pattern(f(x_, y_)), Template(f2(y_, x_))),
+        ReplacementRule(Pattern(f2(x___, a, y___)), Template(f2(y___, x___))),
+    ]
+    assert replacer(f(a, f(b, c)), rules) == f2(f2(c, b))
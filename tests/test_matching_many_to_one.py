@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
+import itertools
+
 import pytest
+from multiset import Multiset
 
 from matchpy.expressions.constraints import CustomConstraint
 from matchpy.expressions.expressions import Symbol, Pattern, Operation, Arity, Wildcard
-from matchpy.matching.many_to_one import ManyToOneMatcher
+from matchpy.expressions.functions import _ExpressionKey
+from matchpy.matching.many_to_one import ManyToOneMatcher, _union_iter
+from matchpy.expressions.substitution import Substitution
+from matchpy.matching.one_to_one import match as match_one_to_one, count_matches, match_anywhere
+from matchpy.functions import replace, replace_many
+from matchpy.utils import Budget, BudgetExceeded
 from .common import *
 from .utils import MockConstraint
 
@@ -149,6 +157,39 @@ def test_same_commutative_but_different_pattern():
     assert result == [(pattern2, {'x': a})]
 
 
+def test_many_patterns_with_constraints():
+    def equals(symbol):
+        return CustomConstraint(lambda x: x == symbol)
+
+    symbols = [Symbol('s{}'.format(i)) for i in range(100)]
+    patterns = [Pattern(f(s, x_), equals(s)) for s in symbols]
+    matcher = ManyToOneMatcher(*patterns)
+
+    for i in (0, 63, 64, 99):
+        result = list(matcher.match(f(symbols[i], symbols[i])))
+        assert result == [(patterns[i], {'x': symbols[i]})]
+
+    assert list(matcher.match(f(symbols[1], symbols[2]))) == []
+
+
+@pytest.mark.parametrize('rename', [True, False])
+@pytest.mark.parametrize('constraint_result', [True, False])
+def test_global_constraint(rename, constraint_result):
+    constraint = MockConstraint(constraint_result)
+    matcher = ManyToOneMatcher(rename=rename)
+    matcher.add(Pattern(f(x_, y_), constraint), 1)
+    matcher.add(Pattern(f(x_, b)), 2)
+
+    results = sorted(matcher.match(f(a, b)))
+
+    expected = [(2, {'x': a})]
+    if constraint_result:
+        expected.insert(0, (1, {'x': a, 'y': b}))
+    assert results == expected
+    assert constraint.call_count == 1
+    constraint.assert_called_with({'x': a, 'y': b})
+
+
 def test_grouped():
     pattern1 = Pattern(a, MockConstraint(True))
     pattern2 = Pattern(a, MockConstraint(True))
@@ -260,3 +301,430 @@ def test_many_to_one(subject, patterns):
     assert matches == [], "Subject {!s} and pattern {!s} yielded unexpected matches".format(
         subject, pattern
     )
+
+
+def _sorted_matches(matcher, subject):
+    return sorted((str(l), str(s)) for l, s in matcher.match(subject))
+
+
+MERGE_PATTERNS = [
+    Pattern(f(a, x_)),
+    Pattern(f(y_, b)),
+    Pattern(f(x_, y_), CustomConstraint(lambda x, y: x != y)),
+    Pattern(f(f_c(x_, a), y___)),
+    Pattern(f(f_c(x_, b), y___)),
+    Pattern(f_ac(x_, f2(y_), z___)),
+    Pattern(f_c(x_, y_, a)),
+    Pattern(f_c(x__, b)),
+]
+
+MERGE_SUBJECTS = [
+    f(a, b),
+    f(b, b),
+    f(f_c(a, b)),
+    f(f_c(a, a), c),
+    f_ac(a, f2(b), c),
+    f_c(a, b, c),
+    f_c(b, a),
+    f_c(b, b, b),
+]
+
+
+@pytest.mark.parametrize('split', range(len(MERGE_PATTERNS) + 1))
+def test_merge(split):
+    expected = ManyToOneMatcher(*MERGE_PATTERNS)
+    matcher1 = ManyToOneMatcher(*MERGE_PATTERNS[:split])
+    matcher2 = ManyToOneMatcher(*MERGE_PATTERNS[split:])
+    for subject in MERGE_SUBJECTS:
+        list(matcher1.match(subject))
+
+    matcher1.merge(matcher2)
+
+    assert [p for p, _, _ in matcher1.patterns] == MERGE_PATTERNS
+    for subject in MERGE_SUBJECTS:
+        assert _sorted_matches(matcher1, subject) == _sorted_matches(expected, subject)
+
+
+def test_merge_duplicate_patterns():
+    matcher1 = ManyToOneMatcher(*MERGE_PATTERNS[:5])
+    matcher2 = ManyToOneMatcher(*MERGE_PATTERNS[3:])
+    expected = ManyToOneMatcher(*MERGE_PATTERNS)
+
+    matcher = ManyToOneMatcher.union(matcher1, matcher2)
+
+    assert len(matcher.patterns) == len(MERGE_PATTERNS)
+    for subject in MERGE_SUBJECTS:
+        assert _sorted_matches(matcher, subject) == _sorted_matches(expected, subject)
+
+
+def test_merge_does_not_modify_other():
+    matcher1 = ManyToOneMatcher(*MERGE_PATTERNS[:4])
+    matcher2 = ManyToOneMatcher(*MERGE_PATTERNS[4:])
+    expected = ManyToOneMatcher(*MERGE_PATTERNS[4:])
+
+    matcher1.merge(matcher2)
+    matcher1.add(Pattern(f_c(x_, c)))
+
+    for subject in MERGE_SUBJECTS:
+        assert _sorted_matches(matcher2, subject) == _sorted_matches(expected, subject)
+
+
+def test_merge_skips_constraints_of_duplicate_patterns():
+    matcher1 = ManyToOneMatcher(*MERGE_PATTERNS)
+    matcher2 = ManyToOneMatcher(*MERGE_PATTERNS[:3])
+    constraint_count = len(matcher1.constraints)
+
+    matcher1.merge(matcher2)
+
+    assert len(matcher1.patterns) == len(MERGE_PATTERNS)
+    assert len(matcher1.constraints) == constraint_count
+
+
+@pytest.mark.parametrize('split', range(len(MERGE_PATTERNS) + 1))
+def test_snapshot(split):
+    old_expected = ManyToOneMatcher(*MERGE_PATTERNS[:split])
+    new_expected = ManyToOneMatcher(*MERGE_PATTERNS[:split], *MERGE_PATTERNS[split:][::-1])
+    matcher = ManyToOneMatcher(*MERGE_PATTERNS[:split])
+    for subject in MERGE_SUBJECTS:
+        list(matcher.match(subject))
+
+    new_matcher = matcher.snapshot()
+    for pattern in reversed(MERGE_PATTERNS[split:]):
+        new_matcher.add(pattern)
+
+    for subject in MERGE_SUBJECTS:
+        assert _sorted_matches(matcher, subject) == _sorted_matches(old_expected, subject)
+        assert _sorted_matches(new_matcher, subject) == _sorted_matches(new_expected, subject)
+
+
+def test_snapshot_modify_both_versions():
+    matcher = ManyToOneMatcher(*MERGE_PATTERNS[:4])
+    new_matcher = matcher.snapshot()
+
+    matcher.add(MERGE_PATTERNS[4])
+    new_matcher.add(MERGE_PATTERNS[5])
+
+    for subject in MERGE_SUBJECTS:
+        assert _sorted_matches(matcher, subject) == _sorted_matches(ManyToOneMatcher(*MERGE_PATTERNS[:5]), subject)
+        assert _sorted_matches(new_matcher, subject) == _sorted_matches(
+            ManyToOneMatcher(*MERGE_PATTERNS[:4], MERGE_PATTERNS[5]), subject
+        )
+
+
+def test_snapshot_ongoing_match():
+    matcher = ManyToOneMatcher(Pattern(f(a, x_)), Pattern(f(x_, y_)))
+    matches = iter(matcher.match(f(a, b)))
+    assert next(matches) is not None
+
+    new_matcher = matcher.snapshot()
+    new_matcher.add(Pattern(f(y_, b)))
+    new_matcher.remove(Pattern(f(x_, y_)))
+
+    assert len(list(matches)) == 1
+    assert len(list(matcher.match(f(a, b)))) == 2
+    assert _sorted_matches(new_matcher, f(a, b)) == [('f(a, x_)', '{x ↦ b}'), ('f(y_, b)', '{y ↦ a}')]
+
+
+def test_remove():
+    matcher = ManyToOneMatcher(*MERGE_PATTERNS)
+
+    for pattern in MERGE_PATTERNS[::2]:
+        matcher.remove(pattern)
+
+    for subject in MERGE_SUBJECTS:
+        assert _sorted_matches(matcher, subject) == _sorted_matches(ManyToOneMatcher(*MERGE_PATTERNS[1::2]), subject)
+    with pytest.raises(ValueError):
+        matcher.remove(MERGE_PATTERNS[0])
+
+    for pattern in MERGE_PATTERNS[::2]:
+        matcher.add(pattern)
+
+    assert len(matcher.patterns) == len(MERGE_PATTERNS)
+    for subject in MERGE_SUBJECTS:
+        assert _sorted_matches(matcher, subject) == _sorted_matches(ManyToOneMatcher(*MERGE_PATTERNS), subject)
+
+
+def test_shared_commutative_matcher():
+    matcher = ManyToOneMatcher(Pattern(f(f_c(x_, a))), Pattern(f2(f_c(x_, b))), Pattern(f_c(x_, a)))
+
+    commutative_states = [state for state in matcher.states.values() if state.matcher is not None]
+    assert len(commutative_states) == 3
+    assert all(state.matcher is matcher.commutative_matchers[f_c] for state in commutative_states)
+    assert _sorted_matches(matcher, f(f_c(a, b))) == [('f(f_c(a, x_))', '{x ↦ b}')]
+    assert _sorted_matches(matcher, f2(f_c(a, b))) == [('f2(f_c(b, x_))', '{x ↦ a}')]
+    assert _sorted_matches(matcher, f_c(a, b)) == [('f_c(a, x_)', '{x ↦ b}')]
+
+
+@pytest.mark.parametrize(
+    'subject',
+    [a, f(a), f_c(a, b, c), f_c(a, c), f_c(a), f_c(f(a), f(b), c), f_c(f(c), a, a), f2(f_c(a, b), f_c(c, a))]
+)
+def test_matched_pattern_indices(subject):
+    matcher = ManyToOneMatcher(
+        Pattern(f_c(x__, y__)),
+        Pattern(f_c(a, x__)),
+        Pattern(f_c(x_, y_), CustomConstraint(lambda x, y: x == c)),
+        Pattern(f_c(f(x_), ___)),
+        Pattern(f_c(f(x_), f(x_), ___)),
+        Pattern(f2(f_c(x_, ___), f_c(x_, ___))),
+        Pattern(f(x_)),
+        Pattern(x_),
+    )
+    expected = sorted(set(pattern_index for pattern_index, _ in matcher.match(subject).indexed()))
+
+    assert matcher.match(subject).matched_pattern_indices() == expected
+
+
+def test_match_cache():
+    matcher = ManyToOneMatcher(Pattern(f(a, x_)), Pattern(f_c(x__, y__)), cache_size=2)
+    subject = f_c(a, b, c)
+
+    first = list(matcher.match(subject))
+    first[0][1]['z'] = a
+    second = list(matcher.match(subject))
+
+    assert len(second) == 6
+    assert all('z' not in substitution for _, substitution in second)
+    assert matcher.count(subject) == 6
+    assert matcher.is_match(subject)
+    assert matcher.match_cache.cache_info() == (3, 1, 2, 1)
+
+    list(matcher.match(f(a, b)))
+    list(matcher.match(f(a, c)))
+    assert _ExpressionKey(subject) not in matcher.match_cache
+    assert len(matcher.match_cache) == 2
+
+
+def test_match_cache_incomplete_iteration():
+    matcher = ManyToOneMatcher(Pattern(f_c(x__, y__)), cache_size=10)
+    subject = f_c(a, b, c)
+
+    next(iter(matcher.match(subject)))
+    assert _ExpressionKey(subject) not in matcher.match_cache
+
+    with pytest.raises(BudgetExceeded):
+        list(matcher.match(subject, Budget(max_steps=3)))
+    assert _ExpressionKey(subject) not in matcher.match_cache
+
+    assert len(list(matcher.match(subject))) == 6
+    assert _ExpressionKey(subject) in matcher.match_cache
+
+
+def test_match_cache_distinguishes_symbol_types():
+    matcher = ManyToOneMatcher(Pattern(f(ss_)), cache_size=10)
+
+    # Symbol('b') == SpecialSymbol('b'), but only the latter is matched by the pattern
+    assert list(matcher.match(f(Symbol('b')))) == []
+    assert [str(s) for _, s in matcher.match(f(SpecialSymbol('b')))] == ['{ss ↦ b}']
+    assert not matcher.is_match(f(Symbol('b')))
+    assert matcher.count(f(SpecialSymbol('b'))) == 1
+
+
+@pytest.mark.parametrize(
+    '   modify,                                                 expected',
+    [
+        (lambda m: m.add(Pattern(f(x_, b))),                    ['f(a, x_)', 'f(x_, b)']),
+        (lambda m: m.remove(Pattern(f(a, x_))),                 []),
+        (lambda m: m.merge(ManyToOneMatcher(Pattern(f(x_, b)))), ['f(a, x_)', 'f(x_, b)']),
+    ]
+)  # yapf: disable
+def test_match_cache_invalidation(modify, expected):
+    matcher = ManyToOneMatcher(Pattern(f(a, x_)), cache_size=10)
+    list(matcher.match(f(a, b)))
+    snapshot = matcher.snapshot()
+
+    modify(matcher)
+
+    assert len(matcher.match_cache) == 0
+    assert sorted(str(p) for p, _ in matcher.match(f(a, b))) == expected
+    assert [str(p) for p, _ in snapshot.match(f(a, b))] == ['f(a, x_)']
+    assert len(snapshot.match_cache) == 1
+
+
+def test_budget():
+    subject = f_c(*(Symbol('s{}'.format(i)) for i in range(6)))
+    pattern = Pattern(f_c(x__, y__, z__))
+    matcher = ManyToOneMatcher(pattern)
+
+    with pytest.raises(BudgetExceeded):
+        list(matcher.match(subject, Budget(max_steps=50)))
+    with pytest.raises(BudgetExceeded):
+        list(match_one_to_one(subject, pattern, Budget(max_steps=50)))
+
+    # The matcher is still usable after it was aborted
+    count = sum(1 for _ in matcher.match(subject))
+    assert count == 3**6 - 3 * 2**6 + 3
+    budget = Budget(max_steps=10**6)
+    assert sum(1 for _ in matcher.match(subject, budget)) == count
+    assert 0 < budget.steps < 10**6
+
+
+def test_budget_nested_commutative():
+    matcher = ManyToOneMatcher(Pattern(f(f_c(x__, y__))))
+
+    with pytest.raises(BudgetExceeded):
+        list(matcher.match(f(f_c(*(Symbol('s{}'.format(i)) for i in range(10)))), Budget(max_steps=20)))
+    assert len(list(matcher.match(f(f_c(a, b))))) == 2
+
+
+def _union_all(substitution, substitution_lists):
+    for substitutions in itertools.product(*substitution_lists):
+        try:
+            yield substitution.union(*substitutions)
+        except ValueError:
+            pass
+
+
+@pytest.mark.parametrize(
+    '   substitution,           substitution_lists',
+    [
+        ({},                    []),
+        ({'x': a},              []),
+        ({},                    [[]]),
+        ({},                    [[{'x': a}, {'x': b}], [{'y': a}, {'x': b, 'y': b}, {'x': a}]]),
+        ({'x': a},              [[{'x': a}, {'x': b}], [{'y': a}, {'x': b, 'y': b}]]),
+        ({},                    [[{'x': a, 'y': b}, {'x': b}], [{'y': a}, {}], [{'x': b, 'y': a}, {'y': b}]]),
+        ({'x': Multiset([a])},  [[{'x': (a, )}, {'x': (b, )}], [{'x': Multiset([a])}]]),
+    ]
+)  # yapf: disable
+def test_union_iter(substitution, substitution_lists):
+    substitution = Substitution(substitution)
+    substitution_lists = [[Substitution(s) for s in substitutions] for substitutions in substitution_lists]
+    original = Substitution(substitution)
+
+    results = list(_union_iter(substitution, substitution_lists))
+
+    assert results == list(_union_all(substitution, substitution_lists))
+    assert substitution == original
+
+
+def test_commutative_match_many_operands():
+    subject = f_c(*(f(Symbol('s{}'.format(i)), Symbol('s{}'.format(i % 3))) for i in range(9)))
+    pattern = Pattern(f_c(f(x_, y_), f(z_, y_), f(_, y_), ___))
+
+    many_to_one = {str(s) for _, s in ManyToOneMatcher(pattern).match(subject)}
+
+    assert many_to_one == {str(s) for s in match_one_to_one(subject, pattern)}
+    assert len(many_to_one) == 3 * 3 * 2
+
+
+@pytest.mark.parametrize(
+    '   pattern',
+    [
+        f_c(x__, y__),
+        f_c(x_, y___),
+        f_c(x_, x_, y___),
+        f_c(x__, x__, y___),
+        f_c(a, x__, y___),
+        f_c(f_c(x__, y__), z___),
+        f_ac(x__, y___),
+        f(x___, f_c(y__, z___)),
+        f(x_, f_c(x_, y__)),
+        Pattern(f_c(x__, y__), CustomConstraint(lambda x: len(x) > 1)),
+        Pattern(f_c(x_, y__), CustomConstraint(lambda y: len(y) > 1)),
+    ]
+)  # yapf: disable
+@pytest.mark.parametrize(
+    '   subject',
+    [
+        f_c(),
+        f_c(a, a, b),
+        f_c(a, b, b, c, f_c(a, b)),
+        f_ac(a, a, b, c),
+        f(a, f_c(a, a, b, c)),
+        f(a, b, f_c(a, b, c)),
+    ]
+)  # yapf: disable
+def test_count(pattern, subject):
+    if not isinstance(pattern, Pattern):
+        pattern = Pattern(pattern)
+    assert count_matches(subject, pattern) == len(list(match_one_to_one(subject, pattern)))
+    for matcher in [ManyToOneMatcher(pattern), ManyToOneMatcher(pattern, Pattern(f_c(x___, b)))]:
+        assert matcher.count(subject) == len(list(matcher.match(subject)))
+
+
+@pytest.mark.parametrize(
+    '   subject,        is_match',
+    [
+        (f(a, b),       True),
+        (f(b, a),       False),
+        (f2(a),         False),
+        (f2(b),         True),
+        (f_c(a, b),     False),
+        (f_c(a, b, b),  True),
+    ]
+)  # yapf: disable
+def test_is_match(subject, is_match):
+    constraint = CustomConstraint(lambda x: x == b)
+    matcher = ManyToOneMatcher(Pattern(f(a, x_)), Pattern(f2(x_), constraint), Pattern(f_c(x_, x_, ___)))
+
+    assert matcher.is_match(subject) == is_match
+
+
+def test_count_many_operands():
+    subject = f_c(*(Symbol('s{}'.format(i)) for i in range(60)), a, b, b)
+    matcher = ManyToOneMatcher(Pattern(f_c(a, x__, y___)), Pattern(f(x_, y__)))
+
+    assert matcher.count(subject) == 3 * 2**60 - 1
+    assert count_matches(subject, Pattern(f_c(a, x__, y___))) == 3 * 2**60 - 1
+    assert ManyToOneMatcher(Pattern(f_c(x_, x_, y___))).count(subject) == 1
+    with pytest.raises(BudgetExceeded):
+        ManyToOneMatcher(Pattern(f_c(x_, y__))).count(subject, Budget(max_steps=3))
+
+
+def test_match_anywhere():
+    patterns = [Pattern(f(x_)), Pattern(f_c(x_, y___)), Pattern(f2(a, x__))]
+    subject = f(f_c(a, f2(a, b), f(c)), f2(a, f(b)))
+    matcher = ManyToOneMatcher(*patterns)
+
+    matches = matcher.match_anywhere(subject)
+
+    expected = sorted(
+        (str(pattern), str(substitution), position) for pattern in patterns
+        for substitution, position in match_anywhere(subject, pattern)
+    )
+    assert sorted((str(p), str(s), position) for p, s, position in matches) == expected
+    assert len(matches) == len(expected)
+    assert [str(p) for p, _ in matches.at((1, ))] == ['f2(a, x__)']
+    with pytest.raises(IndexError):
+        matches.at((0, 5))
+
+
+@pytest.mark.parametrize(
+    '   edit,                                                                   matched_again',
+    [
+        (lambda e: (replace(e, (0, 1), f(c)), [(0, 1)]),                        3),
+        (lambda e: (replace(e, (0, 1), [f(c), f(a)]), [(0, 1)]),                4),
+        (lambda e: (replace(e, (1, 0), f_c(a, b, b)), [(1, 0)]),                1),
+        (lambda e: (replace_many(e, [((0, 0), c), ((2, ), f(b))]), [(0, 0), (2, )]), 3),
+        (lambda e: (replace(e, (), f(a)), [()]),                                1),
+    ]
+)  # yapf: disable
+def test_subject_matches_update(edit, matched_again):
+    calls = []
+    constraint = CustomConstraint(lambda x: calls.append(x) or True)
+    matcher = ManyToOneMatcher(Pattern(f(x_), constraint), Pattern(f_c(x_, y___)))
+    matches = matcher.match_anywhere(f(f(a, f(b)), f_c(f(a), c), f(c)))
+    old_matches = sorted((str(p), str(s), position) for p, s, position in matches)
+
+    new_subject, edited_positions = edit(matches.subject)
+    # The constraint is checked once for every operation f that is matched again
+    del calls[:]
+    new_matches = matches.update(new_subject, edited_positions)
+
+    assert len(calls) == matched_again
+    assert sorted((str(p), str(s), position) for p, s, position in new_matches) == \
+        sorted((str(p), str(s), position) for p, s, position in matcher.match_anywhere(new_subject))
+    assert sorted((str(p), str(s), position) for p, s, position in matches) == old_matches
+
+
+def test_subject_matches_update_after_pattern_change():
+    matcher = ManyToOneMatcher(Pattern(f(x_)))
+    matches = matcher.match_anywhere(f(f(a), f(b)))
+
+    matcher.add(Pattern(f(a)))
+    new_matches = matches.update(replace(matches.subject, (1, ), f(c)), [(1, )])
+
+    assert sorted((str(p), position) for p, _, position in new_matches) == [
+        ('f(a)', (0, )), ('f(x_)', (0, )), ('f(x_)', (1, ))
+    ]
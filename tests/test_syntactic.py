@@ -6,9 +6,13 @@ import hypothesis.strategies as st
 import pytest
 
 from matchpy.expressions.expressions import Atom, Operation, Symbol, Wildcard, Pattern
-from matchpy.matching.one_to_one import match
+from matchpy.expressions.constraints import CustomConstraint
+from matchpy.expressions.functions import preorder_iter_with_position
+from matchpy.matching.one_to_one import match, match_anywhere
 from matchpy.matching.syntactic import OPERATION_END as OP_END
-from matchpy.matching.syntactic import DiscriminationNet, FlatTerm, SequenceMatcher, is_operation, is_symbol_wildcard
+from matchpy.matching.syntactic import (
+    BottomUpMatcher, DiscriminationNet, FlatTerm, SequenceMatcher, is_operation, is_symbol_wildcard
+)
 from .common import *
 
 CONSTANT_EXPRESSIONS = [e for e in [a, b, c, d]]
@@ -322,6 +326,81 @@ def test_product_net(i):
                 assert pattern in result, "Pattern {!s} should match subject {!s}".format(pattern, expression)
 
 
+BOTTOM_UP_PATTERNS = [
+    Pattern(f(a, x_)),
+    Pattern(f(x_, x_)),
+    Pattern(f(f2(x_), y_)),
+    Pattern(f2(_s)),
+    Pattern(f2(ss_)),
+    Pattern(a),
+    Pattern(f(x_, b), CustomConstraint(lambda x: x != c)),
+    Pattern(f_u(x_)),
+    Pattern(x_),
+]
+
+BOTTOM_UP_SUBJECTS = [
+    a,
+    s,
+    f(a, a),
+    f(f2(a), b),
+    f(f(a, b), f(a, b)),
+    f2(s),
+    f(c, b),
+    f(f2(f2(b)), f_u(f2(a))),
+    f_c(f(a, a), f2(c)),
+]
+
+
+@pytest.mark.parametrize('subject', BOTTOM_UP_SUBJECTS)
+def test_bottom_up_matcher(subject):
+    matcher = BottomUpMatcher(*BOTTOM_UP_PATTERNS)
+
+    for _ in range(2):
+        result = list(matcher.match_anywhere(subject))
+        expected = [
+            (pattern, subst, pos)
+            for pos in sorted(pos for _, pos in preorder_iter_with_position(subject))
+            for pattern in BOTTOM_UP_PATTERNS
+            for subst, match_pos in match_anywhere(subject, pattern) if match_pos == pos
+        ]
+        assert result == expected
+
+    assert list(matcher.match(subject)) == [(p, s) for p, s, pos in expected if pos == ()]
+    assert [pos for pos, _ in matcher.label(subject)] == sorted(set(pos for _, _, pos in expected))
+
+
+def _random_bottom_up_subject(rng, depth):
+    if depth == 0 or rng.random() < 0.3:
+        # Symbols of different classes with the same name are equal, but not matched by the same patterns
+        return rng.choice([a, b, SpecialSymbol('a'), SpecialSymbol('b'), s, Symbol('s')])
+    operation = rng.choice([f, f2, f_u])
+    operand_count = 1 if operation is f_u else rng.randint(0, 3)
+    return operation(*(_random_bottom_up_subject(rng, depth - 1) for _ in range(operand_count)))
+
+
+def test_bottom_up_matcher_randomized():
+    patterns = BOTTOM_UP_PATTERNS + [Pattern(f(ss_, b)), Pattern(f2(a, _ss)), Pattern(f_u(s))]
+    matcher = BottomUpMatcher(*patterns)
+    rng = random.Random(42)
+
+    for _ in range(300):
+        subject = _random_bottom_up_subject(rng, 4)
+        result = list(matcher.match_anywhere(subject))
+        expected = [
+            (pattern, subst, pos)
+            for pos in sorted(pos for _, pos in preorder_iter_with_position(subject))
+            for pattern in patterns
+            for subst, match_pos in match_anywhere(subject, pattern) if match_pos == pos
+        ]
+        assert result == expected, str(subject)
+
+
+@pytest.mark.parametrize('pattern', [f(x__), f(___), f_c(x_), f_a(a), f(Wildcard(2, True)), f(Wildcard.optional('x', a))])
+def test_bottom_up_matcher_non_syntactic(pattern):
+    with pytest.raises(ValueError):
+        BottomUpMatcher(Pattern(pattern))
+
+
 def test_sequence_matcher_match():
     PATTERNS = [
         Pattern(f(___, x_, x_, ___)),
@@ -9,8 +9,9 @@ from multiset import Multiset
 
 from matchpy.utils import (
     VariableWithCount, base_solution_linear, cached_property, commutative_sequence_variable_partition_iter,
+    commutative_sequence_variable_partition_count,
     extended_euclid, fixed_integer_vector_iter, get_short_lambda_source, weak_composition_iter, slot_cached_property,
-    solve_linear_diop
+    solve_linear_diop, LRUCache, Budget, BudgetExceeded
 )
 
 
@@ -340,3 +341,125 @@ def test_slot_cached_property():
     assert b.example == 42
     assert A.call_count == 2
     assert A.example.__doc__ == "Docstring Test"
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+
+    cache[1] = 'a'
+    cache[2] = 'b'
+    assert cache.get(1) == 'a'
+    cache[3] = 'c'
+
+    assert 1 in cache
+    assert 2 not in cache
+    assert cache.get(2) is None
+    assert cache.get(3) == 'c'
+    assert cache.cache_info() == (2, 1, 2, 2)
+
+    cache.clear()
+
+    assert len(cache) == 0
+    assert cache.cache_info() == (0, 0, 2, 0)
+
+
+def test_lru_cache_disabled():
+    cache = LRUCache(0)
+
+    cache[1] = 'a'
+
+    assert len(cache) == 0
+    assert cache.get(1, 'default') == 'default'
+
+
+def test_lru_cache_memory():
+    cache = LRUCache(10, maxmemory=6, sizeof=len)
+
+    cache[1] = 'aaa'
+    cache[2] = 'bb'
+    assert cache.memory == 5
+    cache[1] = 'a'
+    assert cache.memory == 3
+    cache[3] = 'cccc'
+
+    assert 2 not in cache
+    assert cache.get(1) == 'a'
+    assert cache.get(3) == 'cccc'
+    assert cache.memory == 5
+
+    cache[4] = 'ddddddd'
+    assert 4 not in cache
+    assert len(cache) == 2
+
+    cache.clear(statistics=False)
+    assert cache.memory == 0
+    assert cache.cache_info() == (2, 0, 10, 0)
+
+
+def test_commutative_sequence_variable_partition_iter_independent_results():
+    x = VariableWithCount('x', 1, 1, None)
+    y = VariableWithCount('y', 2, 0, None)
+
+    results = list(commutative_sequence_variable_partition_iter(Multiset('aaabbc'), [x, y]))
+
+    assert sorted((sorted(r['x']), sorted(r['y'])) for r in results) == [
+        (['a', 'a', 'a', 'b', 'b', 'c'], []),
+        (['a', 'a', 'a', 'c'], ['b']),
+        (['a', 'b', 'b', 'c'], ['a']),
+        (['a', 'c'], ['a', 'b']),
+    ]
+
+@pytest.mark.parametrize(
+    '   values,     variables',
+    [
+        ('',         [('x', 1, 0)]),
+        ('',         [('x', 1, 1)]),
+        ('aaabbc',   [('x', 1, 1), ('y', 2, 0)]),
+        ('aaaabb',   [('x', 2, 0), ('y', 2, 1)]),
+        ('aabbbcd',  [('x', 1, 1), ('y', 1, 0), ('z', 1, 2)]),
+        ('aaaaaa',   [('x', 1, 1), ('y', 2, 1), ('z', 3, 0)]),
+        ('abcdefgh', [('x', 1, 3), ('y', 1, 3), ('z', 1, 3)]),
+        ('aab',      [('x', 2, 1)]),
+    ]
+)  # yapf: disable
+def test_commutative_sequence_variable_partition_count(values, variables):
+    values = Multiset(values)
+    variables = [VariableWithCount(name, count, minimum, None) for name, count, minimum in variables]
+
+    expected = len(list(commutative_sequence_variable_partition_iter(values, variables)))
+
+    assert commutative_sequence_variable_partition_count(values, variables) == expected
+
+
+def test_budget():
+    budget = Budget(max_steps=2)
+
+    budget.step()
+    budget.step()
+    assert budget.exhausted
+    with pytest.raises(BudgetExceeded) as exc_info:
+        budget.step()
+    assert exc_info.value.budget is budget
+    assert exc_info.value.result is None
+    assert budget.steps == 2
+
+    budget = Budget(timeout=0)
+    assert budget.exhausted
+    with pytest.raises(BudgetExceeded):
+        budget.step()
+
+    budget = Budget()
+    for _ in range(1000):
+        budget.step()
+    assert not budget.exhausted
+    assert budget.steps == 1000
+
+
+def test_commutative_sequence_variable_partition_iter_budget():
+    values = Multiset(range(10))
+    variables = [VariableWithCount('x', 1, 1, None), VariableWithCount('y', 1, 1, None)]
+
+    budget = Budget(max_steps=10)
+    with pytest.raises(BudgetExceeded):
+        list(commutative_sequence_variable_partition_iter(values, variables, budget))
+    assert len(list(commutative_sequence_variable_partition_iter(values, variables, Budget(max_steps=1024)))) == 1022